@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+from threading import Lock, Timer
+
+from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.engine import Future
+
+
+class Batcher(object):
+    '''
+    Collects commands and sends them to the server in batches. A batch is
+    sent when it holds ``max_size`` commands, ``window`` seconds after its
+    first command was queued, or when flush() is called (as it is on
+    leaving a with block). submit() returns a Future for each command's
+    Response.
+    '''
+
+    def __init__(self, client, max_size=None, window=None, path='/api/do'):
+        self.client = client
+        self.max_size = max_size or prefs['batch_size']
+        self.window = prefs['batch_window'] if window is None else window
+        self.path = path
+        self._lock = Lock()
+        self._pending = []
+        self._timer = None
+
+    def submit(self, values):
+        future = Future()
+        with self._lock:
+            self._pending.append((values, future))
+            full = len(self._pending) >= self.max_size
+            if not full and self._timer is None:
+                self._timer = Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+        return future
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch):
+        try:
+            results = self.client.post_batch([values for values, future in batch], self.path)
+        except Exception as e:
+            for values, future in batch:
+                future.set_exception(e)
+            return
+        for (values, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
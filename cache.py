@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import json
+import time
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+
+from calibre.utils.config import config_dir
+from calibre.utils.filenames import atomic_rename
+
+# Commands whose answers only depend on their arguments, and so can be cached.
+# get_texts is not one: its zip of texts changes whenever any of them is edited.
+CACHEABLE_COMMANDS = ('get_issues', 'get_formats', 'search')
+# Commands that change what the server would answer to the cached ones
+INVALIDATES = {
+    'commit_metadata': ('search',),
+    'new_text': ('search', 'get_issues'),
+    'sync_issue': ('search', 'get_issues'),
+    'get_author': ('search',),
+}
+# Response headers kept with a cached body
+STORED_HEADERS = ('content-type', 'etag', 'last-modified')
+
+
+def cache_dir():
+    return os.path.join(config_dir, 'plugins', 'casanova_cache')
+
+
+def is_json(body):
+    ''' Whether a response body is a well formed JSON document, as every cacheable answer is '''
+    try:
+        json.loads(body)
+    except ValueError:
+        return False
+    return True
+
+
+def cache_key(url, username, values):
+    ''' The cache key of a command: the server, who asked, and the command's arguments '''
+    parts = [url, username or ''] + ['%s=%s' % (k, values[k]) for k in sorted(values)]
+    return sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+class ResponseCache(object):
+    '''
+    Server responses kept on disk, one file per body plus an index with
+    when each was stored and last used and its validators (ETag and
+    Last-Modified). Bodies younger than their command's TTL are served
+    without asking the server; older ones are revalidated with a
+    conditional request. The least recently used bodies are evicted once
+    the cache grows past ``max_size`` bytes.
+    '''
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = Lock()
+        self._entries = None
+        self._dirty = False
+        self.stats = {'hits': 0, 'stale': 0, 'revalidated': 0, 'misses': 0,
+                      'stored': 0, 'evicted': 0}
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def _body_path(self, key):
+        return os.path.join(self.directory, key + '.body')
+
+    def _load(self):
+        ''' Reads the index the first time the cache is used. Call with the lock held. '''
+        if self._entries is not None:
+            return
+        self._entries = OrderedDict()
+        try:
+            with open(self.index_path, 'rb') as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        for key, entry in sorted(entries.iteritems(), key=lambda x: x[1]['used']):
+            if entry.get('cmd') not in CACHEABLE_COMMANDS:
+                # Left by a version that cached other commands
+                self._remove(key)
+            elif os.path.exists(self._body_path(key)):
+                self._entries[key] = entry
+
+    def _save(self):
+        ''' Writes the index. Call with the lock held. '''
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            with open(self.index_path + '.tmp', 'wb') as f:
+                json.dump(self._entries, f)
+            atomic_rename(self.index_path + '.tmp', self.index_path)
+            self._dirty = False
+        except (IOError, OSError) as e:
+            print('Failed to save the Casanova response cache index:', e)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        try:
+            os.remove(self._body_path(key))
+        except (IOError, OSError):
+            pass
+        return entry
+
+    def lookup(self, key, ttl):
+        '''
+        Returns (entry, body, fresh) for a cached response, or (None, None,
+        False). A stale entry's validators can be sent to the server to ask
+        whether the body is still current.
+        '''
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None, None, False
+            try:
+                with open(self._body_path(key), 'rb') as f:
+                    body = f.read()
+            except (IOError, OSError):
+                self._entries.pop(key)
+                self.stats['misses'] += 1
+                return None, None, False
+            fresh = time.time() - entry['stored'] < ttl
+            if fresh:
+                self.stats['hits'] += 1
+                self._touch(key)
+            else:
+                self.stats['stale'] += 1
+            return entry, body, fresh
+
+    def _touch(self, key):
+        entry = self._entries.pop(key)
+        entry['used'] = time.time()
+        self._entries[key] = entry
+        self._dirty = True
+
+    def revalidated(self, key):
+        ''' The server answered 304 Not Modified: the cached body is fresh again '''
+        with self._lock:
+            self._load()
+            if key in self._entries:
+                self.stats['revalidated'] += 1
+                self._entries[key]['stored'] = time.time()
+                self._touch(key)
+
+    def store(self, key, cmd, headers, body):
+        '''
+        Caches a response body, evicting least recently used ones as needed.
+        Bodies that are not JSON, such as the error page of a proxy in front
+        of the server, are not kept.
+        '''
+        if len(body) > self.max_size or not is_json(body):
+            return
+        now = time.time()
+        entry = {'cmd': cmd, 'stored': now, 'used': now, 'size': len(body),
+                 'headers': dict((h, headers.getheader(h)) for h in STORED_HEADERS
+                                 if headers.getheader(h) is not None)}
+        with self._lock:
+            self._load()
+            self._remove(key)
+            try:
+                if not os.path.exists(self.directory):
+                    os.makedirs(self.directory)
+                path = self._body_path(key)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(body)
+                atomic_rename(path + '.tmp', path)
+            except (IOError, OSError) as e:
+                print('Failed to cache a Casanova response:', e)
+                return
+            self._entries[key] = entry
+            self.stats['stored'] += 1
+            size = sum(e['size'] for e in self._entries.itervalues())
+            while size > self.max_size:
+                old_key = next(iter(self._entries))
+                size -= self._remove(old_key)['size']
+                self.stats['evicted'] += 1
+            self._save()
+
+    def invalidate(self, cmds=None):
+        ''' Drops the cached responses of the given commands, or all of them '''
+        with self._lock:
+            self._load()
+            for key, entry in self._entries.items():
+                if cmds is None or entry['cmd'] in cmds:
+                    self._remove(key)
+            self._save()
+
+    def save(self):
+        ''' Persists the last used times of entries served since the last save '''
+        with self._lock:
+            if self._entries is not None and self._dirty:
+                self._save()
+
+    def size(self):
+        with self._lock:
+            self._load()
+            return sum(e['size'] for e in self._entries.itervalues())
+
+    def stats_summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['stale'] + stats['misses']
+        return ('Casanova response cache: %(hits)d hits, %(revalidated)d of %(stale)d stale '
+                'revalidated, %(misses)d misses, %(stored)d stored, %(evicted)d evicted' % stats +
+                (' (%.0f%% served locally)' % (100 * (stats['hits'] + stats['revalidated']) / lookups)
+                 if lookups else ''))
@@ -0,0 +1,755 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import httplib
+import json
+import socket
+import time
+import urllib
+import zlib
+from base64 import b64decode
+from StringIO import StringIO
+from threading import Condition, Event, Lock
+from urlparse import urlsplit, urljoin
+
+from calibre import get_proxies, url_slash_cleaner
+
+from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.cache import (ResponseCache, CACHEABLE_COMMANDS,
+                                                   INVALIDATES, cache_dir, cache_key)
+from calibre_plugins.casanova_plugin.multipart import MultipartBody, encoded_files
+from calibre_plugins.casanova_plugin.scheduler import (scheduler, command_priority,
+                                                       transfer_connections,
+                                                       INTERACTIVE, NORMAL, BULK)
+
+USER_AGENT = 'Casanova/1.0 (compatible; MSIE 5.5; Windows NT)'
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+CHUNK_SIZE = 64 * 1024
+# Seconds a blocking socket operation may take before giving up
+SOCKET_TIMEOUT = 60
+# Log in again this many seconds before the session token expires
+TOKEN_MARGIN = 30
+# Content codings we can decode in responses, and can send in requests
+ACCEPT_ENCODING = 'gzip, deflate'
+# Seconds before a server found not to support an optional command is asked again
+UNSUPPORTED_RECHECK = 600
+# Commands that can safely be sent twice, so they are sent again on a fresh
+# connection when a reused one fails after the request went out
+IDEMPOTENT_COMMANDS = frozenset(('login', 'search', 'get_formats', 'get_issues', 'get_texts',
+                                 'update_metadata', 'has_content', 'upload_status',
+                                 'upload_chunk'))
+
+
+class HTTPError(Exception):
+    ''' The Casanova server (or a file host) answered with an error status '''
+
+    def __init__(self, url, status, reason, body=''):
+        Exception.__init__(self, 'HTTP %d %s for %s' % (status, reason, url))
+        self.url = url
+        self.status = status
+        self.body = body
+
+
+class Cancelled(Exception):
+    ''' The job that made a request was cancelled while it was in flight '''
+
+
+class RequestTimeout(Exception):
+    ''' A request did not complete before its deadline '''
+
+
+class Deadline(object):
+    '''
+    The time budget of one request and the abort event of the job making
+    it. Blocking socket operations never wait past the deadline, and both
+    are checked between the chunks of a request or response body. If
+    given, progress(bytes done, total bytes) is called after each chunk
+    of an upload or download. The priority is the request's class in the
+    scheduler, and transfer is set for requests run in a transfer slot.
+    '''
+
+    def __init__(self, timeout=None, abort=None, progress=None, priority=NORMAL, transfer=False):
+        self.expires = time.time() + timeout if timeout else None
+        self.abort = abort
+        self.progress = progress
+        self.priority = priority
+        self.transfer = transfer
+
+    def check(self, url):
+        if self.abort is not None and self.abort.is_set():
+            raise Cancelled('Cancelled request to ' + url)
+        if self.expires is not None and time.time() >= self.expires:
+            raise RequestTimeout('Timed out waiting for ' + url)
+
+    def socket_timeout(self):
+        if self.expires is None:
+            return SOCKET_TIMEOUT
+        return max(0.01, min(SOCKET_TIMEOUT, self.expires - time.time()))
+
+    def apply(self, conn):
+        ''' Limits the connection's next blocking operation to the time left '''
+        conn.timeout = self.socket_timeout()
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
+
+
+class Headers(dict):
+    ''' Response headers with the case-insensitive getheader() of mimetools.Message '''
+
+    def __init__(self, items=()):
+        dict.__init__(self, ((k.lower(), v) for k, v in items))
+
+    def getheader(self, name, default=None):
+        return self.get(name.lower(), default)
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decode_body(data, encoding):
+    ''' Undoes the Content-Encoding of a response body '''
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        # Servers disagree on whether deflate means zlib or raw deflate data
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    return data
+
+
+class Response(object):
+    '''
+    A fully read HTTP response. It has the read() and info().getheader()
+    methods the plugin used on the responses from urllib2.urlopen.
+    '''
+
+    def __init__(self, url, status, headers, body, wire_size=None):
+        self.url = url
+        self.code = status
+        self.headers = headers
+        self.body = body
+        # Bytes actually received, before any Content-Encoding was undone
+        self.wire_size = len(body) if wire_size is None else wire_size
+        self._fp = StringIO(body)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._fp.read()
+        return self._fp.read(amt)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+
+class ConnectionPool(object):
+    '''
+    Keep-alive connections to one host. At most ``maxsize`` connections
+    are open at once; callers wait for a free one beyond that, for as long
+    as their deadline allows.
+    '''
+
+    def __init__(self, scheme, host, port, maxsize, proxy=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.proxy = proxy
+        self._idle = []
+        self._lock = Lock()
+        self._free = maxsize
+        self._slots = Condition(Lock())
+
+    def _new_connection(self):
+        if self.proxy:
+            phost, _, pport = self.proxy.partition(':')
+            pport = int(pport) if pport else None
+            if self.scheme == 'https':
+                conn = httplib.HTTPSConnection(phost, pport, timeout=SOCKET_TIMEOUT)
+                conn.set_tunnel(self.host, self.port)
+            else:
+                conn = httplib.HTTPConnection(phost, pport, timeout=SOCKET_TIMEOUT)
+            return conn
+        cls = httplib.HTTPSConnection if self.scheme == 'https' else httplib.HTTPConnection
+        return cls(self.host, self.port, timeout=SOCKET_TIMEOUT)
+
+    def get(self, deadline=None, url=''):
+        ''' Returns (connection, was_reused) '''
+        with self._slots:
+            while self._free <= 0:
+                if deadline is not None:
+                    deadline.check(url)
+                self._slots.wait(0.1)
+            self._free -= 1
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def put(self, conn, reusable=True):
+        if reusable:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        with self._slots:
+            self._free += 1
+            self._slots.notify()
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+
+class UnsupportedServers(object):
+    '''
+    Servers found not to support an optional command, such as batch. They
+    are not sent it again until UNSUPPORTED_RECHECK seconds have passed,
+    after which it is tried again, since the server may have been upgraded
+    or the answer may have come from something passing, like a proxy error.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._until = {}
+
+    def add(self, server):
+        with self._lock:
+            self._until[server] = time.time() + UNSUPPORTED_RECHECK
+
+    def __contains__(self, server):
+        with self._lock:
+            until = self._until.get(server)
+            if until is not None and until <= time.time():
+                del self._until[server]
+                until = None
+            return until is not None
+
+
+class SingleFlight(object):
+    '''
+    Runs at most one call per key at a time. Callers that ask for a key
+    while a call for it is in flight wait for that call and share its
+    result (or exception) instead of making their own.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = {'done': Event(), 'result': None, 'error': None}
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = func(*args, **kwargs)
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
+
+
+class CasanovaClient(object):
+    '''
+    The one HTTP client shared by everything in the plugin that talks to
+    the network. Connections are pooled per host and reused across calls
+    and threads, so a run of requests pays TCP and TLS setup once.
+    '''
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = Lock()
+        # (url, username, password) -> (token, expiry time)
+        self._tokens = {}
+        # (url, username, password) of servers that predate the login command
+        self._legacy_auth = set()
+        # (url, username, password) -> the features the server announced at login
+        self._features = {}
+        self._auth_lock = Lock()
+        # Hosts that said (via a response Accept-Encoding header) they take gzip bodies
+        self._gzip_hosts = set()
+        # cmd -> [raw bytes sent, bytes sent, raw bytes received, bytes received]
+        self.transfer_stats = {}
+        self._stats_lock = Lock()
+        self._cache = None
+        # Identical read-only commands in flight at once share one round trip
+        self.flights = SingleFlight()
+        # Listener urls of servers that do not understand the batch command
+        self._no_batch = UnsupportedServers()
+
+    @property
+    def cache(self):
+        ''' The on-disk cache of responses to read-only commands '''
+        with self._lock:
+            if self._cache is None:
+                self._cache = ResponseCache(cache_dir(), prefs['cache_size'])
+            return self._cache
+
+    def _pool(self, scheme, netloc):
+        proxy = get_proxies(debug=False).get(scheme)
+        key = (scheme, netloc, proxy)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                host, _, port = netloc.partition(':')
+                port = int(port) if port else None
+                # Transfers do not wait for the scheduler, so they need connections of their own
+                pool = ConnectionPool(scheme, host, port,
+                                      prefs['connection_pool_size'] + transfer_connections(), proxy)
+                self._pools[key] = pool
+            return pool
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.itervalues():
+                pool.close()
+            self._pools = {}
+            if self._cache is not None:
+                self._cache.save()
+
+    def _send(self, method, url, body=None, headers=None, deadline=None, idempotent=True):
+        '''
+        Sends one request and returns (pool, connection, httplib response)
+        with the body still unread. The caller must read the body and hand
+        the connection back with pool.put(). A pooled connection that the
+        server has meanwhile closed is retried once on a fresh one, unless
+        the request is not idempotent and its body had started to go out:
+        the server may have acted on it. The body is sent in chunks, so a
+        cancelled or overdue request stops (and gives up its connection)
+        part way through. The body is a byte string or an object, like a
+        MultipartBody, that has a length and gives its content through
+        chunks().
+        '''
+        deadline = deadline or Deadline()
+        scheme, netloc, path, query, _ = urlsplit(url)
+        pool = self._pool(scheme, netloc)
+        target = path or '/'
+        if query:
+            target += '?' + query
+        if pool.proxy and scheme == 'http':
+            target = url
+        hdrs = {'User-Agent': USER_AGENT}
+        hdrs.update(headers or {})
+        # httplib joins the request line and headers with the body, which
+        # must not be unicode once the body holds binary (gzipped) data
+        method, target = str(method), str(target)
+        hdrs = dict((str(k), str(v)) for k, v in hdrs.iteritems())
+        if body is not None:
+            hdrs['Content-Length'] = str(len(body))
+        skip_accept_encoding = any(k.lower() == 'accept-encoding' for k in hdrs)
+        while True:
+            deadline.check(url)
+            conn, reused = pool.get(deadline, url)
+            body_started = False
+            try:
+                deadline.apply(conn)
+                conn.putrequest(method, target, skip_accept_encoding=skip_accept_encoding)
+                for name, value in hdrs.iteritems():
+                    conn.putheader(name, value)
+                conn.endheaders()
+                sent = 0
+                for chunk in self._chunks(body):
+                    scheduler.bucket.consume(len(chunk), deadline.priority, deadline)
+                    deadline.check(url)
+                    deadline.apply(conn)
+                    body_started = True
+                    conn.send(chunk)
+                    sent += len(chunk)
+                    if deadline.progress is not None:
+                        deadline.progress(sent, len(body))
+                deadline.apply(conn)
+                return pool, conn, conn.getresponse()
+            except (Cancelled, RequestTimeout):
+                pool.put(conn, False)
+                raise
+            except socket.timeout:
+                pool.put(conn, False)
+                raise RequestTimeout('Timed out waiting for ' + url)
+            except (httplib.HTTPException, socket.error):
+                pool.put(conn, False)
+                if not reused or (body_started and not idempotent):
+                    raise
+            except:
+                # Anything else, such as a file of the body that can not be read
+                pool.put(conn, False)
+                raise
+
+    def _chunks(self, body):
+        if body is None:
+            return ()
+        if hasattr(body, 'chunks'):
+            return body.chunks(CHUNK_SIZE)
+        return (body[i:i + CHUNK_SIZE] for i in xrange(0, len(body), CHUNK_SIZE))
+
+    def _read(self, pool, conn, resp, url, deadline):
+        ''' Reads a response body in chunks, checking the deadline between them '''
+        chunks = []
+        try:
+            while True:
+                deadline.check(url)
+                deadline.apply(conn)
+                chunk = resp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                scheduler.bucket.consume(len(chunk), deadline.priority, deadline)
+        except socket.timeout:
+            pool.put(conn, False)
+            raise RequestTimeout('Timed out waiting for ' + url)
+        except:
+            pool.put(conn, False)
+            raise
+        pool.put(conn, not resp.will_close)
+        return b''.join(chunks)
+
+    def request(self, method, url, body=None, headers=None, deadline=None, idempotent=True):
+        '''
+        Performs a request, once the scheduler has a slot for its priority,
+        and returns the fully read Response
+        '''
+        deadline = deadline or Deadline()
+        scheduler.acquire(deadline.priority, deadline, deadline.transfer)
+        try:
+            pool, conn, resp = self._send(method, url, body, headers, deadline, idempotent)
+            data = self._read(pool, conn, resp, url, deadline)
+        finally:
+            scheduler.release(deadline.priority, deadline.transfer)
+        headers = Headers(resp.getheaders())
+        if 'gzip' in headers.getheader('accept-encoding', '').lower():
+            self._gzip_hosts.add(urlsplit(url).netloc)
+        wire_size = len(data)
+        data = decode_body(data, headers.pop('content-encoding', None))
+        response = Response(url, resp.status, headers, data, wire_size)
+        if resp.status >= 400:
+            raise HTTPError(url, resp.status, resp.reason, data)
+        return response
+
+    def post(self, values, path='/api/do', timeout=None, abort=None, progress=None,
+             priority=None, files=None, transfer=False):
+        '''
+        Posts a command to the casanova listener url. Answers to read-only
+        commands come from the response cache while they are younger than
+        the command's TTL, and are revalidated with the server after that.
+        Identical read-only commands made at the same time share one request.
+
+        The request raises RequestTimeout if it takes longer than timeout
+        seconds (by default the command's request_timeouts pref), and
+        Cancelled as soon as the abort event is set. progress(bytes sent,
+        total bytes) is called as the request body goes out. The priority
+        class defaults to the command's (see scheduler.COMMAND_PRIORITIES).
+        Set transfer for requests made while holding a transfer slot (see
+        transfers.py), which the scheduler does not limit again.
+
+        files maps field names to paths of files to send with the command;
+        they are streamed from disk in a multipart/form-data body.
+        '''
+        prefs.refresh()
+        url = url_slash_cleaner(prefs['base_url'] + path)
+        if timeout is None:
+            timeouts = prefs['request_timeouts']
+            timeout = timeouts.get(values.get('cmd'), timeouts['default'])
+        if priority is None:
+            priority = command_priority(values.get('cmd'))
+        deadline = Deadline(timeout, abort, progress, priority, transfer)
+        if values.get('cmd') not in CACHEABLE_COMMANDS or abort is not None or files:
+            return self._cached_post(url, values, deadline, files)
+        key = (url, prefs['username']) + tuple(sorted(values.iteritems()))
+        response = self.flights.do(key, self._cached_post, url, values, deadline)
+        # Each caller reads its own copy of the shared body
+        return Response(response.url, response.code, response.headers, response.body,
+                        response.wire_size)
+
+    def _cached_post(self, url, values, deadline=None, files=None):
+        cmd = values.get('cmd')
+        ttl = prefs['cache_ttls'].get(cmd, 0) if cmd in CACHEABLE_COMMANDS else 0
+        key = entry = None
+        validators = {}
+        if ttl > 0:
+            key = cache_key(url, prefs['username'], values)
+            entry, cached, fresh = self.cache.lookup(key, ttl)
+            if fresh:
+                return Response(url, 200, Headers(entry['headers'].iteritems()), cached, 0)
+            if entry is not None:
+                if 'etag' in entry['headers']:
+                    validators['If-None-Match'] = entry['headers']['etag']
+                if 'last-modified' in entry['headers']:
+                    validators['If-Modified-Since'] = entry['headers']['last-modified']
+        response = self._post(url, values, validators, deadline, files)
+        if entry is not None and response.code == 304:
+            self.cache.revalidated(key)
+            return Response(url, 200, Headers(entry['headers'].iteritems()), cached,
+                            response.wire_size)
+        if key is not None and response.code == 200:
+            self.cache.store(key, cmd, response.headers, response.body)
+        elif cmd in INVALIDATES:
+            self.cache.invalidate(INVALIDATES[cmd])
+        return response
+
+    def post_batch(self, commands, path='/api/do'):
+        '''
+        Sends several commands in one request. Returns one entry per
+        command, in order: its Response, or the HTTPError the server
+        answered it with. Servers that answer the batch command as unknown,
+        or not with a list of answers, are sent the commands one at a time
+        for the next UNSUPPORTED_RECHECK seconds.
+        '''
+        prefs.refresh()
+        url = url_slash_cleaner(prefs['base_url'] + path)
+        if len(commands) > 1 and url not in self._no_batch:
+            try:
+                timeouts = prefs['request_timeouts']
+                priority = min(command_priority(values.get('cmd')) for values in commands)
+                response = self._cached_post(url, {'cmd': 'batch',
+                                                   'commands': json.dumps(commands)},
+                                             Deadline(timeouts.get('batch', timeouts['default']),
+                                                      priority=priority))
+                items = json.loads(response.read())
+            except HTTPError as e:
+                if e.status not in (400, 404, 501):
+                    raise
+                items = None
+            except ValueError:
+                items = None
+            if isinstance(items, list) and len(items) == len(commands):
+                return [self._batch_result(url, values, item)
+                        for values, item in zip(commands, items)]
+            print('Casanova server does not support batches, sending commands one at a time')
+            self._no_batch.add(url)
+        results = []
+        for values in commands:
+            try:
+                results.append(self.post(values, path))
+            except HTTPError as e:
+                results.append(e)
+        return results
+
+    def _batch_result(self, url, values, item):
+        ''' Turns one entry of a batch response into a Response or HTTPError '''
+        status = int(item.get('status', 200))
+        body = b64decode(item.get('body', ''))
+        if status >= 400:
+            return HTTPError(url, status, item.get('reason', ''), body)
+        if values.get('cmd') in INVALIDATES:
+            self.cache.invalidate(INVALIDATES[values['cmd']])
+        headers = Headers([('content-type', item.get('content_type', 'text/plain'))])
+        return Response(url, status, headers, body, 0)
+
+    def _post(self, url, values, extra_headers, deadline=None, files=None):
+        '''
+        Sends a command with the session token instead of the username and
+        password; if the server rejects it as expired we log in again and
+        retry once.
+        '''
+        credentials = (url, prefs['username'], prefs['password'])
+        for attempt in (1, 2):
+            auth = self._auth_values(credentials)
+            data = dict(values)
+            data.update(auth)
+            parts = files
+            if files and 'files' not in self._server_features(credentials):
+                # Servers from before file parts take files base64 encoded in the form
+                data.update(encoded_files(files))
+                parts = None
+            if parts:
+                body = MultipartBody(data, parts)
+                raw = body
+                headers = {'Content-type': body.content_type, 'Accept-Encoding': ACCEPT_ENCODING}
+            else:
+                raw = urllib.urlencode(data)
+                body, headers = self._encode_body(url, raw)
+            headers.update(extra_headers)
+            try:
+                response = self.request('POST', url, body, headers, deadline,
+                                        values.get('cmd') in IDEMPOTENT_COMMANDS)
+            except HTTPError as e:
+                if e.status != 401 or 'token' not in auth or attempt == 2:
+                    raise
+                self._forget_token(credentials, auth['token'])
+                continue
+            self._count_transfer(values.get('cmd'), len(raw), len(body),
+                                 len(response.body), response.wire_size)
+            return response
+
+    def _encode_body(self, url, body):
+        '''
+        Gzips a request body above the compress_threshold pref, once the
+        server has said it accepts gzip request bodies (RFC 7694).
+        '''
+        headers = {'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
+                   'Accept-Encoding': ACCEPT_ENCODING}
+        if len(body) > prefs['compress_threshold'] and urlsplit(url).netloc in self._gzip_hosts:
+            compressed = gzip_compress(body)
+            if len(compressed) < len(body):
+                headers['Content-Encoding'] = 'gzip'
+                return compressed, headers
+        return body, headers
+
+    def _count_transfer(self, cmd, sent_raw, sent, received_raw, received):
+        with self._stats_lock:
+            stats = self.transfer_stats.setdefault(cmd, [0, 0, 0, 0])
+            stats[0] += sent_raw
+            stats[1] += sent
+            stats[2] += received_raw
+            stats[3] += received
+
+    def bytes_saved(self, cmd=None):
+        ''' Bytes compression kept off the wire, for one command or all of them '''
+        with self._stats_lock:
+            if cmd is not None:
+                rows = [self.transfer_stats.get(cmd, [0, 0, 0, 0])]
+            else:
+                rows = self.transfer_stats.values()
+            return sum(r[0] - r[1] + r[2] - r[3] for r in rows)
+
+    def stats_summary(self, cmd):
+        with self._stats_lock:
+            sent_raw, sent, received_raw, received = self.transfer_stats.get(cmd, [0, 0, 0, 0])
+        return '%s: sent %d bytes (%d uncompressed), received %d bytes (%d uncompressed)' % (
+            cmd, sent, sent_raw, received, received_raw)
+
+    def _auth_values(self, credentials):
+        ''' The fields that authenticate a request: a session token when the server supports them '''
+        url, username, password = credentials
+        with self._auth_lock:
+            if credentials not in self._legacy_auth:
+                token, expires = self._tokens.get(credentials, (None, 0))
+                if token is None or expires <= time.time():
+                    token, expires = self._login(credentials)
+                if token is not None:
+                    self._tokens[credentials] = (token, expires)
+                    return {'token': token}
+        return {'un': username, 'pw': password}
+
+    def features(self):
+        '''
+        The optional parts of the protocol the server announced in its
+        answer to login: 'files' if it takes files as multipart file parts,
+        'formats' if new_text takes several formats. Servers that announce
+        nothing (or predate login) get what the original protocol sent.
+        '''
+        prefs.refresh()
+        url = url_slash_cleaner(prefs['base_url'] + '/api/do')
+        credentials = (url, prefs['username'], prefs['password'])
+        self._auth_values(credentials)
+        return self._server_features(credentials)
+
+    def _server_features(self, credentials):
+        with self._auth_lock:
+            return self._features.get(credentials, frozenset())
+
+    def _login(self, credentials):
+        ''' Logs in once, returning (token, expiry time) or (None, 0) for servers without sessions '''
+        url, username, password = credentials
+        headers = {'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8'}
+        data = urllib.urlencode({'cmd': 'login', 'un': username, 'pw': password})
+        timeouts = prefs['request_timeouts']
+        try:
+            response = self.request('POST', url, data, headers,
+                                    Deadline(timeouts.get('login', timeouts['default']),
+                                             priority=INTERACTIVE))
+            doc = json.loads(response.read())
+            token = doc['token']
+            expires = time.time() + float(doc.get('expires_in', 3600)) - TOKEN_MARGIN
+            self._features[credentials] = frozenset(doc.get('features', ()))
+        except HTTPError as e:
+            if e.status not in (400, 404, 501):
+                raise
+            print('Casanova server does not know the login command, sending credentials with each request')
+            self._legacy_auth.add(credentials)
+            return None, 0
+        except (ValueError, KeyError, TypeError):
+            print('Casanova server does not support sessions, sending credentials with each request')
+            self._legacy_auth.add(credentials)
+            return None, 0
+        return token, expires
+
+    def _forget_token(self, credentials, token):
+        with self._auth_lock:
+            if self._tokens.get(credentials, (None, 0))[0] == token:
+                del self._tokens[credentials]
+
+    def download(self, url, dest, max_redirects=5, abort=None, progress=None, priority=BULK,
+                 transfer=True):
+        '''
+        Streams the file at url into the open file object dest. Raises
+        Cancelled, after dropping the connection, once abort is set.
+        progress(bytes received, total bytes or None) is called per chunk.
+        Downloads are transfers unless transfer is cleared, as they are
+        made holding a slot of transfers.downloads.
+        '''
+        deadline = Deadline(None, abort, priority=priority, transfer=transfer)
+        scheduler.acquire(priority, deadline, transfer)
+        try:
+            return self._download(url, dest, max_redirects, deadline, progress)
+        finally:
+            scheduler.release(priority, transfer)
+
+    def _download(self, url, dest, max_redirects, deadline, progress):
+        for i in xrange(max_redirects + 1):
+            pool, conn, resp = self._send('GET', url, deadline=deadline)
+            if resp.status in REDIRECT_CODES:
+                self._read(pool, conn, resp, url, deadline)
+                url = urljoin(url, resp.getheader('location'))
+                continue
+            if resp.status >= 400:
+                body = self._read(pool, conn, resp, url, deadline)
+                raise HTTPError(url, resp.status, resp.reason, body)
+            total = resp.getheader('content-length')
+            total = int(total) if total and total.isdigit() else None
+            received = 0
+            try:
+                while True:
+                    deadline.check(url)
+                    deadline.apply(conn)
+                    chunk = resp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    received += len(chunk)
+                    scheduler.bucket.consume(len(chunk), deadline.priority, deadline)
+                    if progress is not None:
+                        progress(received, total)
+            except socket.timeout:
+                pool.put(conn, False)
+                raise RequestTimeout('Timed out waiting for ' + url)
+            except:
+                pool.put(conn, False)
+                raise
+            pool.put(conn, not resp.will_close)
+            return url
+        raise HTTPError(url, 310, 'Too many redirects')
+
+
+# The client shared by all the plugin's modules and threads
+client = CasanovaClient()
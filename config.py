@@ -7,7 +7,8 @@ __license__ = 'GPL 3'
 __copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
-from PyQt4.Qt import QWidget, QVBoxLayout, QLabel, QLineEdit
+from PyQt4.Qt import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QCheckBox,
+                      QSpinBox, QComboBox)
 from time import time
 
 from calibre.utils.config import JSONConfig
@@ -24,6 +25,49 @@ prefs.defaults['base_url'] = 'http://website.com'
 prefs.defaults['username'] = 'guest'
 prefs.defaults['password'] = 'guest'
 prefs.defaults['last_updates'] = {}
+# Import the plugin's modules and load its indexes on first use / in the background
+prefs.defaults['lazy_startup'] = True
+# Print the plugin's network, cache and transfer statistics when calibre shuts down
+prefs.defaults['log_statistics'] = False
+# Keep-alive connections per host shared by all Casanova requests but transfers, which
+# get as many more as transfer_concurrency and upload_parallel_chunks allow
+prefs.defaults['connection_pool_size'] = 4
+# Request bodies larger than this many bytes are gzipped when the server accepts it
+prefs.defaults['compress_threshold'] = 1024
+# Seconds the answers to read-only commands are used without asking the server again
+prefs.defaults['cache_ttls'] = {'get_issues': 300, 'get_formats': 60, 'search': 120}
+# Bytes of server responses kept in the on-disk cache
+prefs.defaults['cache_size'] = 20 * 1024 * 1024
+# Commands sent together in one batch request, and seconds a batch waits to fill up
+prefs.defaults['batch_size'] = 20
+prefs.defaults['batch_window'] = 0.05
+# Seconds each command may take before it is abandoned ('default' for the rest)
+prefs.defaults['request_timeouts'] = {'default': 60, 'login': 20, 'get_issues': 20,
+                                      'get_formats': 20, 'search': 20, 'batch': 120,
+                                      'sync_issue': 300, 'get_author': 300, 'new_text': 600}
+# Requests of each priority class that may be in flight at once (transfers aside)
+prefs.defaults['priority_limits'] = {'interactive': 4, 'normal': 3, 'bulk': 2}
+# KB/s shared by all Casanova transfers, 0 for no limit
+prefs.defaults['bandwidth_limit'] = 0
+# Bounds on the downloads and uploads run at once; the number is tuned within them
+prefs.defaults['transfer_concurrency'] = {'download': {'min': 1, 'max': 6},
+                                          'upload': {'min': 1, 'max': 3}}
+# Files larger than this are uploaded in chunks of upload_chunk_size bytes, which
+# are sent over up to upload_parallel_chunks connections and can be resumed
+prefs.defaults['chunked_upload_threshold'] = 8 * 1024 * 1024
+prefs.defaults['upload_chunk_size'] = 1024 * 1024
+prefs.defaults['upload_parallel_chunks'] = 3
+# Chunked uploads that have not finished yet, by file
+prefs.defaults['upload_sessions'] = {}
+# Content hash of the cover each text last had on each server, by server and casanova id
+prefs.defaults['synced_covers'] = {}
+# Covers are scaled down to fit cover_max_size (width, height) and re-encoded as
+# cover_format ('jpg' or 'png') at cover_quality before upload, on cover_workers threads
+prefs.defaults['cover_processing'] = True
+prefs.defaults['cover_max_size'] = [1200, 1600]
+prefs.defaults['cover_format'] = 'jpg'
+prefs.defaults['cover_quality'] = 85
+prefs.defaults['cover_workers'] = 2
 
 class ConfigWidget(QWidget):
 
@@ -60,9 +104,43 @@ class ConfigWidget(QWidget):
 
         self.password_label.setBuddy(self.password_msg)                
 
+        self.cover_processing_check = QCheckBox('Shrink covers before uploading them', self)
+        self.cover_processing_check.setChecked(prefs['cover_processing'])
+        self.l.addWidget(self.cover_processing_check)
+
+        self.cover_size_label = QLabel('Largest cover size (width x height):')
+        self.l.addWidget(self.cover_size_label)
+        cover_size_layout = QHBoxLayout()
+        self.l.addLayout(cover_size_layout)
+        self.cover_width_spin = QSpinBox(self)
+        self.cover_height_spin = QSpinBox(self)
+        for spin, value in zip((self.cover_width_spin, self.cover_height_spin), prefs['cover_max_size']):
+            spin.setRange(100, 10000)
+            spin.setValue(value)
+            cover_size_layout.addWidget(spin)
+        self.cover_size_label.setBuddy(self.cover_width_spin)
+
+        self.cover_format_label = QLabel('Cover format and quality:')
+        self.l.addWidget(self.cover_format_label)
+        cover_format_layout = QHBoxLayout()
+        self.l.addLayout(cover_format_layout)
+        self.cover_format_combo = QComboBox(self)
+        self.cover_format_combo.addItems(['jpg', 'png'])
+        self.cover_format_combo.setCurrentIndex(max(0, self.cover_format_combo.findText(prefs['cover_format'])))
+        cover_format_layout.addWidget(self.cover_format_combo)
+        self.cover_quality_spin = QSpinBox(self)
+        self.cover_quality_spin.setRange(10, 100)
+        self.cover_quality_spin.setValue(prefs['cover_quality'])
+        cover_format_layout.addWidget(self.cover_quality_spin)
+        self.cover_format_label.setBuddy(self.cover_format_combo)
+
     def save_settings(self):
         prefs['base_url'] = unicode(self.url_msg.text())
         prefs['username'] = unicode(self.username_msg.text())
         prefs['password'] = unicode(self.password_msg.text())
+        prefs['cover_processing'] = self.cover_processing_check.isChecked()
+        prefs['cover_max_size'] = [self.cover_width_spin.value(), self.cover_height_spin.value()]
+        prefs['cover_format'] = unicode(self.cover_format_combo.currentText())
+        prefs['cover_quality'] = self.cover_quality_spin.value()
 
 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib
+import json
+import mmap
+import os
+import socket
+from threading import Lock
+
+from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.client import (client, HTTPError, RequestTimeout,
+                                                    UnsupportedServers)
+
+# Files at least this big are hashed through a memory map
+MMAP_THRESHOLD = 4 * 1024 * 1024
+BLOCK_SIZE = 8 * 1024 * 1024
+
+_lock = Lock()
+# (path, size, mtime) -> hash, so an unchanged file is hashed once
+_hashes = {}
+# Servers that do not know has_content, for a while
+_unsupported = UnsupportedServers()
+
+
+def content_hash(path):
+    ''' The sha256 of a file's content, which the server knows files by '''
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, int(st.st_mtime))
+    with _lock:
+        if key in _hashes:
+            return _hashes[key]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if st.st_size >= MMAP_THRESHOLD:
+            # Let the OS page the file in rather than copying it through read();
+            # buffer() views the map without copying a block out of it
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for i in xrange(0, st.st_size, BLOCK_SIZE):
+                    digest.update(buffer(m, i, BLOCK_SIZE))
+            finally:
+                m.close()
+        else:
+            for data in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(data)
+    with _lock:
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+
+def known_content(hashes, abort=None):
+    '''
+    The subset of hashes whose content the server already holds, so files
+    with them can be referred to by hash instead of sent. Servers without
+    the has_content command hold nothing as far as we know, and neither
+    does one that fails to answer: the files are then sent in full.
+    '''
+    hashes = sorted(set(hashes))
+    if not hashes:
+        return set()
+    prefs.refresh()
+    server = prefs['base_url']
+    if server in _unsupported:
+        return set()
+    try:
+        response = client.post({'cmd': 'has_content', 'hashes': '|'.join(hashes)}, abort=abort)
+        doc = json.loads(response.read())
+        if isinstance(doc, dict):
+            return set(doc.get('known', [])) & set(hashes)
+    except HTTPError as e:
+        if e.status not in (400, 404, 501):
+            print('Casanova server could not check its content, sending files in full:', e)
+            return set()
+    except (RequestTimeout, socket.error) as e:
+        print('Casanova server could not check its content, sending files in full:', e)
+        return set()
+    except ValueError:
+        pass
+    print('Casanova server does not support has_content, sending files in full')
+    _unsupported.add(server)
+    return set()
+
+
+def synced_covers():
+    ''' {casanova id: content hash} of the covers last sent to or received from the server '''
+    prefs.refresh()
+    return dict(prefs['synced_covers'].get(prefs['base_url'], {}))
+
+
+def record_synced_covers(hashes):
+    ''' Remembers the covers the server now has, so unchanged ones are not sent again '''
+    if not hashes:
+        return
+    with _lock:
+        prefs.refresh()
+        all_covers = dict(prefs['synced_covers'])
+        covers = dict(all_covers.get(prefs['base_url'], {}))
+        covers.update(hashes)
+        all_covers[prefs['base_url']] = covers
+        prefs['synced_covers'] = all_covers
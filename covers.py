@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+from threading import Lock
+
+from calibre import human_readable
+from calibre.ptempfile import PersistentTemporaryFile
+try:
+    from calibre.utils.img import save_cover_data_to
+except ImportError:
+    # calibre versions from before the Qt image functions
+    from calibre.utils.magick.draw import save_cover_data_to
+
+from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.content import content_hash
+from calibre_plugins.casanova_plugin.engine import WorkerPool
+
+# The extension save_cover_data_to picks the output format by
+COVER_FORMATS = ('jpg', 'png')
+
+
+class CoverPipeline(object):
+    '''
+    Shrinks covers before they are uploaded: covers larger than the
+    cover_max_size pref are scaled down to fit it and all are re-encoded
+    as cover_format at cover_quality. The result is used only when it is
+    smaller than the original. Covers are processed on a pool of
+    cover_workers threads, and each one only once per session; the files
+    made are removed at shutdown.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pool = WorkerPool(lambda: max(1, prefs['cover_workers']), 'CasanovaCovers')
+        # (content hash, settings) -> path of the cover to upload
+        self._prepared = {}
+        # Paths of the covers made, to remove
+        self._outputs = set()
+        self.processed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def settings(self):
+        fmt = prefs['cover_format'].lower()
+        return (tuple(prefs['cover_max_size']), fmt if fmt in COVER_FORMATS else 'jpg',
+                prefs['cover_quality'])
+
+    def prepare(self, path):
+        ''' The path of the cover to upload in place of the one at path, made on the pool '''
+        if not path or not prefs['cover_processing']:
+            return path
+        try:
+            return self._pool.submit(self._prepare, path).result()
+        except Exception:
+            return path
+
+    def _prepare(self, path):
+        max_size, fmt, quality = settings = self.settings()
+        key = (content_hash(path), settings)
+        with self._lock:
+            prepared = self._prepared.get(key)
+        if prepared is not None and os.path.exists(prepared):
+            return prepared
+        with open(path, 'rb') as f:
+            data = f.read()
+        tf = PersistentTemporaryFile(suffix='.' + fmt)
+        tf.close()
+        try:
+            save_cover_data_to(data, tf.name, minify_to=max_size, compression_quality=quality)
+            size = os.path.getsize(tf.name)
+        except Exception as e:
+            print('Could not process the cover %s, sending it as it is: %s' % (path, e))
+            size = None
+        if size is None or size >= len(data):
+            os.remove(tf.name)
+            prepared, size = path, len(data)
+        else:
+            prepared = tf.name
+        with self._lock:
+            if prepared != path:
+                self._outputs.add(prepared)
+            self._prepared[key] = prepared
+            self.processed += 1
+            self.bytes_in += len(data)
+            self.bytes_out += size
+        return prepared
+
+    def prepare_many(self, paths):
+        ''' Prepares several covers at once on the pool. Returns {path: path to upload}. '''
+        paths = set(p for p in paths if p)
+        if not paths or not prefs['cover_processing']:
+            return dict((p, p) for p in paths)
+        futures = dict((p, self._pool.submit(self._prepare, p)) for p in paths)
+        ret = {}
+        for p, future in futures.iteritems():
+            try:
+                ret[p] = future.result()
+            except Exception:
+                ret[p] = p
+        return ret
+
+    def bytes_saved(self):
+        with self._lock:
+            return self.bytes_in - self.bytes_out
+
+    def stats_summary(self):
+        with self._lock:
+            saved = self.bytes_in - self.bytes_out
+            return 'Casanova covers: %d processed, %s of %s saved' % (
+                self.processed, human_readable(saved), human_readable(self.bytes_in))
+
+    def shutdown(self):
+        ''' Stops the pool and removes the covers made '''
+        self._pool.shutdown()
+        with self._lock:
+            outputs, self._outputs = self._outputs, set()
+            self._prepared = {}
+        for path in outputs:
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                pass
+
+
+# The pipeline all cover uploads go through
+covers = CoverPipeline()
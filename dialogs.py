@@ -17,15 +17,59 @@ from PyQt4.Qt import (Qt, QVBoxLayout, QLabel, QLineEdit, QApplication,
                       QTextEdit)
 
 from calibre.ebooks.metadata import MetaInformation
-from calibre.gui2 import error_dialog, question_dialog, gprefs, open_url
+from calibre.gui2 import error_dialog, question_dialog, gprefs, open_url, Dispatcher
 from calibre.gui2.library.delegates import RatingDelegate
 from calibre.utils.date import qt_to_dt, UNDEFINED_DATE
 
 from calibre_plugins.casanova_plugin.utils import (get_icon, SizePersistedDialog, ImageLabel,
                                          ReadOnlyTableWidgetItem, ImageTitleLayout, ReadOnlyLineEdit,
-                                         DateDelegate, RatingTableWidgetItem, DateTableWidgetItem)
+                                         DateDelegate, RatingTableWidgetItem, DateTableWidgetItem,
+                                         CheckableTableWidgetItem)
+from calibre_plugins.casanova_plugin.client import Cancelled
+from calibre_plugins.casanova_plugin.engine import engine
+from calibre_plugins.casanova_plugin.scheduler import INTERACTIVE
+
+
+class BackgroundLoadMixin(object):
+    '''
+    For dialogs that fill themselves in with data from the server: the
+    data is fetched on the network engine and whatever has not finished
+    when the dialog closes is aborted, even a request already being sent.
+    '''
+
+    _loading = None
+
+    def load_in_background(self, callback, func, *args):
+        '''
+        Runs func(*args, abort=...) on the engine, then callback(future) in
+        the GUI thread. func must stop with Cancelled once abort is set.
+        '''
+        if self._loading is not None:
+            self._loading.cancel()
+        self._loading = future = engine.submit_abortable(INTERACTIVE, func, *args)
+        future.add_done_callback(Dispatcher(partial(self._loaded, callback)))
+
+    def add_placeholder(self, text, icon=None):
+        ''' Adds a line standing in for what is still loading, that can not be selected '''
+        if icon is None:
+            item = QListWidgetItem(text, self.values_list)
+        else:
+            item = QListWidgetItem(icon, text, self.values_list)
+        item.setFlags(Qt.ItemIsEnabled)
+        self.values_list.addItem(item)
+
+    def _loaded(self, callback, future):
+        if future is not self._loading or isinstance(future.exception(), Cancelled):
+            # Overtaken by a newer load, or the dialog was closed
+            return
+        callback(future)
+
+    def done(self, result):
+        if self._loading is not None:
+            self._loading.cancel()
+        return super(BackgroundLoadMixin, self).done(result)
 
-class ChooseIssuesToUpdateDialog(SizePersistedDialog):
+class ChooseIssuesToUpdateDialog(BackgroundLoadMixin, SizePersistedDialog):
 
     def __init__(self, parent=None, mm=None):
         SizePersistedDialog.__init__(self, parent, 'casanova plugin:issues update dialog')
@@ -51,12 +95,24 @@ class ChooseIssuesToUpdateDialog(SizePersistedDialog):
         self.resize_dialog()
 
     def _display_issues(self):
+        # Show the local issues straight away and add the remote ones when they arrive
+        self._show_issues(self.mm.get_all_issues(False), loading=True)
+        self.load_in_background(self._remote_issues_loaded, self.mm.get_remote_issues)
+
+    def _remote_issues_loaded(self, future):
+        remote_issues = future.result() if future.exception() is None else None
+        self._show_issues(self.mm.get_all_issues(remote_issues is not None, remote_issues))
+
+    def _show_issues(self, issues, loading=False):
+        selected = set(item.data(1).toPyObject()[0] for item in self.values_list.selectedItems())
         self.values_list.clear()
-        issues = self.mm.get_all_issues(True)
         for id, issue in issues:
             item = QListWidgetItem(get_icon('images/books.png'), issue, self.values_list)
             item.setData(1, (id,))
             self.values_list.addItem(item)
+            item.setSelected(id in selected)
+        if loading:
+            self.add_placeholder(_('loading issues from Casanova...'))
 
     def _accept_clicked(self):
         #self._save_preferences()
@@ -66,7 +122,7 @@ class ChooseIssuesToUpdateDialog(SizePersistedDialog):
         self.accept()
 
 
-class AddBookDialog(SizePersistedDialog):
+class AddBookDialog(BackgroundLoadMixin, SizePersistedDialog):
 
     def __init__(self, parent=None, mm=None, mi = None):
         SizePersistedDialog.__init__(self, parent, 'casanova plugin:add book dialog')
@@ -104,10 +160,15 @@ class AddBookDialog(SizePersistedDialog):
 
     def _display_choices(self):
         self.values_list.clear()
-        choices = self.mm.search(self.mi.title)
+        self.add_placeholder(_('looking for matches...'), get_icon('images/books.png'))
+        self.load_in_background(self._choices_loaded, self.mm.search, self.mi.title)
+
+    def _choices_loaded(self, future):
+        self.values_list.clear()
+        choices = future.result() if future.exception() is None else None
         if choices is None or len(choices)==0:
-            item = QListWidgetItem(get_icon('images/books.png'), _('there seem to be no matches'), self.values_list)
-            self.values_list.addItem(item)
+            choices = {}
+            self.add_placeholder(_('there seem to be no matches'), get_icon('images/books.png'))
         for id, name in choices.items():
             item = QListWidgetItem(get_icon('images/books.png'), name, self.values_list)
             item.setData(1, (id,))
@@ -125,6 +186,108 @@ class AddBookDialog(SizePersistedDialog):
         self.accept()  
 
 
+class BulkAddDialog(BackgroundLoadMixin, SizePersistedDialog):
+    '''
+    Adds many books to Casanova at once: one row per book, with the texts
+    already on the server that might be the same book (all looked up in
+    one batch of searches) and an editable one line description.
+    '''
+
+    ADD, TITLE, AUTHORS, FORMATS, MATCHES, ONE_LINER = range(6)
+
+    def __init__(self, parent=None, mm=None, books=None):
+        SizePersistedDialog.__init__(self, parent, 'casanova plugin:bulk add dialog')
+        self.setWindowTitle('Add texts to Casanova:')
+        self.gui = parent
+        self.mm = mm
+        self.books = books or []
+        self.selected_books = []
+
+        layout = QVBoxLayout(self)
+        self.setLayout(layout)
+
+        self.info_label = QLabel('Enter a short description (255 chars max) for each text. Texts with '
+                                 'potential matches on the server are not ticked - please make sure you are adding something new')
+        self.info_label.setWordWrap(True)
+        layout.addWidget(self.info_label)
+
+        self.books_table = QTableWidget(len(self.books), 6, self)
+        self.books_table.setHorizontalHeaderLabels(['Add', 'Title', 'Authors', 'Formats',
+                                                    'Potential matches', 'Short description'])
+        self.books_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.books_table.verticalHeader().setVisible(False)
+        layout.addWidget(self.books_table)
+
+        fill_layout = QHBoxLayout()
+        layout.addLayout(fill_layout)
+        self.fill_str = QLineEdit(self)
+        fill_layout.addWidget(self.fill_str)
+        self.fill_button = QPushButton('Use for empty descriptions', self)
+        self.fill_button.clicked.connect(self._fill_clicked)
+        fill_layout.addWidget(self.fill_button)
+
+        self.button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        self.button_box.accepted.connect(self._accept_clicked)
+        self.button_box.rejected.connect(self.reject)
+        layout.addWidget(self.button_box)
+
+        self._display_books()
+
+        # Cause our dialog size to be restored from prefs or created on first usage
+        self.resize_dialog()
+
+    def _display_books(self):
+        for row, book in enumerate(self.books):
+            self.books_table.setItem(row, self.ADD, CheckableTableWidgetItem(True))
+            self.books_table.setItem(row, self.TITLE, ReadOnlyTableWidgetItem(book['title']))
+            self.books_table.setItem(row, self.AUTHORS, ReadOnlyTableWidgetItem(' & '.join(book['authors'])))
+            self.books_table.setItem(row, self.FORMATS, ReadOnlyTableWidgetItem(
+                ', '.join(sorted(fmt.upper() for fmt in book['formats']))))
+            self.books_table.setItem(row, self.MATCHES, ReadOnlyTableWidgetItem(_('looking for matches...')))
+            self.books_table.setItem(row, self.ONE_LINER, QTableWidgetItem(''))
+        self.books_table.resizeColumnsToContents()
+        self.load_in_background(self._matches_loaded, self.mm.search_many,
+                                [book['title'] for book in self.books])
+
+    def _matches_loaded(self, future):
+        results = future.result() if future.exception() is None else {}
+        for row, book in enumerate(self.books):
+            matches = results.get(book['title'])
+            if matches is None:
+                text = _('could not check')
+            elif not isinstance(matches, dict):
+                text = unicode(matches)
+            elif matches:
+                text = '; '.join(sorted(matches.itervalues()))
+                self.books_table.item(row, self.ADD).setCheckState(Qt.Unchecked)
+            else:
+                text = _('there seem to be no matches')
+            self.books_table.item(row, self.MATCHES).setText(text)
+            self.books_table.item(row, self.MATCHES).setToolTip(text)
+
+    def _fill_clicked(self):
+        one_liner = unicode(self.fill_str.text()).strip()
+        for row in xrange(len(self.books)):
+            item = self.books_table.item(row, self.ONE_LINER)
+            if not unicode(item.text()).strip():
+                item.setText(one_liner)
+
+    def _accept_clicked(self):
+        self.selected_books = []
+        missing = []
+        for row, book in enumerate(self.books):
+            if not self.books_table.item(row, self.ADD).get_boolean_value():
+                continue
+            one_liner = unicode(self.books_table.item(row, self.ONE_LINER).text()).strip()
+            if not one_liner:
+                missing.append(book['title'])
+            self.selected_books.append((book['book_id'], one_liner[:255]))
+        if missing:
+            return error_dialog(self, 'Casanova message', _('You need to enter a short description for every text you add.'),
+                                det_msg='\n'.join(missing), show=True)
+        self.accept()
+
+
 class ChooseAuthorsToUpdateDialog(SizePersistedDialog):
 
     def __init__(self, parent=None, mm=None, choices = None):
@@ -166,7 +329,7 @@ class ChooseAuthorsToUpdateDialog(SizePersistedDialog):
         self.accept()    
 
 
-class SearchDialog(SizePersistedDialog):
+class SearchDialog(BackgroundLoadMixin, SizePersistedDialog):
 
     def __init__(self, parent=None, mm=None):
         SizePersistedDialog.__init__(self, parent, 'casanova plugin:search dialog')
@@ -211,7 +374,15 @@ class SearchDialog(SizePersistedDialog):
 
     def _find_clicked(self):
         query = unicode(self.search_str.text())
-        self._display_choices(self.mm.search(query))
+        self.values_list.clear()
+        self.add_placeholder(_('searching...'))
+        self.load_in_background(self._results_loaded, self.mm.search, query)
+
+    def _results_loaded(self, future):
+        if future.exception() is not None:
+            self.values_list.clear()
+            return error_dialog(self, 'Casanova message', unicode(future.exception()), show=True)
+        self._display_choices(future.result())
 
     def _accept_clicked(self):
         #self._save_preferences()
@@ -220,7 +391,7 @@ class SearchDialog(SizePersistedDialog):
             self.selected_texts.append(item.data(1).toPyObject()[0])
         self.accept() 
 
-class ChooseFormatToDownloadDialog(SizePersistedDialog):
+class ChooseFormatToDownloadDialog(BackgroundLoadMixin, SizePersistedDialog):
 
     def __init__(self, parent=None, dm=None, casanova_id=None):
         SizePersistedDialog.__init__(self, parent, 'casanova plugin:format download dialog')
@@ -248,7 +419,14 @@ class ChooseFormatToDownloadDialog(SizePersistedDialog):
 
     def _display_formats(self):
         self.values_list.clear()
-        formats = self.dm.get_download_info(self.casanova_id)
+        self.add_placeholder(_('loading formats...'))
+        self.load_in_background(self._formats_loaded, self.dm.get_download_info, self.casanova_id)
+
+    def _formats_loaded(self, future):
+        self.values_list.clear()
+        if future.exception() is not None:
+            return error_dialog(self.gui, 'Casanova message', unicode(future.exception()), show=True)
+        formats = future.result()
         if isinstance(formats, list):
             for format in formats:
                 item = QListWidgetItem(get_icon('images/books.png'), format['type'], self.values_list)
@@ -8,12 +8,8 @@ __docformat__ = 'restructuredtext en'
 
 import os
 import shutil
-from contextlib import closing
-from mechanize import MozillaCookieJar
-import json
-import mimetypes
 
-from calibre import browser, get_download_filename, url_slash_cleaner
+from calibre import get_download_filename
 from calibre.ebooks import BOOK_EXTENSIONS
 from calibre.gui2 import Dispatcher
 from calibre.gui2.threaded_jobs import ThreadedJob
@@ -21,6 +17,10 @@ from calibre.ptempfile import PersistentTemporaryFile
 from calibre.utils.filenames import ascii_filename
 
 from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.client import client, Cancelled
+from calibre_plugins.casanova_plugin.library import get_casanova_identifier
+from calibre_plugins.casanova_plugin.progress import JobProgress
+from calibre_plugins.casanova_plugin.transfers import downloads
 
 
 class CasanovaDownload(object):
@@ -28,7 +28,10 @@ class CasanovaDownload(object):
     def __call__(self, gui, url='', filename='', save_loc='', id=False, log=None, abort=None, notifications=None):
         dfilename = ''
         try:
-            dfilename = self._download(url, filename, save_loc)
+            progress = JobProgress(notifications, _('Downloading'))
+            dfilename = self._download(url, filename, save_loc, abort, progress)
+            if abort is not None and abort.is_set():
+                raise Cancelled(_('Download cancelled'))
             self._add(dfilename, gui, id)
             #self._save_as(dfilename, save_loc) # commented out because double files were being stored
         except Exception as e:
@@ -40,7 +43,7 @@ class CasanovaDownload(object):
             except:
                 pass
 
-    def _download(self, url, filename, save_loc):
+    def _download(self, url, filename, save_loc, abort=None, progress=None):
         dfilename = ''
 
         if not url:
@@ -55,11 +58,16 @@ class CasanovaDownload(object):
             filename = filename[:60] + ext
             filename = ascii_filename(filename)
 
-        br = browser()
-        with closing(br.open(url)) as r:
-            tf = PersistentTemporaryFile(suffix=filename)
-            tf.write(r.read())
-            dfilename = tf.name
+        tf = PersistentTemporaryFile(suffix=filename)
+        try:
+            with downloads.slot(abort) as slot, tf:
+                client.download(url, tf, abort=abort, progress=progress)
+                slot.bytes = tf.tell()
+        except:
+            # Do not leave a partial download behind
+            os.remove(tf.name)
+            raise
+        dfilename = tf.name
 
         return dfilename
 
@@ -86,7 +94,7 @@ gui_casanova_download = CasanovaDownload()
 
 def start_casanova_download(callback, job_manager, gui, url='', filename='', save_loc='', id=False):
     description = _('Downloading %s') % filename.decode('utf-8', 'ignore') if filename else url.decode('utf-8', 'ignore')
-    job = ThreadedJob('casanova_download', description, gui_casanova_download, (gui, url, filename, save_loc, id), {}, callback, max_concurrent_count=2, killable=False)
+    job = ThreadedJob('casanova_download', description, gui_casanova_download, (gui, url, filename, save_loc, id), {}, callback, max_concurrent_count=downloads.job_limit(), killable=True)
     job_manager.run_threaded_job(job)
 
 
@@ -100,29 +108,24 @@ class CasanovaDownloadManager(object):
         self.base_url = prefs['base_url']
 
     def download_ebook(self, book_id, di=None):
-        # Get the current metadata for this book from the db
-        mi = self.db.get_metadata(book_id, index_is_id=True,
-                get_cover=True, cover_as_data=True)
-        
         # get save directory & filename
         try:
-            path_to_book = self.gui.library_view.model().db.abspath(mi.id, True)
-            book_file_name = self.gui.library_view.model().db.construct_file_name(mi.id)
+            path_to_book = self.gui.library_view.model().db.abspath(book_id, True)
+            book_file_name = self.gui.library_view.model().db.construct_file_name(book_id)
         except  Exception as e:
             print('Failed to get path and filename from book metadata')
             raise e
         
         if not di:        
-            try:
-                # @todo: fix this line to get the base id part
-                casanova_id = mi.identifiers['casanova']
-            except AttributeError:
-                print('There is no aaaarg attribute for this book')                
+            casanova_id = get_casanova_identifier(self.db, book_id)
+            if not casanova_id:
+                print('There is no Casanova identifier for this book')
+                return
             # download detail from site
-            di = self.get_first_download_info(casanova_id)
+            di = self.get_first_download_info(casanova_id.partition('.')[0])
         if di:
             book_file_name = book_file_name + di['type']
-            start_casanova_download(Dispatcher(self.downloaded_ebook), self.gui.job_manager, self.gui, di['href'], book_file_name, path_to_book, mi.id)
+            start_casanova_download(Dispatcher(self.downloaded_ebook), self.gui.job_manager, self.gui, di['href'], book_file_name, path_to_book, book_id)
             self.gui.status_bar.show_message(_('Downloading') + ' ' + book_file_name.decode('utf-8', 'ignore') if book_file_name else url.decode('utf-8', 'ignore'), 3000)
 
 
@@ -133,8 +136,8 @@ class CasanovaDownloadManager(object):
 
         self.gui.status_bar.show_message(job.description + ' ' + _('finished'), 5000)
 
-    def get_download_info(self, id):
-        return self.mm.get_remote_formats(id)
+    def get_download_info(self, id, abort=None):
+        return self.mm.get_remote_formats(id, abort=abort)
 
     def get_first_download_info(self, id, timeout=60):
         ''' Retrieves information about where the actual file is located to download '''
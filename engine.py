@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import traceback
+from collections import deque
+from threading import Condition, Event, Lock, Thread, current_thread
+
+from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.client import Cancelled
+from calibre_plugins.casanova_plugin.scheduler import NORMAL, PRIORITY_NAMES
+
+
+class Future(object):
+    ''' The result of a call that has been queued but perhaps not yet run '''
+
+    def __init__(self):
+        self._done = Event()
+        self._lock = Lock()
+        self._callbacks = []
+        self._result = None
+        self._error = None
+        # Set by cancel(); calls made with submit_abortable() are passed it as abort
+        self.aborted = Event()
+
+    def cancel(self):
+        ''' Asks the call to stop. A call that has not started yet never runs. '''
+        self.aborted.set()
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, error):
+        self._error = error
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        '''
+        Calls callback(future) once the call has finished, from the thread
+        that finished it (wrap it in a Dispatcher to run it in the GUI thread)
+        '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self):
+        return self._error
+
+    def result(self, timeout=None):
+        ''' Waits for the call to finish, returning its result or raising its error '''
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for a Casanova command')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def run_call(future, func, args, kwargs):
+    ''' Runs a queued call, unless it was cancelled first, and settles its Future '''
+    if future.aborted.is_set():
+        future.set_exception(Cancelled('Cancelled before it started'))
+        return
+    try:
+        result = func(*args, **kwargs)
+    except Cancelled as e:
+        future.set_exception(e)
+    except Exception as e:
+        traceback.print_exc()
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+class NetworkEngine(object):
+    '''
+    Runs the plugin's network calls off the GUI thread. Calls are queued
+    and run by a fixed number of worker threads, so any number of queued
+    requests costs a queue entry each rather than a thread. Results come
+    back as Futures.
+
+    Each call has a priority class (see scheduler.py). Workers take the
+    most urgent queued call whose class is below its priority_limits
+    pref, so bulk calls never occupy the workers an interactive one needs.
+    '''
+
+    def __init__(self, workers=None, name='CasanovaNetwork'):
+        self.workers = workers
+        self.name = name
+        self._cond = Condition(Lock())
+        self._queues = [deque() for name in PRIORITY_NAMES]
+        self._running = [0] * len(PRIORITY_NAMES)
+        self._threads = []
+        self._stopping = False
+
+    def _start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            count = self.workers or sum(prefs['priority_limits'].itervalues())
+            for i in xrange(count):
+                t = Thread(target=self._run, name='%s%d' % (self.name, i))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def _next(self):
+        ''' The most urgent call that may run now, or None. Call with the lock held. '''
+        limits = prefs['priority_limits']
+        for priority, queue in enumerate(self._queues):
+            if queue and self._running[priority] < limits[PRIORITY_NAMES[priority]]:
+                self._running[priority] += 1
+                return priority, queue.popleft()
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    item = self._next()
+                    if item is not None:
+                        break
+                    self._cond.wait()
+            priority, (future, func, args, kwargs) = item
+            try:
+                self._call(future, func, args, kwargs)
+            finally:
+                with self._cond:
+                    self._running[priority] -= 1
+                    self._cond.notify_all()
+
+    def _call(self, future, func, args, kwargs):
+        run_call(future, func, args, kwargs)
+
+    def _put(self, priority, future, func, args, kwargs):
+        self._start()
+        with self._cond:
+            self._queues[priority].append((future, func, args, kwargs))
+            self._cond.notify_all()
+        return future
+
+    def submit(self, func, *args, **kwargs):
+        ''' Queues func(*args, **kwargs) as a NORMAL call and returns the Future of its result '''
+        return self._put(NORMAL, Future(), func, args, kwargs)
+
+    def submit_at(self, priority, func, *args, **kwargs):
+        ''' Like submit(), for a call of the given priority class '''
+        return self._put(priority, Future(), func, args, kwargs)
+
+    def submit_abortable(self, priority, func, *args, **kwargs):
+        ''' Like submit_at(), passing the Future's aborted event to func as abort '''
+        future = Future()
+        kwargs['abort'] = future.aborted
+        return self._put(priority, future, func, args, kwargs)
+
+    def when_all(self, futures, callback):
+        ''' Calls callback(futures) once every one of futures has finished '''
+        futures = list(futures)
+        remaining = [len(futures)]
+        lock = Lock()
+
+        def one_done(future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                callback(futures)
+
+        if not futures:
+            callback(futures)
+        for future in futures:
+            future.add_done_callback(one_done)
+
+    def shutdown(self):
+        with self._cond:
+            self._stopping = True
+            self._threads = []
+            self._cond.notify_all()
+
+
+class WorkerPool(object):
+    '''
+    A plain pool of threads, for work with a limit of its own rather than
+    a priority class: the chunks of uploads that already hold a transfer
+    slot, or covers to shrink. Threads are started as work comes in, up
+    to workers() of them, and wait for more work once started.
+    '''
+
+    def __init__(self, workers, name):
+        self.workers = workers
+        self.name = name
+        self._cond = Condition(Lock())
+        self._queue = deque()
+        self._threads = []
+        self._idle = 0
+        self._stopping = False
+
+    def submit(self, func, *args, **kwargs):
+        ''' Queues func(*args, **kwargs) and returns the Future of its result '''
+        future = Future()
+        with self._cond:
+            self._stopping = False
+            self._queue.append((future, func, args, kwargs))
+            if len(self._queue) > self._idle and len(self._threads) < max(1, self.workers()):
+                t = Thread(target=self._run, name='%s%d' % (self.name, len(self._threads)))
+                t.daemon = True
+                self._threads.append(t)
+                t.start()
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                self._idle -= 1
+                if self._stopping:
+                    self._threads.remove(current_thread())
+                    return
+                future, func, args, kwargs = self._queue.popleft()
+            run_call(future, func, args, kwargs)
+
+    def shutdown(self):
+        ''' Stops the threads; work still queued is cancelled '''
+        with self._cond:
+            self._stopping = True
+            queued, self._queue = self._queue, deque()
+            self._cond.notify_all()
+        for future, func, args, kwargs in queued:
+            future.set_exception(Cancelled('Shut down before it started'))
+
+
+# The engine shared by all the plugin's network calls
+engine = NetworkEngine()
@@ -0,0 +1,757 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import re
+import sys
+import json
+import time
+import traceback
+from array import array
+from base64 import b64encode, b64decode
+from bisect import bisect_left
+from itertools import izip
+from operator import itemgetter
+from threading import Event, Lock, RLock, Thread
+
+from calibre.utils.config import config_dir
+from calibre.utils.date import parse_date
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.casanova_plugin.utils import get_library_uuid
+
+# Bump this whenever the layout of the saved snapshot changes
+SNAPSHOT_VERSION = 4
+
+ISSUE_COLUMN = '#issue'
+ISSUE_RE = re.compile(r'(.*)\((\d+)\)')
+
+# Book ids, casanova ids and revisions are stored as C ints
+TYPECODE = 'i'
+MAX_ID = 0x7fffffff
+
+# Changes to more books than this at once rebuild the arrays in one pass
+# instead of editing them a book at a time
+BULK_CHANGE = 32
+
+
+def parse_int(value):
+    ''' Parses a non-negative id that round trips exactly through a C int, else None '''
+    try:
+        n = int(value)
+    except (TypeError, ValueError):
+        return None
+    if n < 0 or n > MAX_ID or unicode(n) != value:
+        return None
+    return n
+
+
+def split_casanova_id(value):
+    '''
+    Splits a raw casanova identifier ("<id>.<revision>") into its parts.
+    Returns None if the value is not a well formed casanova identifier.
+    '''
+    if not value:
+        return None
+    res = unicode(value).split('.')
+    if len(res) != 2:
+        return None
+    return res[0], res[1]
+
+
+def parse_casanova_id(value):
+    ''' Returns (id, revision) as ints for numeric casanova identifiers, else None '''
+    parts = split_casanova_id(value)
+    if parts is None:
+        return None
+    cid, rev = parse_int(parts[0]), parse_int(parts[1])
+    if cid is None or rev is None:
+        return None
+    return cid, rev
+
+
+class LibraryIndex(object):
+    '''
+    Base class for the plugin's indexes over one library. Subclasses are
+    told about changes made outside of this plugin by overriding
+    _library_event.
+    '''
+
+    listening = False
+    # Bumped on every change, so callers can tell when derived data is stale
+    generation = 0
+
+    def add_listener(self):
+        '''
+        Keeps the index current when books are changed outside of this plugin.
+        Only newer calibre versions expose database listeners, older ones rely
+        on the plugin updating the index itself.
+        '''
+        api = getattr(self.db, 'new_api', None)
+        if api is None or not hasattr(api, 'add_listener'):
+            return False
+        try:
+            from calibre.db.listeners import EventType
+        except ImportError:
+            return False
+        self._event_type = EventType
+        api.add_listener(self._library_event)
+        self.listening = True
+        return True
+
+    def remove_listener(self):
+        api = getattr(self.db, 'new_api', None)
+        if self.listening and hasattr(api, 'remove_listener'):
+            try:
+                api.remove_listener(self._library_event)
+            except Exception:
+                pass
+        self.listening = False
+
+    def _query(self, sql, bindings=()):
+        '''
+        Runs a read-only query. The indexes are built and updated outside the
+        GUI thread, so calibre's read lock is held (where the database has
+        one) to keep the query from racing its writes.
+        '''
+        lock = getattr(getattr(self.db, 'new_api', None), 'read_lock', None)
+        if lock is None:
+            return self.db.conn.get(sql, bindings, all=True) or []
+        with lock:
+            return self.db.conn.get(sql, bindings, all=True) or []
+
+    def _library_event(self, event_type, library_id, event_data):
+        ''' Called by calibre, in its listener thread, for every change to the library '''
+        pass
+
+
+class CasanovaBookIndex(LibraryIndex):
+    '''
+    Maps base Casanova ids to calibre book ids. It is built from the
+    identifiers table in one query and then kept up to date as books are
+    added, removed or re-identified. It behaves like the old book_map dict
+    for ``in``, ``[]`` and ``get``.
+
+    Identifiers of the usual numeric "<id>.<revision>" form are kept in
+    sorted typed arrays and looked up by bisection, which costs about 24
+    bytes a book instead of several hundred for dicts of strings. Anything
+    else falls back to small dicts. When several books share a casanova id
+    the highest book id is the one it maps to. The index is changed by the
+    database listener's thread, so every access holds its lock.
+    '''
+
+    def __init__(self, db, build=True):
+        self.db = db
+        self.lock = RLock()
+        self._clear()
+        if build:
+            self.refresh()
+
+    def _clear(self):
+        self.generation += 1
+        # casanova id -> book id and the number of books with the id, sorted by casanova id
+        self._cids = array(TYPECODE)
+        self._cid_books = array(TYPECODE)
+        self._cid_counts = array(TYPECODE)
+        # book id -> casanova id and revision, sorted by book id
+        self._books = array(TYPECODE)
+        self._book_cids = array(TYPECODE)
+        self._book_revs = array(TYPECODE)
+        # identifiers that are not numeric
+        self._other_books = {}
+        self._other_identifiers = {}
+
+    def refresh(self):
+        ''' Rebuilds the whole index with a single read of the identifiers table '''
+        with self.lock:
+            self._clear()
+            self._rebuild((), self._read_identifiers())
+
+    def refresh_books(self, book_ids):
+        ''' Re-reads the casanova identifier of just these books '''
+        book_ids = set(book_ids)
+        if not book_ids:
+            return
+        with self.lock:
+            self._update(book_ids, self._read_identifiers(book_ids))
+
+    def reconcile(self, since):
+        '''
+        Brings a restored index up to date by re-reading only the books
+        modified after ``since`` and dropping books that no longer exist.
+        '''
+        result = self._query('SELECT id FROM books')
+        existing = set(r[0] for r in result)
+        self.remove_books([book_id for book_id in self.book_ids()
+                           if book_id not in existing])
+        result = self._query('SELECT id FROM books WHERE last_modified > ?', (since,))
+        self.refresh_books(r[0] for r in result)
+
+    def snapshot(self):
+        with self.lock:
+            return {'itemsize': self._cids.itemsize,
+                    'cids': b64encode(self._cids.tostring()),
+                    'cid_books': b64encode(self._cid_books.tostring()),
+                    'cid_counts': b64encode(self._cid_counts.tostring()),
+                    'books': b64encode(self._books.tostring()),
+                    'book_cids': b64encode(self._book_cids.tostring()),
+                    'book_revs': b64encode(self._book_revs.tostring()),
+                    'other': [[book_id, val] for book_id, val in self._other_identifiers.iteritems()]}
+
+    def restore(self, snapshot):
+        ''' Restores a snapshot, returning False if it was saved on an incompatible platform '''
+        with self.lock:
+            self._clear()
+            if snapshot.get('itemsize') != self._cids.itemsize:
+                return False
+            for name in ('cids', 'cid_books', 'cid_counts', 'books', 'book_cids', 'book_revs'):
+                getattr(self, '_' + name).fromstring(b64decode(snapshot[name]))
+            for book_id, val in snapshot['other']:
+                self._set(book_id, val)
+            return True
+
+    def set_identifier(self, book_id, val):
+        ''' Records a new (or changed) casanova identifier for a book. None unlinks it '''
+        with self.lock:
+            self._discard(book_id)
+            if val:
+                self._set(book_id, val)
+
+    def remove_books(self, book_ids):
+        book_ids = set(book_ids)
+        if book_ids:
+            with self.lock:
+                self._update(book_ids, ())
+
+    def memory_footprint(self):
+        ''' Approximate number of bytes used by the index '''
+        with self.lock:
+            size = sum(len(a) * a.itemsize for a in (self._cids, self._cid_books, self._cid_counts,
+                                                     self._books, self._book_cids, self._book_revs))
+            size += sys.getsizeof(self._other_books) + sys.getsizeof(self._other_identifiers)
+            for book_id, val in self._other_identifiers.iteritems():
+                size += sys.getsizeof(val) + sys.getsizeof(split_casanova_id(val)[0])
+            return size
+
+    def _read_identifiers(self, book_ids=None):
+        sql = 'SELECT book, val FROM identifiers WHERE type=?'
+        if book_ids is not None:
+            sql += ' AND book IN ({0})'.format(','.join(unicode(int(x)) for x in book_ids))
+        return self._query(sql, ('casanova',))
+
+    def _update(self, book_ids, rows):
+        ''' Replaces the identifiers of book_ids with rows of (book id, identifier) '''
+        if len(book_ids) > BULK_CHANGE:
+            return self._rebuild(book_ids, rows)
+        for book_id in book_ids:
+            self._discard(book_id)
+        for book_id, val in rows:
+            self._set(book_id, val)
+
+    def _rebuild(self, book_ids, rows):
+        '''
+        Like _update, but makes new arrays from every remaining entry and the
+        new ones, sorting once, rather than inserting and deleting a book at a
+        time, which moves the rest of the arrays for each book.
+        '''
+        self.generation += 1
+        for book_id in book_ids:
+            self._discard_other(book_id)
+        entries = [entry for entry in izip(self._books, self._book_cids, self._book_revs)
+                   if entry[0] not in book_ids]
+        for book_id, val in rows:
+            parsed = parse_casanova_id(val)
+            if parsed is None:
+                self._set(book_id, val)
+            else:
+                entries.append((book_id, parsed[0], parsed[1]))
+        entries.sort()
+        books, book_cids, book_revs = array(TYPECODE), array(TYPECODE), array(TYPECODE)
+        for book_id, cid, rev in entries:
+            books.append(book_id)
+            book_cids.append(cid)
+            book_revs.append(rev)
+        # Sorting on (cid, book id) makes the highest book id win for duplicates
+        entries.sort(key=itemgetter(1, 0))
+        cids, cid_books, cid_counts = array(TYPECODE), array(TYPECODE), array(TYPECODE)
+        for book_id, cid, rev in entries:
+            if cids and cids[-1] == cid:
+                cid_books[-1] = book_id
+                cid_counts[-1] += 1
+            else:
+                cids.append(cid)
+                cid_books.append(book_id)
+                cid_counts.append(1)
+        self._books, self._book_cids, self._book_revs = books, book_cids, book_revs
+        self._cids, self._cid_books, self._cid_counts = cids, cid_books, cid_counts
+
+    def _set(self, book_id, val):
+        self.generation += 1
+        parsed = parse_casanova_id(val)
+        if parsed is None:
+            parts = split_casanova_id(val)
+            if parts is not None:
+                self._other_books[parts[0]] = max(book_id, self._other_books.get(parts[0], book_id))
+                self._other_identifiers[book_id] = unicode(val)
+            return
+        cid, rev = parsed
+        pos = bisect_left(self._books, book_id)
+        self._books.insert(pos, book_id)
+        self._book_cids.insert(pos, cid)
+        self._book_revs.insert(pos, rev)
+        pos = bisect_left(self._cids, cid)
+        if pos < len(self._cids) and self._cids[pos] == cid:
+            self._cid_books[pos] = max(book_id, self._cid_books[pos])
+            self._cid_counts[pos] += 1
+        else:
+            self._cids.insert(pos, cid)
+            self._cid_books.insert(pos, book_id)
+            self._cid_counts.insert(pos, 1)
+
+    def _discard_other(self, book_id):
+        val = self._other_identifiers.pop(book_id, None)
+        if val is None:
+            return False
+        cid = split_casanova_id(val)[0]
+        if self._other_books.get(cid) == book_id:
+            # Another book with the same id takes over, if there is one
+            holders = [b for b, v in self._other_identifiers.iteritems()
+                       if split_casanova_id(v)[0] == cid]
+            if holders:
+                self._other_books[cid] = max(holders)
+            else:
+                del self._other_books[cid]
+        return True
+
+    def _discard(self, book_id):
+        self.generation += 1
+        if self._discard_other(book_id):
+            return
+        pos = self._book_pos(book_id)
+        if pos is None:
+            return
+        cid = self._book_cids[pos]
+        del self._books[pos]
+        del self._book_cids[pos]
+        del self._book_revs[pos]
+        pos = self._cid_pos(cid)
+        if pos is None:
+            return
+        self._cid_counts[pos] -= 1
+        if self._cid_counts[pos] <= 0:
+            del self._cids[pos]
+            del self._cid_books[pos]
+            del self._cid_counts[pos]
+        elif self._cid_books[pos] == book_id:
+            # Another book with the same id takes over
+            self._cid_books[pos] = max(b for b, c in izip(self._books, self._book_cids) if c == cid)
+
+    def _book_pos(self, book_id):
+        pos = bisect_left(self._books, book_id)
+        if pos < len(self._books) and self._books[pos] == book_id:
+            return pos
+
+    def _cid_pos(self, cid):
+        pos = bisect_left(self._cids, cid)
+        if pos < len(self._cids) and self._cids[pos] == cid:
+            return pos
+
+    def __contains__(self, casanova_id):
+        return self.get(casanova_id) is not None
+
+    def __getitem__(self, casanova_id):
+        book_id = self.get(casanova_id)
+        if book_id is None:
+            raise KeyError(casanova_id)
+        return book_id
+
+    def __len__(self):
+        with self.lock:
+            return len(self._cids) + len(self._other_books)
+
+    def get(self, casanova_id, default=None):
+        cid = parse_int(casanova_id)
+        with self.lock:
+            if cid is None:
+                return self._other_books.get(casanova_id, default)
+            pos = self._cid_pos(cid)
+            if pos is None:
+                return default
+            return self._cid_books[pos]
+
+    def book_ids(self):
+        ''' All books that have a casanova identifier '''
+        with self.lock:
+            return list(self._books) + list(self._other_identifiers)
+
+    def identifier(self, book_id):
+        ''' The full casanova identifier ("<id>.<revision>") of a book, or None '''
+        with self.lock:
+            pos = self._book_pos(book_id)
+            if pos is None:
+                return self._other_identifiers.get(book_id)
+            return '%d.%d' % (self._book_cids[pos], self._book_revs[pos])
+
+    def casanova_id(self, book_id):
+        ''' The base casanova id of a book, or None '''
+        with self.lock:
+            pos = self._book_pos(book_id)
+            if pos is None:
+                parts = split_casanova_id(self._other_identifiers.get(book_id))
+                if parts is not None:
+                    return parts[0]
+                return None
+            return unicode(self._book_cids[pos])
+
+    def identifiers(self):
+        ''' All full casanova identifiers in the library '''
+        with self.lock:
+            ids = ['%d.%d' % x for x in izip(self._book_cids, self._book_revs)]
+            ids.extend(self._other_identifiers.itervalues())
+            return ids
+
+    def _library_event(self, event_type, library_id, event_data):
+        et = self._event_type
+        if event_type == et.book_created:
+            self.refresh_books([event_data[0]])
+        elif event_type == et.books_removed:
+            self.remove_books(event_data[0])
+        elif event_type == et.metadata_changed and event_data[0] == 'identifiers':
+            self.refresh_books(event_data[1])
+
+
+class CasanovaIssueIndex(LibraryIndex):
+    '''
+    Names, tag ids and member books of every issue in the #issue column.
+    Issue values look like "Issue name (1234)" where 1234 is the Casanova
+    issue id. Everything is loaded with a single join of the column's
+    table and its link table, and re-read per book when #issue changes.
+    It behaves like the old issue_map dict of issue id to tag id.
+    '''
+
+    def __init__(self, db, build=True):
+        self.db = db
+        self.lock = RLock()
+        self._clear()
+        if build:
+            self.refresh()
+
+    def _clear(self):
+        self.generation += 1
+        self._names = {}
+        self._keys = {}
+        self._members = {}
+        self._book_issues = {}
+
+    def _tables(self):
+        try:
+            fm = self.db.field_metadata[ISSUE_COLUMN]
+        except KeyError:
+            return None
+        return fm['table'], 'books_{0}_link'.format(fm['table']), fm['link_column']
+
+    def refresh(self):
+        ''' Rebuilds the whole index with one query '''
+        with self.lock:
+            self._clear()
+            tables = self._tables()
+            if tables is None:
+                return
+            result = self._query(
+                'SELECT t.id, t.value, l.book FROM {0} AS t LEFT JOIN {1} AS l ON l.{2}=t.id'.format(*tables))
+            for key, value, book_id in result:
+                self._add(key, value, book_id)
+
+    def refresh_books(self, book_ids):
+        ''' Re-reads the issues of just these books '''
+        book_ids = set(book_ids)
+        tables = self._tables()
+        if not book_ids or tables is None:
+            return
+        with self.lock:
+            self.remove_books(book_ids)
+            result = self._query(
+                'SELECT t.id, t.value, l.book FROM {1} AS l JOIN {0} AS t ON l.{2}=t.id '
+                'WHERE l.book IN ({3})'.format(tables[0], tables[1], tables[2],
+                                               ','.join(unicode(int(x)) for x in book_ids)))
+            for key, value, book_id in result:
+                self._add(key, value, book_id)
+
+    def remove_books(self, book_ids):
+        with self.lock:
+            self.generation += 1
+            for book_id in book_ids:
+                for issue_id in self._book_issues.pop(book_id, ()):
+                    self._members[issue_id].discard(book_id)
+
+    def _add(self, key, value, book_id):
+        self.generation += 1
+        m = ISSUE_RE.match(value or '')
+        if not m:
+            return
+        issue_id = m.group(2)
+        self._names[issue_id] = m.group(1)
+        self._keys[issue_id] = key
+        members = self._members.setdefault(issue_id, set())
+        if book_id is not None:
+            members.add(book_id)
+            self._book_issues.setdefault(book_id, set()).add(issue_id)
+
+    def snapshot(self):
+        with self.lock:
+            return [[issue_id, self._keys[issue_id], self._names[issue_id], list(members)]
+                    for issue_id, members in self._members.iteritems()]
+
+    def restore(self, snapshot):
+        with self.lock:
+            self._clear()
+            for issue_id, key, name, members in snapshot:
+                self._names[issue_id] = name
+                self._keys[issue_id] = key
+                self._members[issue_id] = set(members)
+                for book_id in members:
+                    self._book_issues.setdefault(book_id, set()).add(issue_id)
+            return True
+
+    def __contains__(self, issue_id):
+        return issue_id in self._keys
+
+    def __getitem__(self, issue_id):
+        return self._keys[issue_id]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, issue_id, default=None):
+        return self._keys.get(issue_id, default)
+
+    def issues(self):
+        ''' A dict of issue id to issue name for every issue in the library '''
+        with self.lock:
+            return dict(self._names)
+
+    def book_ids(self, issue_id):
+        ''' The ids of the books in an issue '''
+        with self.lock:
+            return set(self._members.get(issue_id, ()))
+
+    def _library_event(self, event_type, library_id, event_data):
+        et = self._event_type
+        if event_type == et.books_removed:
+            self.remove_books(event_data[0])
+        elif event_type == et.metadata_changed and event_data[0] == ISSUE_COLUMN:
+            self.refresh_books(event_data[1])
+        elif event_type in (et.items_renamed, et.items_removed) and event_data[0] == ISSUE_COLUMN:
+            self.refresh()
+
+
+def library_marker(db):
+    ''' The last modified time of the library database, used to validate snapshots '''
+    try:
+        return db.last_modified()
+    except Exception:
+        return None
+
+
+def snapshot_path(library_uuid):
+    return os.path.join(config_dir, 'plugins', 'casanova_indexes', library_uuid + '.json')
+
+
+def load_snapshot(db):
+    '''
+    Returns the saved snapshot of the plugin's indexes for this library, or
+    None if there is no usable one. The caller compares snapshot['marker']
+    with library_marker(db) to decide whether anything needs reconciling.
+    '''
+    library_uuid = get_library_uuid(db)
+    if not library_uuid:
+        return None
+    try:
+        with open(snapshot_path(library_uuid), 'rb') as f:
+            snapshot = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION or \
+            snapshot.get('library_uuid') != library_uuid:
+        return None
+    return snapshot
+
+
+def save_snapshot(db, marker, book_map, issue_map):
+    '''
+    Saves the indexes for this library. ``marker`` is the library_marker()
+    from when the indexes were last known to match the library.
+    '''
+    library_uuid = get_library_uuid(db)
+    if not library_uuid or marker is None:
+        return False
+    path = snapshot_path(library_uuid)
+    snapshot = {'version': SNAPSHOT_VERSION,
+                'library_uuid': library_uuid,
+                'marker': marker.isoformat(),
+                'books': book_map.snapshot(),
+                'issues': issue_map.snapshot()}
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(snapshot, f)
+        atomic_rename(path + '.tmp', path)
+    except (IOError, OSError) as e:
+        print('Failed to save the Casanova index snapshot:', e)
+        return False
+    return True
+
+
+class LibraryIndexes(object):
+    '''
+    The book and issue indexes of one library. They are restored from the
+    warm-start snapshot (or built from scratch) by load(), which can run
+    in a background thread; wait() blocks until they are usable. If the
+    background load fails, the error is kept and the indexes are built
+    again, synchronously, by the next wait().
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self.book_map = None
+        self.issue_map = None
+        self.indexed_at = None
+        self.error = None
+        self.ready = Event()
+        self._recover_lock = Lock()
+
+    def start(self, callback=None):
+        ''' Loads the indexes in a background thread, calling callback() when they are ready '''
+        def run():
+            try:
+                self.load()
+            finally:
+                if callback is not None:
+                    callback()
+        t = Thread(target=run, name='CasanovaIndexLoader')
+        t.daemon = True
+        t.start()
+
+    def wait(self):
+        self.ready.wait()
+        if self.error is not None:
+            self.recover()
+        return self
+
+    def load(self):
+        start = time.time()
+        try:
+            if not self.load_snapshot():
+                self.refresh_book_map()
+                self.refresh_issue_map()
+        except Exception:
+            self.error = traceback.format_exc()
+            print('Failed to load the Casanova indexes:\n' + self.error)
+        finally:
+            self.ready.set()
+        print('Casanova indexes ready in %.1f ms' % ((time.time() - start) * 1000))
+
+    def recover(self):
+        ''' Builds the indexes from scratch after a failed load '''
+        with self._recover_lock:
+            if self.error is None:
+                return
+            self.refresh_book_map()
+            self.refresh_issue_map()
+            self.error = None
+
+    def load_snapshot(self):
+        ''' Restores the indexes saved by an earlier session, reconciling anything changed since '''
+        snapshot = load_snapshot(self.db)
+        if snapshot is None:
+            return False
+        marker = library_marker(self.db)
+        book_map = CasanovaBookIndex(self.db, build=False)
+        if not book_map.restore(snapshot['books']):
+            return False
+        self.book_map = book_map
+        self.book_map.add_listener()
+        self.issue_map = CasanovaIssueIndex(self.db, build=False)
+        self.issue_map.restore(snapshot['issues'])
+        self.issue_map.add_listener()
+        if marker is None or marker.isoformat() != snapshot['marker']:
+            print('Reconciling the Casanova index with library changes')
+            self.book_map.reconcile(parse_date(snapshot['marker'], assume_utc=True))
+            self.issue_map.refresh()
+        self.indexed_at = marker
+        return True
+
+    def catch_up(self):
+        '''
+        Without library listeners the indexes do not see changes made in
+        calibre, such as deleted books or identifiers set by hand. If the
+        library has changed since they were last known to match it, the
+        books modified since then are read again, as for a snapshot.
+        '''
+        self.wait()
+        if self.book_map.listening and self.issue_map.listening:
+            return
+        marker = library_marker(self.db)
+        if marker is not None and marker == self.indexed_at:
+            return
+        if marker is None or self.indexed_at is None:
+            self.book_map.refresh()
+        else:
+            self.book_map.reconcile(self.indexed_at)
+        self.issue_map.refresh()
+        self.indexed_at = marker
+
+    def save_snapshot(self):
+        ''' Saves the indexes so the next session can start warm '''
+        if not self.ready.is_set() or self.book_map is None or self.issue_map is None:
+            return False
+        marker = self.indexed_at
+        if self.book_map.listening and self.issue_map.listening:
+            # The listeners have applied the changes made since the indexes
+            # were loaded, so they match the library as it is now
+            self._flush_events()
+            marker = library_marker(self.db)
+        return save_snapshot(self.db, marker, self.book_map, self.issue_map)
+
+    def _flush_events(self):
+        ''' Waits for calibre to deliver the library events it has queued for the listeners '''
+        dispatcher = getattr(getattr(self.db, 'new_api', None), 'event_dispatcher', None)
+        flush = getattr(dispatcher, 'flush', None)
+        if flush is not None:
+            try:
+                flush()
+            except Exception:
+                pass
+
+    def close(self):
+        ''' Called when this library is no longer the current one '''
+        self.wait()
+        self.save_snapshot()
+        self.book_map.remove_listener()
+        self.issue_map.remove_listener()
+
+    def refresh_book_map(self):
+        ''' Rebuilds the casanova id -> book id index from the identifiers table '''
+        self.indexed_at = library_marker(self.db)
+        if self.book_map is None:
+            self.book_map = CasanovaBookIndex(self.db)
+            self.book_map.add_listener()
+        else:
+            self.book_map.refresh()
+        print('Casanova index holds %d books in %.1f KB' % (
+            len(self.book_map), self.book_map.memory_footprint() / 1024))
+
+    def refresh_issue_map(self):
+        ''' Rebuilds the issue index with one query over the #issue column '''
+        if self.issue_map is None:
+            self.issue_map = CasanovaIssueIndex(self.db)
+            self.issue_map.add_listener()
+        else:
+            self.issue_map.refresh()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# Field level reads from the calibre library. Building a full Metadata
+# object (let alone loading its cover) just to look at one field is an
+# order of magnitude slower than asking the database for that field.
+
+import os
+
+
+def _authors(db, book_id):
+    authors = db.authors(book_id, index_is_id=True)
+    if authors:
+        return tuple(a.strip().replace('|', ',') for a in authors.split(','))
+    return ()
+
+# How to read each field on calibre versions without the new database api
+LEGACY_GETTERS = {
+    'identifiers': lambda db, book_id: db.get_identifiers(book_id, index_is_id=True),
+    'title': lambda db, book_id: db.title(book_id, index_is_id=True),
+    'authors': _authors,
+    'comments': lambda db, book_id: db.comments(book_id, index_is_id=True),
+}
+
+
+def get_field(db, field, book_ids, default_value=None):
+    '''
+    Reads one field for several books at once. Returns a dict mapping each
+    book id to its value.
+    '''
+    api = getattr(db, 'new_api', None)
+    if api is not None:
+        return api.all_field_for(field, book_ids, default_value=default_value)
+    getter = LEGACY_GETTERS[field]
+    ret = {}
+    for book_id in book_ids:
+        val = getter(db, book_id)
+        ret[book_id] = default_value if val is None else val
+    return ret
+
+
+def cover_path(db, book_id):
+    '''
+    The path of a book's cover file in the library, or None. Unlike
+    get_metadata(get_cover=True) this does not copy the cover anywhere.
+    '''
+    path = db.abspath(book_id, index_is_id=True, create_dirs=False)
+    if path:
+        path = os.path.join(path, 'cover.jpg')
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def get_identifiers(db, book_ids):
+    ''' A dict of book id to that book's identifiers dict '''
+    return get_field(db, 'identifiers', book_ids, default_value={})
+
+
+def get_casanova_identifier(db, book_id):
+    ''' The full casanova identifier ("<id>.<revision>") of one book, or None '''
+    return get_identifiers(db, (book_id,))[book_id].get('casanova')
+
+
+def get_casanova_identifiers(db, book_ids):
+    ''' A dict of book id to casanova identifier, for the books that have one '''
+    ret = {}
+    for book_id, identifiers in get_identifiers(db, book_ids).iteritems():
+        if identifiers.get('casanova'):
+            ret[book_id] = identifiers['casanova']
+    return ret
@@ -7,38 +7,51 @@ __copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
 import os
-import re
-from contextlib import closing
 from time import time
+from threading import Condition, Event, Lock, current_thread
+from collections import deque
 import json
-import mechanize
 import mimetypes
-import urllib
-import urllib2
 import StringIO
-from base64 import b64encode
 
-from PyQt4.Qt import QModelIndex
-
-from calibre import browser, get_download_filename, url_slash_cleaner
-from calibre.ebooks import BOOK_EXTENSIONS
-from calibre.utils.filenames import ascii_filename
 from calibre.utils.zipfile import ZipFile
 from calibre.ebooks.metadata.opf2 import OPF, metadata_to_opf
+from calibre.gui2 import Dispatcher
+from calibre.gui2.threaded_jobs import ThreadedJob
 
 from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.client import client, SingleFlight, HTTPError, Cancelled
+from calibre_plugins.casanova_plugin.batch import Batcher
+from calibre_plugins.casanova_plugin.covers import covers
+from calibre_plugins.casanova_plugin.content import (content_hash, known_content, synced_covers,
+                                                     record_synced_covers)
+from calibre_plugins.casanova_plugin.progress import JobProgress
+from calibre_plugins.casanova_plugin.library import get_casanova_identifier, get_casanova_identifiers, cover_path
 
 
 class CasanovaMetadataManager(object):
 
-	def __init__(self, gui):
+	def __init__(self, gui, indexes):
 		print('New Casanova metadata manager created')
 		self.gui = gui
 		self.db = gui.current_db
 		self.model = self.gui.library_view.model()
 		self.base_url = prefs['base_url']
-		self.refresh_book_map()
-		self.refresh_issue_map()
+		self.indexes = indexes
+		# Identical lookups made at the same time share one request and one parsed result
+		self.flights = SingleFlight()
+		# Books changed by updates applied in a job, for the GUI thread to redisplay
+		self.refresh_ids = set()
+		self.refresh_lock = Lock()
+		self.queue_refresh = Dispatcher(self.refresh_gui)
+		# Jobs change the library through in_gui_thread
+		self.gui_thread = current_thread()
+		self.calls = deque()
+		self.calls_cond = Condition(Lock())
+		self.dispatch_call = Dispatcher(self.run_queued_calls)
+		# The abort events of the apply jobs running, and whether the library was closed
+		self.applies = set()
+		self.closed = False
 
 		#self.get_all_issues(True)		
 		#self.get_local_books_in_issue('17492')
@@ -47,15 +60,93 @@ class CasanovaMetadataManager(object):
 	def commit(self, book_id):
 		''' Commits any local changes to the metadata for this book up to the Casanova server '''
     # get the opf that will be posted
-		mi = self.db.get_metadata(book_id, index_is_id=True, get_cover=True)
+		mi = self.db.get_metadata(book_id, index_is_id=True)
 		opf = metadata_to_opf(mi)
 		# get the remote id
 		try:
 			casanova_id = mi.identifiers['casanova']
 		except AttributeError:
 			print('There is no Casanova identifier for this book')
-		# now post the metadata
-		return self._post_metadata(casanova_id, opf, mi.cover)
+		# now post the metadata, with the cover only if it changed since it was last synced
+		cover = self._changed_cover(cover_path(self.db, book_id), casanova_id, synced_covers())
+		the_page = self._post_metadata(casanova_id, opf, covers.prepare(cover))
+		if cover:
+			record_synced_covers({casanova_id.partition('.')[0]: content_hash(cover)})
+		return the_page
+
+	def prepare_commit(self, book_ids):
+		'''
+		What commit_many sends for these books: (casanova id, opf, cover path
+		or None) for each one linked to Casanova. This reads the library, so
+		it runs in the GUI thread, leaving commit_many to the network.
+		'''
+		entries = []
+		for book_id in book_ids:
+			mi = self.db.get_metadata(book_id, index_is_id=True)
+			casanova_id = mi.identifiers.get('casanova')
+			if casanova_id:
+				entries.append((casanova_id, metadata_to_opf(mi), cover_path(self.db, book_id)))
+		return entries
+
+	def commit_many(self, entries, abort=None):
+		'''
+		Commits the local metadata of several books, given by prepare_commit,
+		sending the commands in batches. Covers go along only when they
+		changed since last synced, after going through the cover pipeline.
+		'''
+		futures = []
+		covered = []
+		synced = synced_covers()
+		with Batcher(client) as batcher:
+			for casanova_id, opf, path in entries:
+				if abort is not None and abort.is_set():
+					raise Cancelled('Cancelled uploading metadata')
+				cover = self._changed_cover(path, casanova_id, synced)
+				if cover:
+					covered.append((casanova_id, opf, cover))
+				else:
+					values = self._metadata_values(casanova_id, opf)
+					futures.append((casanova_id, values, None, batcher.submit(values)))
+			prepared = covers.prepare_many([cover for casanova_id, opf, cover in covered])
+			covered = [(casanova_id, self._metadata_values(casanova_id, opf, prepared[cover]), cover)
+			           for casanova_id, opf, cover in covered]
+			# Covers the server already holds are sent as their hash; the
+			# rest are streamed as files, which a batch can not carry
+			known = known_content([values['cover_hash'] for casanova_id, values, cover in covered], abort)
+			for casanova_id, values, cover in covered:
+				if values['cover_hash'] in known:
+					futures.append((casanova_id, values, cover, batcher.submit(values)))
+			covered = [c for c in covered if c[1]['cover_hash'] not in known]
+		messages = []
+		# Hashes of the library's covers, not of what was sent, as that is what _changed_cover compares
+		sent_covers = {}
+		for casanova_id, values, cover, future in futures:
+			try:
+				messages.append(future.result().read())
+			except HTTPError as e:
+				messages.append(e.body or unicode(e))
+				continue
+			if cover:
+				sent_covers[casanova_id.partition('.')[0]] = content_hash(cover)
+		try:
+			for casanova_id, values, cover in covered:
+				if abort is not None and abort.is_set():
+					raise Cancelled('Cancelled uploading metadata')
+				try:
+					messages.append(self._post_metadata(casanova_id, values['opf'], prepared[cover], abort, known))
+				except HTTPError as e:
+					messages.append(e.body or unicode(e))
+					continue
+				sent_covers[casanova_id.partition('.')[0]] = content_hash(cover)
+		finally:
+			record_synced_covers(sent_covers)
+		return messages
+
+	def _changed_cover(self, path, casanova_id, synced):
+		''' The cover file at path, if it differs from the one last synced with the server '''
+		if path is None or synced.get(casanova_id.partition('.')[0]) == content_hash(path):
+			return None
+		return path
     
 
 	def update(self, book_id=False):
@@ -67,21 +158,73 @@ class CasanovaMetadataManager(object):
 			#casanova_issue_ids = self.get_all_issues()
 			# @todo!
 		else:
-			mi = self.db.get_metadata(book_id, index_is_id=True)
-			if mi.has_identifier('casanova'):
-				return self._post_update_request(mi.identifiers['casanova'])
+			casanova_id = get_casanova_identifier(self.db, book_id)
+			if casanova_id:
+				return self._post_update_request(casanova_id)
+
+	def update_many(self, book_ids):
+		'''
+		Asks the server for metadata updates to several books, sending the
+		commands in batches. Returns the combined added/updated counts and
+		any messages the server sent instead of updates.
+		'''
+		return self.apply_updates(self.fetch_updates(get_casanova_identifiers(self.db, book_ids).values()))
+
+	def fetch_updates(self, casanova_ids, abort=None):
+		'''
+		The network half of update_many: the server's answer (or HTTPError)
+		for each of these casanova identifiers
+		'''
+		futures = []
+		with Batcher(client) as batcher:
+			for casanova_id in casanova_ids:
+				futures.append(batcher.submit({'cmd' : 'update_metadata',
+				                               'id' : casanova_id }))
+		results = []
+		for future in futures:
+			try:
+				results.append(future.result())
+			except HTTPError as e:
+				results.append(e)
+		if abort is not None and abort.is_set():
+			raise Cancelled('Cancelled fetching metadata updates')
+		return results
+
+	def apply_updates(self, results, abort=None, progress=None):
+		''' The library half of update_many '''
+		result = {'added':0, 'updated':0, 'messages':[]}
+		for i, response in enumerate(results):
+			if isinstance(response, HTTPError):
+				r = response.body or unicode(response)
+			else:
+				r = self._handle_update_response(response, abort,
+						progress.part(i, len(results)) if progress else None)
+			if isinstance(r, dict):
+				result['added'] += r['added']
+				result['updated'] += r['updated']
+			elif r:
+				result['messages'].append(r)
+		return result
 
 
 	def sync(self, id):
 		''' Syncs an issue, ensuring that any new books in the issue remotely are added locally '''
+		return self.apply_sync(id, self.fetch_sync(id))
+
+	def fetch_sync(self, id, abort=None):
+		''' The network half of sync: asks the server for the changes to an issue '''
 		if id in prefs['last_updates']:
 			# for now, just add things that were added after the date of last update
 			local_books = self.get_local_books_in_issue(id)
-			updates_zip = self._post_sync_request(id, local_books, prefs['last_updates'][id])
+			return self._post_sync_request(id, local_books, prefs['last_updates'][id], abort)
 		else:
 			# use the remote issue as the target - we want to match it by the end of the sync
 			local_books = self.get_local_books_in_issue(id)
-			updates_zip = self._post_sync_request(id, local_books)
+			return self._post_sync_request(id, local_books, abort=abort)
+
+	def apply_sync(self, id, response):
+		''' The library half of sync '''
+		updates_zip = self.apply_zip_response(response)
 
 		# Add new books
 		# If a book is in an issue locally, but not remotely, we have to ignore it, because it might have been removed remotely and we shouldn't re-add
@@ -89,53 +232,85 @@ class CasanovaMetadataManager(object):
 		books_to_create_on_casanova = []
 		books_to_add_to_issue = []
 
+		self.mark_synced(id)
+		return updates_zip
+
+	def mark_synced(self, id):
+		''' Records that an issue has just been synced '''
 		last_updates = prefs['last_updates']
 		last_updates[id] = time()
 		prefs['last_updates'] = last_updates
-		return updates_zip
 
 	def author_sync(self, str):
 		''' Gets all metadata for one or more authors '''
+		return self.apply_zip_response(self.fetch_author(str))
+
+	def fetch_author(self, str, abort=None):
+		''' The network half of author_sync '''
 		values = {'cmd' : 'get_author',
 		          'authors' : str }
-		
-		response = self._post(values)
+		return self._post(values, abort=abort)
+
+	def apply_zip_response(self, response, abort=None, progress=None):
+		''' Merges a zip of opf files sent by the server into the library '''
 		the_zip = response.read()
 		response_type = response.info().getheader('Content-Type')
 		if 'archive/zip' in response_type:
 			io = StringIO.StringIO()
 			io.write(the_zip)
-			return self.handle_zip_of_opf_files(io) #@todo : pick up here
+			return self.handle_zip_of_opf_files(io, abort, progress) #@todo : pick up here
 		else:
 			return 'Something went wrong :('
 
-	def _post(self, values, path='/api/do'):
+	def apply_zip_responses(self, responses, abort=None, progress=None):
+		'''
+		Merges several zips of opf files, returning the combined counts and
+		any messages. results holds what each response gave: its counts, or
+		a message if it was not a zip.
+		'''
+		result = {'added':0, 'updated':0, 'messages':[], 'results':[]}
+		for i, response in enumerate(responses):
+			r = self.apply_zip_response(response, abort,
+					progress.part(i, len(responses)) if progress else None)
+			result['results'].append(r)
+			if isinstance(r, dict):
+				result['added'] += r['added']
+				result['updated'] += r['updated']
+			else:
+				result['messages'].append(r)
+		return result
+
+	def _post(self, values, path='/api/do', timeout=None, abort=None, files=None):
 		''' Posts something to the casanova listener url '''
-		prefs.refresh()
-		self.base_url = prefs['base_url']
-		url = url_slash_cleaner(self.base_url + path)
-		user_agent = 'Casanova/1.0 (compatible; MSIE 5.5; Windows NT)'
-		values['un'] = prefs['username']
-		values['pw'] = prefs['password']
-		headers = { 'User-Agent' : user_agent, 'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8' }
-		data = urllib.urlencode(values)
-		req = urllib2.Request(url, data, headers)
-		response = urllib2.urlopen(req)
-		return response
-
-
-	def _post_metadata(self, id, opf, cover=None):
-		''' Posts updated metadata to Casanova server '''
+		return client.post(values, path, timeout, abort, files=files)
+
+
+	def _metadata_values(self, id, opf, cover=None):
+		''' The commit_metadata command for a book '''
 		values = {'cmd' : 'commit_metadata',
 		          'id' : id,
 		          'opf' : opf }
 		if cover:
-			with open(cover, 'rb') as f:
-				cd = f.read()
-				values['cover'] = b64encode(cd)
-				fn, ext = os.path.splitext(cover)
-				values['cover_ext'] = ext
-		response = self._post(values)
+			fn, ext = os.path.splitext(cover)
+			values['cover_ext'] = ext
+			values['cover_hash'] = content_hash(cover)
+		return values
+
+
+	def _post_metadata(self, id, opf, cover=None, abort=None, known=None):
+		'''
+		Posts updated metadata to Casanova server, streaming the cover file
+		if there is one and the server does not hold it yet. known is the
+		set of content hashes the server is already known to hold.
+		'''
+		values = self._metadata_values(id, opf, cover)
+		files = None
+		if cover:
+			if known is None:
+				known = known_content([values['cover_hash']], abort)
+			if values['cover_hash'] not in known:
+				files = {'cover': cover}
+		response = self._post(values, abort=abort, files=files)
 		the_page = response.read()
 		return the_page
 
@@ -144,7 +319,11 @@ class CasanovaMetadataManager(object):
 		''' Asks Casanova server for updates to a certain piece of Casanova metadata '''
 		values = {'cmd' : 'update_metadata',
 		          'id' : casanova_id }
-		response = self._post(values)
+		return self._handle_update_response(self._post(values))
+
+
+	def _handle_update_response(self, response, abort=None, progress=None):
+		''' Applies an update_metadata answer: a message, or a zip of updated opf files '''
 		response_type = response.info().getheader('Content-Type')
 		response_content = response.read()
 		if 'text/html' in response_type:
@@ -152,32 +331,54 @@ class CasanovaMetadataManager(object):
 		if 'archive/zip' in response_type:
 			io = StringIO.StringIO()
 			io.write(response_content)
-			return self.handle_zip_of_opf_files(io) #@todo : pick up here
+			return self.handle_zip_of_opf_files(io, abort, progress) #@todo : pick up here
 
 
-	def _post_sync_request(self, id, local_casanova_ids, since=0):
+	def _post_sync_request(self, id, local_casanova_ids, since=0, abort=None):
 		''' Posts a arequest for syncing an issue '''
 		values = {'cmd' : 'sync_issue',
 		          'id' : id,
 		          'casanova_ids' : ','.join(local_casanova_ids),
 		          'last_update' : since }
-		
-		response = self._post(values)
-		the_zip = response.read()
-		response_type = response.info().getheader('Content-Type')
-		if 'archive/zip' in response_type:
-			io = StringIO.StringIO()
-			io.write(the_zip)
-			return self.handle_zip_of_opf_files(io) #@todo : pick up here
-		else:
-			return 'Something went wrong :('
-
-	def search(self, str):
-		''' Searches for text metadata on Casanova '''
+		return self._post(values, abort=abort)
+
+	def search(self, str, abort=None):
+		'''
+		Searches for text metadata on Casanova. A call that can be aborted
+		makes its own request, as aborting a shared one would fail the others.
+		'''
+		if abort is not None:
+			return self._search(str, abort)
+		return self.flights.do(('search', str), self._search, str)
+
+	def _search(self, str, abort=None):
 		values = {'cmd' : 'search',
 							'query' : str }
-		response = self._post(values)
-		text = response.read()
+		response = self._post(values, abort=abort)
+		return self._search_results(response.read())
+
+	def search_many(self, queries, abort=None):
+		'''
+		Searches for several texts at once, sending the searches in batches.
+		Returns {query: {casanova id: name}}; a query whose search failed
+		maps to the error message instead.
+		'''
+		futures = {}
+		with Batcher(client) as batcher:
+			for query in set(queries):
+				if abort is not None and abort.is_set():
+					raise Cancelled('Cancelled searching Casanova')
+				futures[query] = batcher.submit({'cmd' : 'search', 'query' : query})
+		results = {}
+		for query, future in futures.iteritems():
+			try:
+				results[query] = self._search_results(future.result().read())
+			except HTTPError as e:
+				results[query] = e.body or unicode(e)
+		return results
+
+	def _search_results(self, text):
+		''' The {casanova id: name} matches in the answer to a search '''
 		ret_dict = {}
 		try: 
 			doc = json.loads(text)
@@ -194,25 +395,25 @@ class CasanovaMetadataManager(object):
 
 	def get_texts(self, casanova_ids):
 		''' Given base Casanova ids, get the metadata from the server '''
+		return self.apply_zip_response(self.fetch_texts(casanova_ids))
+
+	def fetch_texts(self, casanova_ids, abort=None):
+		''' The network half of get_texts '''
 		values = {'cmd' : 'get_texts',
 		          'casanova_ids' : ','.join(casanova_ids) }
-		
-		response = self._post(values)
-		the_zip = response.read()
-		response_type = response.info().getheader('Content-Type')
-		if 'archive/zip' in response_type:
-			io = StringIO.StringIO()
-			io.write(the_zip)
-			return self.handle_zip_of_opf_files(io) #@todo : pick up here
-		else:
-			return 'Something went wrong :('
+		return self._post(values, abort=abort)
 
 
-	def get_remote_formats(self, id, timeout=60):
+	def get_remote_formats(self, id, timeout=60, abort=None):
 		''' Retrieves information about where the actual file is located to download. Id is a casanova id '''
+		if abort is not None:
+			return self._get_remote_formats(id, timeout, abort)
+		return self.flights.do(('get_formats', id), self._get_remote_formats, id, timeout)
+
+	def _get_remote_formats(self, id, timeout=60, abort=None):
 		values = {'cmd' : 'get_formats',
 							'id' : id }
-		response = self._post(values)
+		response = self._post(values, timeout=timeout, abort=abort)
 		try:
 			doc = json.load(response)
 			formats = []
@@ -229,10 +430,15 @@ class CasanovaMetadataManager(object):
 		except:
 			return _('Something went wrong :(')
 
-	def get_remote_issues(self):
+	def get_remote_issues(self, abort=None):
 		''' Gets a list of remote issues - the Casanova server itself will decide how to implement this '''
+		if abort is not None:
+			return self._get_remote_issues(abort)
+		return self.flights.do(('get_issues',), self._get_remote_issues)
+
+	def _get_remote_issues(self, abort=None):
 		values = {'cmd' : 'get_issues' }
-		response = self._post(values)		
+		response = self._post(values, abort=abort)		
 		try:
 			doc = json.load(response)
 			ret_dict = {}
@@ -246,37 +452,31 @@ class CasanovaMetadataManager(object):
 
 	def get_all_casanova_books(self):
 		''' Gets every Casanova book in the library '''
-		rows = xrange(self.model.rowCount(QModelIndex()))
-		ids = []
-		for i in rows:
-			mi = self.db.get_metadata(i)
-			if mi.has_identifier('casanova'):
-				ids.append(mi.identifiers['casanova'])
-		return ids
+		return self.book_map.identifiers()
 
 
-	def get_all_issues(self, include_external=False):
-		from operator import itemgetter
+	def get_all_issues(self, include_external=False, remote_issues=None):
+		'''
+		The local issues, and the remote ones too if include_external is
+		set. Callers that fetched get_remote_issues() themselves (off the
+		GUI thread) can pass it as remote_issues.
+		'''
 		ids = []
-		tags_model = self.gui.tags_view.model()
-		result = tags_model.get_category_editor_data('#issue')
 		followed={}
 		downloaded={}
 		synced={}
-		if result is not None:
-			for key, category_name, num in result:
-				#print(category_name)
-				m = re.match( r'(.*)\((\d+)\)' , category_name)
-				if m:
-					#ids[ m.group(2) ] = m.group(1)
-					issue_id = m.group(2);
-					issue_name = m.group(1)
-					if 'last_updates' in prefs and issue_id in prefs['last_updates']:
-						synced[issue_id] = issue_name
-					else:
-						downloaded[issue_id] = issue_name
+		if not self.issue_map.listening:
+			# Without library listeners the index cannot see edits made outside the plugin
+			self.issue_map.refresh()
+		for issue_id, issue_name in self.issue_map.issues().iteritems():
+			if 'last_updates' in prefs and issue_id in prefs['last_updates']:
+				synced[issue_id] = issue_name
+			else:
+				downloaded[issue_id] = issue_name
 		if include_external:
-			ei = self.get_remote_issues()
+			ei = self.get_remote_issues() if remote_issues is None else remote_issues
+			if not isinstance(ei, dict):
+				ei = {}
 			for k, v in ei.iteritems():
 				if v is not None:
 					if not k in ids:
@@ -303,124 +503,258 @@ class CasanovaMetadataManager(object):
 
 	def get_casanova_metadata(self, casanova_id, cover_as_data=False):
 		''' Gets a local book (metadata) by its casanova id '''
-		rows = xrange(self.model.rowCount(QModelIndex()))
-		for i in rows:
-			mi = self.db.get_metadata(i, cover_as_data=cover_as_data)
-			candidate = self.extract_id(mi)
-			if candidate:
-				if candidate['id']==casanova_id:
-					return mi
-		return False
+		book_id = self.book_map.get(casanova_id)
+		if book_id is None:
+			return False
+		return self.db.get_metadata(book_id, index_is_id=True, cover_as_data=cover_as_data)
 
 
 	def get_local_books_in_issue(self, id, return_casanova_id_strings=True):
 		''' Given an issue's id, return a list of books '''
+		book_ids = self.issue_map.book_ids(id)
+		if not return_casanova_id_strings:
+			return list(book_ids)
 		ret_ids = []
-		if id in self.issue_map:
-			calibre_id = self.issue_map[id]
-			book_ids = self.get_book_ids_in_issue(calibre_id)
-			for book_id in book_ids:
-				if return_casanova_id_strings:
-					mi = self.db.get_metadata(book_id, index_is_id=True)
-					if mi.has_identifier('casanova'):
-						ret_ids.append(mi.identifiers['casanova'])
-				else:
-					ret_ids.append(book_id)
+		for book_id in book_ids:
+			identifier = self.book_map.identifier(book_id)
+			if identifier:
+				ret_ids.append(identifier)
 		return ret_ids
 
 
-	def get_book_ids_in_issue(self, id):
-		''' This is a hack which will probably break in future Calibre versions... 
-		all it does is get a list of book ids for books in a particular issue,
-		using the internal tag id '''
-		fm = self.db.field_metadata['#issue']
-		result = self.db.conn.get(
-		'SELECT book FROM books_{0}_link WHERE {1}=?'.format(fm['table'], fm['link_column']), (id, ), all=True)
-		if not result:
-			return set([])
-		return set([r[0] for r in result])
-
-
-	def handle_zip_of_opf_files(self, stream):
-		''' Given a zip up of a bunch of opf files, either merge them or add them to library '''
+	def handle_zip_of_opf_files(self, stream, abort=None, progress=None):
+		'''
+		Given a zip up of a bunch of opf files, either merge them or add them
+		to library. If abort is set part way through, the changes made so
+		far are undone and Cancelled is raised. progress(entries done,
+		entries) is called as the entries are applied. The zip is read in
+		the calling thread and each entry applied in the GUI thread.
+		'''
 		result = {'updated':0, 'added':0}
+		# Books deleted or re-identified in calibre must not be matched
+		self.indexes.catch_up()
 		with ZipFile(stream, 'r') as zf:
 			self.start_applying_updates()
-			for zi in zf.infolist():
+			entries = zf.infolist()
+			for i, zi in enumerate(entries):
+				if progress is not None:
+					progress(i, len(entries))
+				if abort is not None and abort.is_set():
+					self.in_gui_thread(self.rollback_updates)
+					self.in_gui_thread(self.finish_applying_updates)
+					raise Cancelled('Cancelled while applying updates from Casanova')
 				ext = zi.filename.rpartition('.')[-1].lower()
 				if ext in {'opf'}:
 					try:
 						raw = zf.open(zi)
 						opf = OPF(raw)
 						mi = opf.to_book_metadata()
-						casanova_id = self.extract_id(mi)
-						if casanova_id:
-							book_mi = self.get_casanova_metadata(casanova_id['id'])
-							if book_mi:
-								# Update an existing book's metadata!
-								result['updated'] = result['updated'] + 1
-								self.apply_metadata_update(casanova_id['id'], book_mi, mi)
-							else:
-								# Create a new book entry
-								result['added'] = result['added'] + 1
-								self.model.db.import_book(mi,[])
+						applied = self.in_gui_thread(self._apply_opf, mi)
+						if applied:
+							result[applied] = result[applied] + 1
 					except:
 						foo=False
 				if ext in {'jpg', 'png', 'gif'}:
 					# try and handle the cover
 					casanova_id = zi.filename.partition('.')[0].lower()
-					if casanova_id in self.book_map:
-						book_id = self.book_map[casanova_id]
-						raw = zf.open(zi)
-						self.db.set_cover(book_id, raw)
-			self.finish_applying_updates()
+					self.in_gui_thread(self._apply_cover, casanova_id, zf.read(zi))
+			if progress is not None:
+				progress(len(entries), len(entries), force=True)
+			self.in_gui_thread(self.finish_applying_updates)
 			return result
 			# @todo: display a message with the results
 
 
+	def _apply_opf(self, mi):
+		'''
+		Merges the metadata of one book sent by the server into the library.
+		Returns 'updated', 'added' or None. Runs in the GUI thread.
+		'''
+		casanova_id = self.extract_id(mi)
+		if not casanova_id:
+			return None
+		book_mi = self.get_casanova_metadata(casanova_id['id'])
+		if book_mi:
+			# Update an existing book's metadata!
+			self.apply_metadata_update(casanova_id['id'], book_mi, mi)
+			return 'updated'
+		# Create a new book entry
+		book_id = self.db.import_book(mi,[])
+		if book_id is not None:
+			self.book_map.set_identifier(book_id, mi.identifiers['casanova'])
+			self.added_book_ids.add(book_id)
+			self.undo.append(('add', book_id, None))
+		return 'added'
+
+
+	def _apply_cover(self, casanova_id, data):
+		''' Sets a cover sent by the server on its book, if it is in the library. Runs in the GUI thread. '''
+		if casanova_id not in self.book_map:
+			return
+		book_id = self.book_map[casanova_id]
+		self.undo.append(('cover', book_id, self.db.cover(book_id, index_is_id=True)))
+		self.db.set_cover(book_id, data)
+		# The server has this cover, so it need not go back on the next commit
+		path = cover_path(self.db, book_id)
+		if path is not None:
+			self.received_covers[casanova_id] = content_hash(path)
+
+
+	def in_gui_thread(self, func, *args):
+		'''
+		Calls func(*args) in the GUI thread, through a Dispatcher, and waits
+		for its result. Jobs make their library changes through this, as
+		calibre's library is only to be changed from the GUI thread.
+		'''
+		if current_thread() is self.gui_thread:
+			return func(*args)
+		call = {'done': Event(), 'result': None, 'error': None, 'func': func, 'args': args}
+		with self.calls_cond:
+			self.calls.append(call)
+			self.calls_cond.notify_all()
+		self.dispatch_call()
+		call['done'].wait()
+		if call['error'] is not None:
+			raise call['error']
+		return call['result']
+
+
+	def run_queued_calls(self):
+		''' Makes the calls queued by in_gui_thread. Runs in the GUI thread. '''
+		while True:
+			with self.calls_cond:
+				if not self.calls:
+					return
+				call = self.calls.popleft()
+			try:
+				call['result'] = call['func'](*call['args'])
+			except Exception as e:
+				call['error'] = e
+			finally:
+				call['done'].set()
+
+
+	def run_apply(self, func, args, abort, progress=None):
+		''' Runs func(*args) in an apply job, unless the library was closed first '''
+		with self.calls_cond:
+			if self.closed:
+				raise Cancelled('The library was closed before the updates were applied')
+			self.applies.add(abort)
+		try:
+			return func(*args, abort=abort, progress=progress)
+		finally:
+			with self.calls_cond:
+				self.applies.discard(abort)
+				self.calls_cond.notify_all()
+
+
+	def close(self):
+		'''
+		Stops the apply jobs before the library is closed: they are aborted,
+		and the calls they still make, which undo what they changed, are
+		made here until they have all finished. Runs in the GUI thread.
+		'''
+		with self.calls_cond:
+			self.closed = True
+			for abort in self.applies:
+				abort.set()
+		while True:
+			self.run_queued_calls()
+			with self.calls_cond:
+				if not self.applies and not self.calls:
+					return
+				if not self.calls:
+					self.calls_cond.wait(0.1)
+
+
 	def apply_metadata_update(self, casanova_id, current_mi, new_mi):
 		''' Updates existing metadata '''
 		if casanova_id in self.book_map:
-			current_mi.smart_update(new_mi)
 			book_id = self.book_map[casanova_id]
+			self.undo.append(('update', book_id, current_mi.deepcopy()))
+			current_mi.smart_update(new_mi)
 			self.db.set_metadata(book_id, current_mi)
+			self.book_map.set_identifier(book_id, current_mi.identifiers.get('casanova'))
 			self.applied_update_ids.add(book_id)
 			return True
 
 
 	def start_applying_updates(self):
 		self.applied_update_ids = set()
+		self.added_book_ids = set()
+		# casanova id -> content hash of each cover set from the server
+		self.received_covers = {}
+		# (action, book id, previous value) for each change, so it can be undone
+		self.undo = []
+
+
+	def rollback_updates(self):
+		''' Undoes the changes made since start_applying_updates '''
+		for action, book_id, old in reversed(self.undo):
+			if action == 'add':
+				self.db.delete_book(book_id)
+				self.book_map.remove_books([book_id])
+				self.issue_map.remove_books([book_id])
+				self.added_book_ids.discard(book_id)
+			elif action == 'update':
+				self.db.set_metadata(book_id, old)
+				self.book_map.set_identifier(book_id, old.identifiers.get('casanova'))
+			elif action == 'cover':
+				if old:
+					self.db.set_cover(book_id, old)
+				else:
+					self.db.remove_cover(book_id)
+		self.undo = []
+		self.received_covers = {}
 
 
 	def finish_applying_updates(self):
+		'''
+		Commits the applied updates. Runs in the GUI thread, and the library
+		view is refreshed once the events queued before it are handled.
+		'''
+		self.issue_map.refresh_books(self.applied_update_ids | self.added_book_ids)
+		record_synced_covers(self.received_covers)
 		if self.applied_update_ids:
 			self.db.commit()
-			cr = self.gui.library_view.currentIndex().row()
-			self.model.refresh_ids(list(self.applied_update_ids), cr)
-			if self.gui.cover_flow:
-				self.gui.cover_flow.dataChanged()
-			self.gui.tags_view.recount()
+			with self.refresh_lock:
+				self.refresh_ids |= self.applied_update_ids
+			self.queue_refresh()
+
+
+	def refresh_gui(self):
+		''' Redisplays the books changed by applied updates. Runs in the GUI thread. '''
+		with self.refresh_lock:
+			book_ids, self.refresh_ids = self.refresh_ids, set()
+		if not book_ids or self.closed:
+			# The view shows another library now
+			return
+		cr = self.gui.library_view.currentIndex().row()
+		self.model.refresh_ids(list(book_ids), cr)
+		if self.gui.cover_flow:
+			self.gui.cover_flow.dataChanged()
+		self.gui.tags_view.recount()
+
+
+	@property
+	def book_map(self):
+		''' The casanova id -> book id index, waiting for it if it is still loading '''
+		return self.indexes.wait().book_map
+
+
+	@property
+	def issue_map(self):
+		''' The issue index, waiting for it if it is still loading '''
+		return self.indexes.wait().issue_map
 
 
 	def refresh_book_map(self):
-		self.book_map = {}
-		rows = xrange(self.model.rowCount(QModelIndex()))
-		for i in rows:
-			mi = self.model.db.get_metadata(i)
-			candidate = self.extract_id(mi)
-			if candidate:
-				casanova_id = candidate['id']
-				self.book_map[casanova_id] = self.model.db.id(i)
+		self.indexes.wait().refresh_book_map()
+
 
 	def refresh_issue_map(self):
-		self.issue_map = {}
-		tags_model = self.gui.tags_view.model()
-		result = tags_model.get_category_editor_data('#issue')
-		if result is not None:
-			for key, category_name, num in result:
-				m = re.match( r'(.*)\((\d+)\)' , category_name)
-				if m:
-					self.issue_map[m.group(2)] = key
+		self.indexes.wait().refresh_issue_map()
+
 
 	def extract_id(self, mi):
 		if mi.has_identifier('casanova'):
@@ -437,3 +771,19 @@ class CasanovaMetadataManager(object):
 			else:
 				return {'id':res[0], 'revision':res[1]}
 		return False
+
+
+class CasanovaApplier(object):
+	''' Runs one of the metadata manager's apply methods as a calibre job, reporting its progress '''
+
+	def __call__(self, func, args, log=None, abort=None, notifications=None):
+		progress = JobProgress(notifications, _('Applying updates'), unit='entries')
+		return func.__self__.run_apply(func, args, abort, progress)
+
+
+gui_casanova_applier = CasanovaApplier()
+
+def start_casanova_apply(callback, job_manager, description, func, args):
+	job = ThreadedJob('casanova_apply', description, gui_casanova_applier, (func, args), {}, callback, max_concurrent_count=1, killable=True)
+	job_manager.run_threaded_job(job)
+	return job
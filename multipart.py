@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import mimetypes
+import os
+import uuid
+from base64 import b64encode
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return bytes(value)
+
+
+def read_file(spec):
+    ''' The contents of a file given as MultipartBody takes them: a path or (path, offset, length) '''
+    if isinstance(spec, basestring):
+        spec = (spec, 0, None)
+    path, offset, length = spec
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read() if length is None else f.read(length)
+
+
+def encoded_files(files):
+    '''
+    The files of a MultipartBody as base64 encoded form fields of the same
+    names, for servers that take no file parts. Unlike MultipartBody this
+    reads each file into memory.
+    '''
+    return dict((name, b64encode(read_file(spec))) for name, spec in files.iteritems())
+
+
+class MultipartBody(object):
+    '''
+    A multipart/form-data request body (RFC 7578) made of form fields and
+    files on disk. The files are never read into memory as a whole:
+    chunks() reads them piece by piece as the body is sent, so an upload
+    takes the same memory whatever the size of the file. The length is
+    known up front, for the Content-Length header.
+
+    files maps each field name to the path of the file to send in it, or
+    to (path, offset, length) to send only that part of the file.
+    '''
+
+    def __init__(self, fields, files):
+        self.boundary = uuid.uuid4().hex
+        self.parts = []
+        for name, value in sorted(fields.iteritems()):
+            self.parts.append((self._header(name), _encode(value), None))
+        for name, spec in sorted(files.iteritems()):
+            if isinstance(spec, basestring):
+                spec = (spec, 0, None)
+            filename = os.path.basename(spec[0])
+            content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            self.parts.append((self._header(name, filename, content_type), None, spec))
+        self.trailer = b'--' + _encode(self.boundary) + b'--\r\n'
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=' + self.boundary
+
+    def _header(self, name, filename=None, content_type=None):
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (self.boundary, name)
+        if filename is not None:
+            header += '; filename="%s"\r\nContent-Type: %s' % (
+                filename.replace('"', '%22'), content_type)
+        return _encode(header + '\r\n\r\n')
+
+    def __len__(self):
+        length = len(self.trailer)
+        for header, value, spec in self.parts:
+            length += len(header) + 2
+            length += len(value) if spec is None else self._file_length(spec)
+        return length
+
+    def _file_length(self, spec):
+        path, offset, length = spec
+        available = max(os.path.getsize(path) - offset, 0)
+        return available if length is None else min(length, available)
+
+    def chunks(self, size):
+        ''' Yields the body in chunks of at most size bytes, reading the files as it goes '''
+        buf = b''
+        for header, value, spec in self.parts:
+            buf += header
+            if spec is None:
+                buf += value
+            else:
+                left = self._file_length(spec)
+                with open(spec[0], 'rb') as f:
+                    f.seek(spec[1])
+                    while left > 0:
+                        if len(buf) >= size:
+                            yield buf[:size]
+                            buf = buf[size:]
+                            continue
+                        data = f.read(min(size - len(buf), left))
+                        if not data:
+                            break
+                        left -= len(data)
+                        buf += data
+            buf += b'\r\n'
+            while len(buf) >= size:
+                yield buf[:size]
+                buf = buf[size:]
+        buf += self.trailer
+        while buf:
+            yield buf[:size]
+            buf = buf[size:]
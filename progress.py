@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+
+from calibre import human_readable
+
+# Seconds between two updates sent to the jobs panel
+UPDATE_INTERVAL = 0.5
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    return '%d:%02d' % (seconds // 60, seconds % 60)
+
+
+class JobProgress(object):
+    '''
+    Reports the progress of a calibre ThreadedJob through its notifications
+    queue, as the fraction done and a message with the throughput and the
+    time left. Call it with (done, total) as work is done; updates are
+    rate limited so tight loops do not flood the GUI. part() gives a
+    reporter for one slice of the job, for jobs made of several steps.
+    '''
+
+    def __init__(self, notifications, message='', unit='bytes', start=0.0, end=1.0, parent=None):
+        self.notifications = notifications
+        self.message = message
+        self.unit = unit
+        self.start = start
+        self.end = end
+        self.parent = parent
+        self.started = time.time()
+        self.last_update = 0
+
+    def part(self, index, count, message=None, unit=None):
+        ''' The reporter for step index (of count equal steps) of this job '''
+        width = (self.end - self.start) / max(count, 1)
+        start = self.start + index * width
+        return JobProgress(self.notifications, self.message if message is None else message,
+                           unit or self.unit, start, start + width, self.parent or self)
+
+    def rate_text(self, done, total, elapsed):
+        if elapsed <= 0 or done <= 0:
+            return ''
+        rate = done / elapsed
+        if self.unit == 'bytes':
+            text = '%s/s' % human_readable(rate)
+        else:
+            text = '%.1f %s/s' % (rate, self.unit)
+        if total:
+            text += ', %s left' % format_duration((total - done) / rate)
+        return text
+
+    def __call__(self, done, total=None, force=False):
+        if self.notifications is None:
+            return
+        now = time.time()
+        root = self.parent or self
+        if not force and now - root.last_update < UPDATE_INTERVAL and done != total:
+            return
+        root.last_update = now
+        fraction = min(float(done) / total, 1.0) if total else 0.0
+        if self.unit == 'bytes':
+            amount = human_readable(done) + (' of ' + human_readable(total) if total else '')
+        else:
+            amount = '%d%s %s' % (done, ' of %d' % total if total else '', self.unit)
+        rate = self.rate_text(done, total, now - self.started)
+        msg = '%s: %s' % (self.message, amount) if self.message else amount
+        if rate:
+            msg += ' (%s)' % rate
+        self.notifications.put((self.start + fraction * (self.end - self.start), msg))
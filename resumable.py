@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib
+import json
+import os
+import socket
+from threading import Lock
+
+from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.client import (client, Cancelled, HTTPError,
+                                                    RequestTimeout)
+from calibre_plugins.casanova_plugin.engine import WorkerPool
+from calibre_plugins.casanova_plugin.scheduler import BULK
+from calibre_plugins.casanova_plugin.transfers import uploads
+
+# Attempts at each chunk before the upload gives up (and can be resumed later)
+CHUNK_ATTEMPTS = 3
+
+# Uploads running at once read and write the upload_sessions pref under this
+_sessions_lock = Lock()
+
+
+class UnsupportedServer(Exception):
+    ''' The server does not know the chunked upload commands '''
+
+
+# Sends the chunks of the uploads running at once, upload_parallel_chunks for each.
+# The uploads hold their transfer slots, so the chunks need no priority class.
+chunk_pool = WorkerPool(lambda: max(1, prefs['upload_parallel_chunks']) * uploads.cap(),
+                        'CasanovaChunks')
+
+
+def send_all(uploads):
+    '''
+    Sends the missing chunks of several started uploads together, keeping
+    upload_parallel_chunks of them in flight. An upload whose chunk fails
+    is dropped without stopping the others. Returns {upload: error} for the
+    uploads that failed.
+    '''
+    window = max(1, prefs['upload_parallel_chunks'])
+    pending = [(upload, index) for upload in uploads for index in upload.missing]
+    pending.reverse()
+    in_flight = []
+    errors = {}
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < window:
+                upload, index = pending.pop()
+                if upload not in errors:
+                    in_flight.append((upload, chunk_pool.submit(upload._send_chunk, index)))
+            if not in_flight:
+                break
+            upload, future = in_flight.pop(0)
+            try:
+                future.result()
+            except Cancelled:
+                raise
+            except Exception as e:
+                errors.setdefault(upload, e)
+    finally:
+        for upload, future in in_flight:
+            future.cancel()
+    return errors
+
+
+def session_key(path):
+    ''' Identifies a file, as it is now, among the uploads that can be resumed '''
+    st = os.stat(path)
+    return '%s|%d|%d' % (os.path.abspath(path), st.st_size, int(st.st_mtime))
+
+
+def chunk_checksum(path, offset, length):
+    ''' The md5 of a part of a file, read a block at a time '''
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(length, 64 * 1024))
+            if not data:
+                break
+            digest.update(data)
+            length -= len(data)
+    return digest.hexdigest()
+
+
+class ResumableUpload(object):
+    '''
+    Sends a file to the server in chunks, so an interrupted upload goes
+    on from the chunks the server already has rather than from the start:
+
+        upload_start   name, size, chunk_size -> {"session": id}
+        upload_status  session -> {"received": [chunk indexes]}
+        upload_chunk   session, index, checksum (md5) and the chunk as a file part
+
+    The session of each file (by path, size and mtime) is kept in the
+    upload_sessions pref until the upload is done, and chunks are sent
+    over up to upload_parallel_chunks connections at once. run() returns
+    the session id, which the command using the file (new_text) is given
+    instead of the file itself. To send several files together, start()
+    each and pass them to send_all(). key identifies the file among the
+    saved sessions in place of session_key(path), for a copy of a file
+    that should resume the uploads of the original.
+    '''
+
+    def __init__(self, path, abort=None, progress=None, key=None):
+        self.path = path
+        self.abort = abort
+        self.progress = progress
+        self.size = os.path.getsize(path)
+        self.chunk_size = prefs['upload_chunk_size']
+        self.key = key or session_key(path)
+        self.lock = Lock()
+        self.sent = 0
+        self.session = None
+        self.missing = []
+
+    def _command(self, values, files=None):
+        '''
+        Sends one of the chunked upload commands and returns its JSON answer.
+        An upload_start the server answers as an unknown command, or not
+        with JSON, raises UnsupportedServer.
+        '''
+        starting = values['cmd'] == 'upload_start'
+        try:
+            # Chunks are sent holding the upload's transfer slot
+            response = client.post(values, abort=self.abort, priority=BULK, files=files,
+                                   transfer=files is not None)
+        except HTTPError as e:
+            if starting and e.status in (400, 404, 501):
+                raise UnsupportedServer(e.body or unicode(e))
+            raise
+        body = response.read()
+        try:
+            return json.loads(body)
+        except ValueError:
+            if starting:
+                raise UnsupportedServer('Not an answer to upload_start: %r' % body[:100])
+            raise
+
+    def _saved_sessions(self):
+        prefs.refresh()
+        return dict(prefs['upload_sessions'])
+
+    def _remember(self, session):
+        with _sessions_lock:
+            sessions = self._saved_sessions()
+            if session is None:
+                sessions.pop(self.key, None)
+            else:
+                sessions[self.key] = session
+            prefs['upload_sessions'] = sessions
+
+    def _resume(self):
+        ''' The session of an earlier attempt and the chunks it got through, if it still exists '''
+        session = self._saved_sessions().get(self.key)
+        if session is None:
+            return None, set()
+        try:
+            doc = self._command({'cmd': 'upload_status', 'session': session})
+        except HTTPError as e:
+            if e.status not in (404, 410):
+                raise
+            # The server has dropped it
+            return None, set()
+        return session, set(int(i) for i in doc.get('received', []))
+
+    def run(self):
+        self.start()
+        errors = send_all([self])
+        if errors:
+            raise errors[self]
+        return self.session
+
+    def start(self):
+        ''' Opens or resumes the upload session and works out the chunks left to send '''
+        session, received = self._resume()
+        if session is None:
+            doc = self._command({'cmd': 'upload_start', 'name': os.path.basename(self.path),
+                                 'size': self.size, 'chunk_size': self.chunk_size})
+            if not isinstance(doc, dict) or not doc.get('session'):
+                raise UnsupportedServer('No upload session in %r' % doc)
+            session = doc['session']
+            self.chunk_size = int(doc.get('chunk_size', self.chunk_size))
+            self._remember(session)
+        else:
+            print('Resuming the upload of %s: the server has %d chunks' % (self.path, len(received)))
+        count = max(1, -(-self.size // self.chunk_size))
+        self.session = session
+        self.missing = [i for i in xrange(count) if i not in received]
+        self.sent = sum(self._length(i) for i in received if i < count)
+        self._report()
+
+    def finished(self):
+        ''' Forgets the session once the server has used the uploaded file '''
+        self._remember(None)
+
+    def _length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def _report(self):
+        if self.progress is not None:
+            self.progress(self.sent, self.size)
+
+    def _send_chunk(self, index):
+        offset, length = index * self.chunk_size, self._length(index)
+        values = {'cmd': 'upload_chunk', 'session': self.session, 'index': index,
+                  'checksum': chunk_checksum(self.path, offset, length)}
+        for attempt in xrange(1, CHUNK_ATTEMPTS + 1):
+            if self.abort is not None and self.abort.is_set():
+                raise Cancelled('Upload cancelled')
+            try:
+                self._command(values, {'data': (self.path, offset, length)})
+                break
+            except (HTTPError, RequestTimeout, socket.error) as e:
+                # 422: the server got a chunk that does not match its checksum
+                retry = not isinstance(e, HTTPError) or e.status == 422 or e.status >= 500
+                if not retry or attempt == CHUNK_ATTEMPTS:
+                    raise
+                print('Sending chunk %d of %s again: %s' % (index, self.path, e))
+        with self.lock:
+            self.sent += length
+            self._report()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+from threading import Condition, Lock
+
+from calibre_plugins.casanova_plugin.config import prefs
+
+# Priority classes, most urgent first
+INTERACTIVE, NORMAL, BULK = 0, 1, 2
+PRIORITY_NAMES = ('interactive', 'normal', 'bulk')
+
+# The class of each command; anything else is NORMAL
+COMMAND_PRIORITIES = {
+    'login': INTERACTIVE,
+    'search': INTERACTIVE,
+    'get_formats': INTERACTIVE,
+    'get_issues': INTERACTIVE,
+    'update_metadata': INTERACTIVE,
+    'sync_issue': BULK,
+    'get_author': BULK,
+    'new_text': BULK,
+}
+
+
+def command_priority(cmd):
+    return COMMAND_PRIORITIES.get(cmd, NORMAL)
+
+
+def transfer_connections():
+    '''
+    The most connections transfers can hold at once: a download per
+    download slot and upload_parallel_chunks per upload slot, at the
+    upper bounds of the transfer_concurrency pref
+    '''
+    bounds = prefs['transfer_concurrency']
+    return (max(1, bounds['download']['max']) +
+            max(1, bounds['upload']['max']) * max(1, prefs['upload_parallel_chunks']))
+
+
+class TokenBucket(object):
+    '''
+    A bandwidth budget shared by all transfers: tokens (bytes) refill at
+    ``rate`` per second up to ``rate`` (one second's worth of burst), or
+    up to the size of the request when that is larger, so chunks bigger
+    than a second's worth still get through.
+    Interactive transfers take what they need without waiting, running
+    the bucket into debt that the others then wait out.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._tokens = 0.0
+        self._stamp = time.time()
+
+    def consume(self, nbytes, priority, deadline=None):
+        rate = prefs['bandwidth_limit'] * 1024
+        if rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(max(rate, nbytes), self._tokens + (now - self._stamp) * rate)
+                self._stamp = now
+                if priority == INTERACTIVE or self._tokens >= nbytes:
+                    self._tokens -= nbytes
+                    return
+                wait = (nbytes - self._tokens) / rate
+            if deadline is not None:
+                deadline.check('the bandwidth budget')
+            time.sleep(min(wait, 0.25))
+
+
+class Scheduler(object):
+    '''
+    Decides when each Casanova request may start. There are at most
+    connection_pool_size requests in flight, and at most the
+    priority_limits pref for each priority class, and a request never
+    starts while a more urgent one, that its class limit would let run,
+    is waiting. So bulk requests can not take the slots a search needs.
+
+    Transfers (downloads, and the requests carrying uploaded files) are
+    already limited by their AdaptiveLimit in transfers.py, and have
+    connections of their own (see transfer_connections()), so they start
+    straight away and count against none of these limits.
+    '''
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self.running = [0, 0, 0]
+        self.waiting = [0, 0, 0]
+        self.transfers = 0
+        self.bucket = TokenBucket()
+        # Per class: requests started, and seconds spent waiting for a slot
+        self.started = [0, 0, 0]
+        self.waited = [0.0, 0.0, 0.0]
+        self.transfers_started = 0
+
+    def _limit(self, priority):
+        return prefs['priority_limits'][PRIORITY_NAMES[priority]]
+
+    def _can_start(self, priority):
+        if sum(self.running) >= prefs['connection_pool_size']:
+            return False
+        if self.running[priority] >= self._limit(priority):
+            return False
+        for urgent in xrange(priority):
+            if self.waiting[urgent] and self.running[urgent] < self._limit(urgent):
+                return False
+        return True
+
+    def acquire(self, priority, deadline=None, transfer=False):
+        ''' Waits for a slot for a request of this priority '''
+        if transfer:
+            with self._cond:
+                self.transfers += 1
+                self.transfers_started += 1
+            return
+        start = time.time()
+        with self._cond:
+            self.waiting[priority] += 1
+            try:
+                while not self._can_start(priority):
+                    if deadline is not None:
+                        deadline.check('a free connection')
+                    self._cond.wait(0.25)
+            finally:
+                self.waiting[priority] -= 1
+            self.running[priority] += 1
+            self.started[priority] += 1
+            self.waited[priority] += time.time() - start
+
+    def release(self, priority, transfer=False):
+        with self._cond:
+            if transfer:
+                self.transfers -= 1
+                return
+            self.running[priority] -= 1
+            self._cond.notify_all()
+
+    def stats_summary(self):
+        with self._cond:
+            return 'Casanova scheduler: ' + ', '.join(
+                ['%s %d requests (%.1fs waiting)' % (name, self.started[p], self.waited[p])
+                 for p, name in enumerate(PRIORITY_NAMES)] +
+                ['%d transfers' % self.transfers_started])
+
+
+# The scheduler all of the plugin's network traffic goes through
+scheduler = Scheduler()
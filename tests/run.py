@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Runs the plugin's tests. They need calibre's python, and a scratch
+configuration directory so the plugin's real settings are left alone:
+
+    CALIBRE_CONFIG_DIRECTORY=/tmp/casanova-tests calibre-debug -e tests/run.py
+
+Any arguments are test name patterns, e.g. test_index.
+'''
+
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main(args):
+    if not os.environ.get('CALIBRE_CONFIG_DIRECTORY'):
+        print('Set CALIBRE_CONFIG_DIRECTORY to a scratch directory to run the tests')
+        return 2
+    sys.path.insert(0, TESTS_DIR)
+    import support
+    support.install()
+    loader = unittest.defaultTestLoader
+    if args:
+        suite = unittest.TestSuite(loader.loadTestsFromName(name) for name in args)
+    else:
+        suite = loader.discover(TESTS_DIR)
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    return 0 if result.wasSuccessful() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+# A small stand-in for a Casanova server's /api/do listener, so the plugin's
+# protocol (logins, token expiry, ...) can be exercised without a real
+# server. The tests start one per test case; it can also be run on its own,
+# with just the python standard library:
+#
+#     python tests/standin_server.py --port 8080 --token-ttl 60
+#
+# then point the plugin's "Casanova server" setting at http://localhost:8080
+# and use the username and password given with --username/--password.
+
+import argparse
+import base64
+import cgi
+import hashlib
+import json
+import time
+import uuid
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Lock
+from urlparse import parse_qsl
+
+
+class StandInState(object):
+    ''' Everything the stand-in server remembers between requests '''
+
+    def __init__(self, username, password, token_ttl):
+        self.username = username
+        self.password = password
+        self.token_ttl = token_ttl
+        self.tokens = {}
+        self.lock = Lock()
+        self.issues = {'1': {'name': 'Stand-in issue'}}
+        self.texts = {'1': {'title': 'Stand-in text', 'author': 'Doe, Jane'}}
+        # Chunked uploads: session id -> {'size', 'chunk_size', 'chunks': {index: data}}
+        self.uploads = {}
+        # sha256 of every file received -> its size
+        self.content = {}
+        self.stats = {'logins': 0, 'password_checks': 0, 'requests': 0, 'not_modified': 0,
+                      'batched': 0, 'files': 0, 'chunks': 0, 'deduplicated': 0}
+        # The command of every request, in the order they arrived
+        self.received = []
+        # Commands answered as unknown, as by an older server, and how
+        self.unknown = set()
+        self.unknown_status = 400
+        # cmd -> number of its requests to drop without an answer, as a
+        # server closing a keep-alive connection would
+        self.drop = {}
+        # cmd -> seconds to wait before answering it, and the most requests
+        # of each command that were being answered at once
+        self.delay = {}
+        self.active = {}
+        self.peak = {}
+        # What login announces: 'files' to take files as multipart file
+        # parts rather than base64 encoded fields, 'formats' to take several
+        # formats of a new text rather than a single text field
+        self.features = ['files', 'formats']
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # The responses of the commands in the batch being answered
+    captured = None
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def do_POST(self):
+        if (self.headers.getheader('content-type') or '').startswith('multipart/form-data'):
+            if 'files' not in self.state.features:
+                self.read_multipart()
+                return self.send_body(400, 'text/plain', 'File parts are not supported')
+            values = self.read_multipart()
+        else:
+            length = int(self.headers.getheader('content-length') or 0)
+            body = self.rfile.read(length)
+            if (self.headers.getheader('content-encoding') or '').lower() == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            values = dict(parse_qsl(body, keep_blank_values=True))
+            if 'files' not in self.state.features:
+                self.decode_files(values)
+        cmd = values.get('cmd', '')
+        with self.state.lock:
+            self.state.stats['requests'] += 1
+            self.state.received.append(cmd)
+            drop = self.state.drop.get(cmd, 0) > 0
+            if drop:
+                self.state.drop[cmd] -= 1
+        if drop:
+            self.close_connection = 1
+            return
+        handler = getattr(self, 'cmd_' + cmd, None)
+        if handler is None or cmd in self.state.unknown:
+            return self.send_body(self.state.unknown_status, 'text/plain', 'Unknown command: ' + cmd)
+        if cmd == 'login':
+            return self.cmd_login(values)
+        if not self.authenticated(values):
+            return self.send_body(401, 'text/plain', 'Session expired or not logged in')
+        with self.state.lock:
+            self.state.active[cmd] = self.state.active.get(cmd, 0) + 1
+            self.state.peak[cmd] = max(self.state.peak.get(cmd, 0), self.state.active[cmd])
+        try:
+            time.sleep(self.state.delay.get(cmd, 0))
+            return handler(values)
+        finally:
+            with self.state.lock:
+                self.state.active[cmd] -= 1
+
+    def read_multipart(self):
+        ''' The fields of a multipart/form-data body; files are given as their contents '''
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST',
+                                         'CONTENT_TYPE': self.headers.getheader('content-type')})
+        values = {}
+        for name in form.keys():
+            values[name] = form[name].value
+            if form[name].filename:
+                with self.state.lock:
+                    self.state.stats['files'] += 1
+        return values
+
+    def decode_files(self, values):
+        ''' Decodes the files sent, base64 encoded, in the fields of a form '''
+        for name in values.keys():
+            if name in ('cover', 'text', 'data') or (name.startswith('text_') and
+                    not name.startswith(('text_hash_', 'text_upload_', 'text_ext'))):
+                values[name] = base64.b64decode(values[name])
+                with self.state.lock:
+                    self.state.stats['files'] += 1
+
+    def authenticated(self, values):
+        if 'token' in values:
+            with self.state.lock:
+                expires = self.state.tokens.get(values['token'], 0)
+            return expires > time.time()
+        return self.check_password(values.get('un'), values.get('pw'))
+
+    def check_password(self, username, password):
+        with self.state.lock:
+            self.state.stats['password_checks'] += 1
+        return username == self.state.username and password == self.state.password
+
+    def send_body(self, status, content_type, body, headers=None):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if self.captured is not None:
+            # Answering a command inside a batch
+            self.captured.append((status, content_type, body))
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        # Tell clients they may gzip their request bodies (RFC 7694)
+        self.send_header('Accept-Encoding', 'gzip')
+        accepted = (self.headers.getheader('accept-encoding') or '').lower()
+        if len(body) > self.server.compress_threshold and 'gzip' in accepted:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, doc, status=200):
+        body = json.dumps(doc, sort_keys=True)
+        if status != 200:
+            return self.send_body(status, 'application/json', body)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if etag == self.headers.getheader('if-none-match'):
+            with self.state.lock:
+                self.state.stats['not_modified'] += 1
+            return self.send_body(304, 'application/json', '', {'ETag': etag})
+        self.send_body(status, 'application/json', body, {'ETag': etag})
+
+    def cmd_login(self, values):
+        if not self.check_password(values.get('un'), values.get('pw')):
+            return self.send_json({'status': 'error', 'message': 'Bad credentials'}, 403)
+        token = uuid.uuid4().hex
+        with self.state.lock:
+            self.state.stats['logins'] += 1
+            self.state.tokens[token] = time.time() + self.state.token_ttl
+        self.send_json({'status': 'success', 'token': token,
+                        'expires_in': self.state.token_ttl, 'features': self.state.features})
+
+    def cmd_get_issues(self, values):
+        self.send_json(self.state.issues)
+
+    def cmd_search(self, values):
+        query = values.get('query', '').lower()
+        self.send_json(dict((k, v) for k, v in self.state.texts.iteritems()
+                            if query in v['title'].lower() or query in v['author'].lower()))
+
+    def cmd_get_formats(self, values):
+        self.send_json({'1': {'type': 'application/epub+zip',
+                              'href': 'http://%s:%d/files/%s.epub' % (
+                                  self.server.server_address + (values.get('id', ''),))}})
+
+    def store_content(self, data, digest=None):
+        ''' Remembers a file received, or checks a hash sent instead of one '''
+        with self.state.lock:
+            if data is None:
+                if digest not in self.state.content:
+                    return 'Unknown content %s' % digest
+                self.state.stats['deduplicated'] += 1
+                return 'success'
+            self.state.content[hashlib.sha256(data).hexdigest()] = len(data)
+        return 'success'
+
+    def cmd_has_content(self, values):
+        hashes = filter(None, values.get('hashes', '').split('|'))
+        with self.state.lock:
+            known = [h for h in hashes if h in self.state.content]
+        self.send_json({'known': known})
+
+    def cmd_commit_metadata(self, values):
+        cover = values.get('cover')
+        status = 'no cover'
+        if cover is not None or 'cover_hash' in values:
+            status = self.store_content(cover, values.get('cover_hash'))
+        self.send_body(200, 'text/html', 'Metadata for %s received (%d bytes of OPF, cover: %s)' % (
+            values.get('id'), len(values.get('opf', '')), status))
+
+    def cmd_new_text(self, values):
+        if 'formats' not in self.state.features:
+            # One format, in the text field, and no word on what became of it
+            values['formats'] = values.get('text_ext', '').lstrip('.')
+            if 'text' in values:
+                values['text_' + values['formats']] = values['text']
+        texts, results = {}, {}
+        for fmt in filter(None, values.get('formats', '').split('|')):
+            if 'text_upload_' + fmt in values:
+                texts[fmt], results[fmt] = self.finish_upload(values['text_upload_' + fmt])
+            elif 'text_' + fmt in values:
+                texts[fmt], results[fmt] = values['text_' + fmt], 'success'
+            elif 'text_hash_' + fmt in values:
+                texts[fmt], results[fmt] = None, self.store_content(None, values['text_hash_' + fmt])
+            else:
+                results[fmt] = 'No file was sent'
+            if texts.get(fmt) is not None and results[fmt] == 'success':
+                self.store_content(texts[fmt])
+        if 'cover' in values or 'cover_hash' in values:
+            results['cover'] = self.store_content(values.get('cover'), values.get('cover_hash'))
+        with self.state.lock:
+            casanova_id = unicode(len(self.state.texts) + 1)
+            self.state.texts[casanova_id] = {
+                'title': values.get('title', ''), 'author': values.get('authors', ''),
+                'formats': dict((fmt, {'size': len(text), 'md5': hashlib.md5(text).hexdigest()})
+                                for fmt, text in texts.iteritems()
+                                if text is not None and results[fmt] == 'success')}
+        if 'formats' not in self.state.features:
+            return self.send_json({'status': 'success', 'casanova_id': casanova_id})
+        self.send_json({'status': 'success', 'casanova_id': casanova_id, 'formats': results})
+
+    def finish_upload(self, session):
+        ''' The file of a chunked upload and 'success', or None and what is wrong with it '''
+        with self.state.lock:
+            upload = self.state.uploads.get(session)
+            if upload is None:
+                return None, 'No such upload'
+            count = -(-upload['size'] // upload['chunk_size'])
+            if len(upload['chunks']) < count:
+                return None, 'The upload is missing %d chunks' % (count - len(upload['chunks']))
+            del self.state.uploads[session]
+        return b''.join(upload['chunks'][i] for i in xrange(count)), 'success'
+
+    def cmd_upload_start(self, values):
+        session = uuid.uuid4().hex
+        with self.state.lock:
+            self.state.uploads[session] = {'size': int(values.get('size', 0)),
+                                           'chunk_size': int(values.get('chunk_size', 1024 * 1024)),
+                                           'chunks': {}}
+        self.send_json({'session': session,
+                        'chunk_size': self.state.uploads[session]['chunk_size']})
+
+    def cmd_upload_status(self, values):
+        with self.state.lock:
+            upload = self.state.uploads.get(values.get('session'))
+            received = sorted(upload['chunks']) if upload is not None else None
+        if received is None:
+            return self.send_body(404, 'text/plain', 'No such upload')
+        self.send_json({'received': received})
+
+    def cmd_upload_chunk(self, values):
+        data = values.get('data', '')
+        if hashlib.md5(data).hexdigest() != values.get('checksum'):
+            return self.send_body(422, 'text/plain', 'Checksum mismatch')
+        with self.state.lock:
+            upload = self.state.uploads.get(values.get('session'))
+            if upload is not None:
+                upload['chunks'][int(values['index'])] = data
+                self.state.stats['chunks'] += 1
+        if upload is None:
+            return self.send_body(404, 'text/plain', 'No such upload')
+        self.send_json({'status': 'success'})
+
+    def cmd_update_metadata(self, values):
+        self.send_body(200, 'text/html', 'Metadata for %s is up to date' % values.get('id'))
+
+    def cmd_batch(self, values):
+        results = []
+        for command in json.loads(values.get('commands', '[]')):
+            cmd = command.get('cmd', '')
+            self.captured = []
+            handler = getattr(self, 'cmd_' + cmd, None)
+            if handler is None or cmd in ('login', 'batch') or cmd in self.state.unknown:
+                self.send_body(400, 'text/plain', 'Unknown command: ' + cmd)
+            else:
+                handler(command)
+            status, content_type, body = self.captured[0]
+            results.append({'status': status, 'content_type': content_type,
+                            'body': base64.b64encode(body)})
+        self.captured = None
+        with self.state.lock:
+            self.state.stats['batched'] += len(results)
+        self.send_json(results)
+
+    def cmd_stats(self, values):
+        with self.state.lock:
+            self.send_json(self.state.stats)
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    # Responses larger than this are gzipped for clients that accept it
+    compress_threshold = 512
+
+    def __init__(self, address, state, verbose=False):
+        HTTPServer.__init__(self, address, StandInHandler)
+        self.state = state
+        self.verbose = verbose
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in Casanova server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--username', default='casanova')
+    parser.add_argument('--password', default='casanova')
+    parser.add_argument('--token-ttl', type=int, default=3600,
+                        help='Seconds before a session token expires')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    state = StandInState(args.username, args.password, args.token_ttl)
+    server = StandInServer((args.host, args.port), state, args.verbose)
+    print('Stand-in Casanova server listening on http://%s:%d' % (args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Helpers shared by the tests: importing the plugin from the source tree,
+overriding its settings, and a small sqlite library with calibre's
+identifiers and #issue tables.
+'''
+
+import datetime
+import imp
+import os
+import sqlite3
+import sys
+import types
+from threading import Thread
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(TESTS_DIR)
+PACKAGE = 'calibre_plugins.casanova_plugin'
+
+
+class PluginImporter(object):
+    '''
+    Imports calibre_plugins.casanova_plugin.<module> from the source tree,
+    as calibre does from the installed plugin zip.
+    '''
+
+    def find_module(self, fullname, path=None):
+        if fullname in ('calibre_plugins', PACKAGE) or fullname.startswith(PACKAGE + '.'):
+            return self
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        if fullname in ('calibre_plugins', PACKAGE):
+            module = types.ModuleType(str(fullname))
+            module.__path__ = [PLUGIN_DIR] if fullname == PACKAGE else []
+            module.__loader__ = self
+            sys.modules[fullname] = module
+            return module
+        name = fullname.rpartition('.')[2]
+        return imp.load_source(str(fullname), os.path.join(PLUGIN_DIR, name + '.py'))
+
+
+def install():
+    ''' Makes the plugin importable; called once by run.py before the tests are loaded '''
+    if not any(isinstance(f, PluginImporter) for f in sys.meta_path):
+        sys.meta_path.insert(0, PluginImporter())
+
+
+def override_prefs(test, **values):
+    ''' Sets plugin prefs for the duration of a test '''
+    from calibre_plugins.casanova_plugin.config import prefs
+    for key, value in values.iteritems():
+        if key in prefs:
+            test.addCleanup(prefs.__setitem__, key, prefs[key])
+        else:
+            test.addCleanup(lambda key=key: prefs.pop(key, None))
+        prefs[key] = value
+
+
+def start_server(test, token_ttl=3600, **state):
+    '''
+    Starts a stand-in server for the duration of a test and points the
+    plugin at it. Attributes of its StandInState can be set through state.
+    Returns the state, to look at what the server was sent.
+    '''
+    from standin_server import StandInServer, StandInState
+    server_state = StandInState('casanova', 'secret', token_ttl)
+    for name, value in state.iteritems():
+        setattr(server_state, name, value)
+    server = StandInServer(('127.0.0.1', 0), server_state)
+    thread = Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05},
+                    name='StandInServer')
+    thread.daemon = True
+    thread.start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    # Closing the kept-alive connections lets the server's threads finish
+    from calibre_plugins.casanova_plugin.client import client
+    test.addCleanup(client.close)
+    override_prefs(test, base_url='http://127.0.0.1:%d' % server.server_address[1],
+                   username='casanova', password='secret')
+    return server_state
+
+
+class Connection(object):
+    ''' The part of calibre's database connection the plugin uses '''
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+
+    def get(self, sql, bindings=(), all=True):
+        rows = self.db.execute(sql, bindings).fetchall()
+        if all:
+            return rows
+        return rows[0][0] if rows else None
+
+    def execute(self, sql, bindings=()):
+        self.db.execute(sql, bindings)
+        self.db.commit()
+
+
+class Library(object):
+    '''
+    Just enough of a calibre library for the plugin's indexes: books,
+    their identifiers and an #issue column.
+    '''
+
+    library_id = 'casanova-test-library'
+
+    def __init__(self):
+        self.conn = Connection()
+        self.conn.db.executescript('''
+            CREATE TABLE books (id INTEGER PRIMARY KEY, last_modified TIMESTAMP);
+            CREATE TABLE identifiers (book INTEGER, type TEXT, val TEXT);
+            CREATE TABLE custom_column_1 (id INTEGER PRIMARY KEY, value TEXT);
+            CREATE TABLE books_custom_column_1_link (book INTEGER, value INTEGER);
+        ''')
+        self.field_metadata = {'#issue': {'table': 'custom_column_1', 'link_column': 'value'}}
+        self.modified = datetime.datetime(2014, 1, 1)
+
+    def last_modified(self):
+        return self.modified
+
+    def touch(self, book_id):
+        self.modified += datetime.timedelta(seconds=1)
+        self.conn.execute('UPDATE books SET last_modified=? WHERE id=?',
+                          (self.modified.isoformat(), book_id))
+
+    def add_book(self, book_id, casanova=None, issues=()):
+        self.conn.execute('INSERT INTO books VALUES (?, ?)', (book_id, None))
+        if casanova is not None:
+            self.set_casanova(book_id, casanova)
+        for issue_id, name in issues:
+            self.conn.execute('INSERT OR IGNORE INTO custom_column_1 VALUES (?, ?)',
+                              (issue_id, '%s (%s)' % (name, issue_id)))
+            self.conn.execute('INSERT INTO books_custom_column_1_link VALUES (?, ?)',
+                              (book_id, issue_id))
+        self.touch(book_id)
+
+    def set_casanova(self, book_id, val):
+        self.conn.execute("DELETE FROM identifiers WHERE book=? AND type='casanova'", (book_id,))
+        if val is not None:
+            self.conn.execute("INSERT INTO identifiers VALUES (?, 'casanova', ?)", (book_id, val))
+        self.touch(book_id)
+
+    def remove_book(self, book_id):
+        for table in ('books WHERE id', 'identifiers WHERE book',
+                      'books_custom_column_1_link WHERE book'):
+            self.conn.execute('DELETE FROM %s=?' % table, (book_id,))
+        self.modified += datetime.timedelta(seconds=1)
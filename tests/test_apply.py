@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+import time
+from threading import Event, Thread
+from zipfile import ZipFile
+
+from support import Library, override_prefs
+
+from calibre_plugins.casanova_plugin.client import Cancelled
+from calibre_plugins.casanova_plugin.content import synced_covers
+from calibre_plugins.casanova_plugin.index import LibraryIndexes
+from calibre_plugins.casanova_plugin.metadata import CasanovaMetadataManager
+
+
+class CoverLibrary(Library):
+    ''' A Library whose books have folders with covers in them '''
+
+    def __init__(self, root):
+        Library.__init__(self)
+        self.root = root
+
+    def abspath(self, book_id, index_is_id=False, create_dirs=True):
+        path = os.path.join(self.root, str(book_id))
+        if create_dirs and not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+    def cover(self, book_id, index_is_id=False):
+        path = os.path.join(self.abspath(book_id), 'cover.jpg')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+
+    def set_cover(self, book_id, data):
+        if hasattr(data, 'read'):
+            data = data.read()
+        with open(os.path.join(self.abspath(book_id), 'cover.jpg'), 'wb') as f:
+            f.write(data)
+
+    def remove_cover(self, book_id):
+        os.remove(os.path.join(self.abspath(book_id), 'cover.jpg'))
+
+    def commit(self):
+        pass
+
+
+class GUI(object):
+
+    def __init__(self, db):
+        self.current_db = db
+        self.library_view = self
+
+    def model(self):
+        return self
+
+
+class Response(BytesIO):
+    ''' Just enough of a client response for apply_zip_response '''
+
+    def __init__(self, body, content_type):
+        BytesIO.__init__(self, body)
+        self.content_type = content_type
+
+    def info(self):
+        return self
+
+    def getheader(self, name):
+        return self.content_type
+
+
+class ApplyUpdatesTest(unittest.TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        override_prefs(self, synced_covers={})
+        self.db = CoverLibrary(root)
+        self.db.add_book(1, '10.1')
+        self.db.add_book(2, '20.1')
+        self.db.set_cover(1, b'old cover')
+        indexes = LibraryIndexes(self.db)
+        indexes.load()
+        self.mm = CasanovaMetadataManager(GUI(self.db), indexes)
+        stream = BytesIO()
+        with ZipFile(stream, 'w') as zf:
+            zf.writestr('10.jpg', b'new cover 10')
+            zf.writestr('20.jpg', b'new cover 20')
+            zf.writestr('30.jpg', b'a book not in the library')
+        self.zip = stream.getvalue()
+
+    def test_apply(self):
+        self.mm.handle_zip_of_opf_files(BytesIO(self.zip))
+        self.assertEqual(self.db.cover(1), b'new cover 10')
+        self.assertEqual(self.db.cover(2), b'new cover 20')
+        self.assertEqual(sorted(synced_covers()), ['10', '20'])
+
+    def test_library_changed_in_calibre(self):
+        # Without listeners the index is checked against the library before applying
+        self.db.remove_book(1)
+        self.db.set_casanova(2, '30.1')
+        self.mm.handle_zip_of_opf_files(BytesIO(self.zip))
+        # The deleted book is left alone, and the one identified by hand matched
+        self.assertEqual(self.db.cover(1), b'old cover')
+        self.assertEqual(self.db.cover(2), b'a book not in the library')
+        self.assertEqual(sorted(synced_covers()), ['30'])
+
+    def test_results_per_response(self):
+        result = self.mm.apply_zip_responses([Response(b'No such issue', 'text/plain'),
+                                              Response(self.zip, 'archive/zip')])
+        self.assertEqual(result['messages'], ['Something went wrong :('])
+        self.assertEqual(len(result['results']), 2)
+        self.assertNotIsInstance(result['results'][0], dict)
+        self.assertEqual(result['results'][1], {'added': 0, 'updated': 0})
+
+    def test_rollback_on_abort(self):
+        abort = Event()
+
+        def progress(done, total, force=False):
+            # Abort once both library books have their new cover
+            if done == 2:
+                abort.set()
+
+        with self.assertRaises(Cancelled):
+            self.mm.handle_zip_of_opf_files(BytesIO(self.zip), abort, progress)
+        self.assertEqual(self.db.cover(1), b'old cover')
+        self.assertIsNone(self.db.cover(2))
+        self.assertEqual(synced_covers(), {})
+
+    def test_close_stops_apply(self):
+        errors = []
+
+        def job():
+            try:
+                self.mm.run_apply(self.mm.handle_zip_of_opf_files, (BytesIO(self.zip),), Event())
+            except Cancelled as e:
+                errors.append(e)
+
+        thread = Thread(target=job)
+        thread.start()
+        # The job waits for the GUI thread to set the first cover
+        while not self.mm.calls:
+            time.sleep(0.01)
+        self.mm.close()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+        # What it changed was undone while the library was still open
+        self.assertEqual(self.db.cover(1), b'old cover')
+        self.assertIsNone(self.db.cover(2))
+        self.assertEqual(synced_covers(), {})
+        # and jobs that start later do nothing
+        with self.assertRaises(Cancelled):
+            self.mm.run_apply(self.mm.handle_zip_of_opf_files, (BytesIO(self.zip),), Event())
+        self.assertEqual(self.db.cover(1), b'old cover')
+
+
+if __name__ == '__main__':
+    unittest.main()
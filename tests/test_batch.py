@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from support import override_prefs, start_server
+
+from calibre_plugins.casanova_plugin import client as client_module
+from calibre_plugins.casanova_plugin.batch import Batcher
+from calibre_plugins.casanova_plugin.client import client, HTTPError
+
+
+class BatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        override_prefs(self, cache_ttls={})
+
+    def send(self, ids):
+        with Batcher(client, max_size=10, window=60) as batcher:
+            futures = [batcher.submit({'cmd': 'update_metadata', 'id': i}) for i in ids]
+        return [future.result().read() for future in futures]
+
+    def test_one_request(self):
+        state = start_server(self)
+        self.assertEqual(self.send(['1', '2', '3']),
+                         ['Metadata for %s is up to date' % i for i in '123'])
+        self.assertEqual(state.received.count('batch'), 1)
+        self.assertNotIn('update_metadata', state.received)
+        self.assertEqual(state.stats['batched'], 3)
+
+    def test_errors_per_command(self):
+        start_server(self, unknown=set(['search']))
+        with Batcher(client, max_size=10, window=60) as batcher:
+            ok = batcher.submit({'cmd': 'update_metadata', 'id': '1'})
+            failed = batcher.submit({'cmd': 'search', 'query': 'doe'})
+        self.assertEqual(ok.result().read(), 'Metadata for 1 is up to date')
+        self.assertIsInstance(failed.exception(), HTTPError)
+        self.assertEqual(failed.exception().status, 400)
+
+    def test_server_without_batch(self):
+        state = start_server(self, unknown=set(['batch']))
+        self.assertEqual(len(self.send(['1', '2'])), 2)
+        self.send(['3', '4'])
+        # Batching is not tried again right away
+        self.assertEqual(state.received.count('batch'), 1)
+        self.assertEqual(state.received.count('update_metadata'), 4)
+
+    def test_batch_tried_again_later(self):
+        self.addCleanup(setattr, client_module, 'UNSUPPORTED_RECHECK',
+                        client_module.UNSUPPORTED_RECHECK)
+        client_module.UNSUPPORTED_RECHECK = 0
+        state = start_server(self, unknown=set(['batch']))
+        self.send(['1', '2'])
+        state.unknown = set()
+        self.send(['3', '4'])
+        self.assertEqual(state.received.count('batch'), 2)
+        self.assertEqual(state.stats['batched'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+from support import override_prefs, start_server
+
+from calibre_plugins.casanova_plugin.cache import ResponseCache
+from calibre_plugins.casanova_plugin.client import client, Headers
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = ResponseCache(self.directory, 100)
+        self.headers = Headers([('Content-Type', 'application/json'), ('ETag', '"1"')])
+
+    def test_fresh_and_stale(self):
+        self.cache.store('a', 'search', self.headers, b'{"1": {}}')
+        entry, body, fresh = self.cache.lookup('a', 60)
+        self.assertTrue(fresh)
+        self.assertEqual(body, b'{"1": {}}')
+        self.assertEqual(entry['headers']['etag'], '"1"')
+        self.assertFalse(self.cache.lookup('a', 0)[2])
+        self.assertEqual(self.cache.lookup('b', 60), (None, None, False))
+
+    def test_only_json_is_stored(self):
+        self.cache.store('a', 'search', self.headers, b'<html>Service unavailable</html>')
+        self.assertIsNone(self.cache.lookup('a', 60)[0])
+
+    def test_eviction(self):
+        for key in 'abc':
+            self.cache.store(key, 'search', self.headers, json.dumps('x' * 40))
+        self.assertIsNone(self.cache.lookup('a', 60)[0])
+        self.assertIsNotNone(self.cache.lookup('c', 60)[0])
+        self.assertLessEqual(self.cache.size(), 100)
+
+    def test_invalidate(self):
+        self.cache.store('a', 'search', self.headers, b'[]')
+        self.cache.store('b', 'get_issues', self.headers, b'[]')
+        self.cache.invalidate(('search',))
+        self.assertIsNone(self.cache.lookup('a', 60)[0])
+        self.assertIsNotNone(self.cache.lookup('b', 60)[0])
+
+    def test_saved_index(self):
+        self.cache.store('a', 'search', self.headers, b'[]')
+        self.cache.save()
+        self.assertIsNotNone(ResponseCache(self.directory, 100).lookup('a', 60)[0])
+
+
+class CachedPostTest(unittest.TestCase):
+
+    def test_cached_until_invalidated(self):
+        override_prefs(self, cache_ttls={'search': 60})
+        state = start_server(self)
+        for i in xrange(2):
+            self.assertIn('1', json.loads(client.post({'cmd': 'search', 'query': 'doe'}).read()))
+        self.assertEqual(state.received.count('search'), 1)
+        client.post({'cmd': 'new_text', 'title': 'Another', 'formats': ''})
+        client.post({'cmd': 'search', 'query': 'doe'})
+        self.assertEqual(state.received.count('search'), 2)
+
+    def test_revalidation(self):
+        override_prefs(self, cache_ttls={'search': 0.01})
+        state = start_server(self)
+        client.post({'cmd': 'search', 'query': 'doe'})
+        time.sleep(0.02)
+        self.assertIn('1', json.loads(client.post({'cmd': 'search', 'query': 'doe'}).read()))
+        self.assertEqual(state.stats['not_modified'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import httplib
+import json
+import unittest
+from threading import Event
+
+from support import override_prefs, start_server
+
+from calibre_plugins.casanova_plugin.client import (client, Cancelled, ConnectionPool, Deadline,
+                                                    RequestTimeout, CHUNK_SIZE)
+from calibre_plugins.casanova_plugin.config import prefs
+
+
+class UnreadableBody(object):
+    ''' A request body whose file can not be read part way through '''
+
+    def __len__(self):
+        return 3 * CHUNK_SIZE
+
+    def chunks(self, size):
+        yield b'x' * size
+        raise IOError('The file went away')
+
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+        # Every request goes to the server
+        override_prefs(self, cache_ttls={})
+
+    def post(self, cmd, **values):
+        values['cmd'] = cmd
+        return json.loads(client.post(values).read())
+
+    def test_session_token(self):
+        state = start_server(self)
+        self.assertIn('1', self.post('get_issues'))
+        self.post('search', query='doe')
+        self.assertEqual(state.stats['logins'], 1)
+        # The password is only checked by the login
+        self.assertEqual(state.stats['password_checks'], 1)
+
+    def test_expired_token(self):
+        state = start_server(self)
+        self.post('get_issues')
+        with state.lock:
+            state.tokens.clear()
+        self.post('get_issues')
+        self.assertEqual(state.stats['logins'], 2)
+
+    def test_server_without_login(self):
+        for status in (400, 404, 501):
+            state = start_server(self, unknown=set(['login']), unknown_status=status)
+            self.assertIn('1', self.post('get_issues'))
+            self.post('get_issues')
+            self.assertEqual(state.received, ['login', 'get_issues', 'get_issues'])
+            self.assertEqual(state.stats['password_checks'], 2)
+
+    def test_dropped_connection(self):
+        state = start_server(self)
+        self.post('get_issues')
+        # A read on a kept-alive connection the server dropped is sent again
+        state.drop['get_issues'] = 1
+        self.assertIn('1', self.post('get_issues'))
+        self.assertEqual(state.received.count('get_issues'), 3)
+        # A new_text may already have been acted on, so it is not
+        state.drop['new_text'] = 1
+        self.assertRaises(httplib.HTTPException, self.post, 'new_text', title='Dropped')
+        self.assertEqual(state.received.count('new_text'), 1)
+
+    def test_connection_returned_on_any_error(self):
+        start_server(self)
+        url = prefs['base_url'] + '/api/do'
+        pool = client._pool('http', url.split('/')[2])
+        free = pool._free
+        for i in xrange(free + 1):
+            self.assertRaises(IOError, client._send, 'POST', url, UnreadableBody())
+        self.assertEqual(pool._free, free)
+        self.assertIn('1', self.post('get_issues'))
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_wait_within_deadline(self):
+        pool = ConnectionPool('http', '127.0.0.1', 1, 1)
+        conn, reused = pool.get()
+        self.assertRaises(RequestTimeout, pool.get, Deadline(0.1))
+        abort = Event()
+        abort.set()
+        self.assertRaises(Cancelled, pool.get, Deadline(abort=abort))
+        pool.put(conn, False)
+        conn, reused = pool.get(Deadline(0.1))
+        self.assertFalse(reused)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib
+import os
+import tempfile
+import unittest
+from threading import Event
+
+from support import override_prefs, start_server
+
+from calibre_plugins.casanova_plugin import client as client_module, content
+from calibre_plugins.casanova_plugin.client import Cancelled
+from calibre_plugins.casanova_plugin.content import content_hash, known_content
+
+
+class ContentHashTest(unittest.TestCase):
+
+    def test_hash(self):
+        data = os.urandom(10000)
+        f = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write(data)
+        self.assertEqual(content_hash(f.name), hashlib.sha256(data).hexdigest())
+        # Big files are hashed a block at a time from a memory map
+        for name, value in (('MMAP_THRESHOLD', 1), ('BLOCK_SIZE', 3000)):
+            self.addCleanup(setattr, content, name, getattr(content, name))
+            setattr(content, name, value)
+        content._hashes.clear()
+        self.assertEqual(content_hash(f.name), hashlib.sha256(data).hexdigest())
+
+
+class KnownContentTest(unittest.TestCase):
+
+    def setUp(self):
+        override_prefs(self, cache_ttls={})
+        self.addCleanup(setattr, content, '_unsupported', content._unsupported)
+        content._unsupported = client_module.UnsupportedServers()
+        self.held = hashlib.sha256(b'held').hexdigest()
+        self.other = hashlib.sha256(b'other').hexdigest()
+
+    def test_known(self):
+        state = start_server(self)
+        state.content[self.held] = 4
+        self.assertEqual(known_content([self.held, self.other]), set([self.held]))
+        self.assertEqual(known_content([]), set())
+        self.assertEqual(state.received.count('has_content'), 1)
+
+    def test_server_without_has_content(self):
+        state = start_server(self, unknown=set(['has_content']))
+        self.assertEqual(known_content([self.held]), set())
+        self.assertEqual(known_content([self.held]), set())
+        self.assertEqual(state.received.count('has_content'), 1)
+
+    def test_asked_again_later(self):
+        self.addCleanup(setattr, client_module, 'UNSUPPORTED_RECHECK',
+                        client_module.UNSUPPORTED_RECHECK)
+        client_module.UNSUPPORTED_RECHECK = 0
+        state = start_server(self, unknown=set(['has_content']))
+        known_content([self.held])
+        state.unknown = set()
+        state.content[self.held] = 4
+        self.assertEqual(known_content([self.held]), set([self.held]))
+
+    def test_server_error(self):
+        # A failure says nothing about what the server supports: send in full, ask next time
+        state = start_server(self, unknown=set(['has_content']), unknown_status=500)
+        self.assertEqual(known_content([self.held]), set())
+        self.assertEqual(known_content([self.held]), set())
+        self.assertEqual(state.received.count('has_content'), 2)
+
+    def test_cancelled(self):
+        start_server(self)
+        abort = Event()
+        abort.set()
+        with self.assertRaises(Cancelled):
+            known_content([self.held], abort)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import tempfile
+import unittest
+from threading import current_thread
+
+from support import override_prefs
+
+from calibre_plugins.casanova_plugin import covers as covers_module
+from calibre_plugins.casanova_plugin.covers import CoverPipeline
+
+
+class CoverPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        override_prefs(self, cover_processing=True, cover_workers=2)
+        self.threads = []
+        self.addCleanup(setattr, covers_module, 'save_cover_data_to',
+                        covers_module.save_cover_data_to)
+        covers_module.save_cover_data_to = self.shrink
+        self.pipeline = CoverPipeline()
+        self.addCleanup(self.pipeline.shutdown)
+        self.paths = []
+        for i in xrange(3):
+            f = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
+            self.addCleanup(os.remove, f.name)
+            with f:
+                f.write(os.urandom(2000))
+            self.paths.append(f.name)
+
+    def shrink(self, data, path, minify_to=None, compression_quality=None):
+        ''' Stands in for calibre's image functions: keeps half the data '''
+        self.threads.append(current_thread().name)
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) // 2])
+
+    def test_prepare_on_pool(self):
+        prepared = self.pipeline.prepare(self.paths[0])
+        self.assertNotEqual(prepared, self.paths[0])
+        self.assertEqual(os.path.getsize(prepared), 1000)
+        # Made by a pool thread, not the caller's
+        self.assertTrue(self.threads[0].startswith('CasanovaCovers'))
+        # Only once per session
+        self.assertEqual(self.pipeline.prepare(self.paths[0]), prepared)
+        self.assertEqual(len(self.threads), 1)
+
+    def test_prepare_many(self):
+        prepared = self.pipeline.prepare_many(self.paths + [None])
+        self.assertEqual(sorted(prepared), sorted(self.paths))
+        self.assertTrue(all(t.startswith('CasanovaCovers') for t in self.threads))
+        self.assertEqual(self.pipeline.bytes_saved(), 3000)
+
+    def test_larger_result_not_used(self):
+        covers_module.save_cover_data_to = lambda data, path, **kw: open(path, 'wb').write(data + data)
+        self.assertEqual(self.pipeline.prepare(self.paths[0]), self.paths[0])
+        self.assertEqual(self.pipeline.bytes_saved(), 0)
+
+    def test_not_processing(self):
+        override_prefs(self, cover_processing=False)
+        self.assertEqual(self.pipeline.prepare(self.paths[0]), self.paths[0])
+        self.assertEqual(self.threads, [])
+
+    def test_outputs_removed(self):
+        made = self.pipeline.prepare_many(self.paths).values()
+        self.assertTrue(all(os.path.exists(p) for p in made))
+        self.pipeline.shutdown()
+        self.assertFalse(any(os.path.exists(p) for p in made))
+        # The originals stay
+        self.assertTrue(all(os.path.exists(p) for p in self.paths))
+
+
+if __name__ == '__main__':
+    unittest.main()
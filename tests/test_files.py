@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib
+import os
+import tempfile
+import unittest
+
+from support import override_prefs, start_server
+
+from calibre_plugins.casanova_plugin.client import client
+from calibre_plugins.casanova_plugin.multipart import encoded_files, read_file
+
+
+class FilesTest(unittest.TestCase):
+    ''' Files go as multipart file parts to servers that announce them, base64 fields to others '''
+
+    def setUp(self):
+        override_prefs(self, cache_ttls={})
+        self.data = os.urandom(3000)
+        f = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write(self.data)
+        self.path = f.name
+
+    def commit_cover(self):
+        return client.post({'cmd': 'commit_metadata', 'id': '1', 'opf': '<package/>',
+                            'cover_ext': '.jpg'}, files={'cover': self.path}).read()
+
+    def test_file_parts(self):
+        state = start_server(self)
+        self.assertIn('cover: success', self.commit_cover())
+        self.assertEqual(client.features(), frozenset(['files', 'formats']))
+        self.assertEqual(state.content, {hashlib.sha256(self.data).hexdigest(): 3000})
+
+    def test_server_without_file_parts(self):
+        state = start_server(self, features=[])
+        self.assertIn('cover: success', self.commit_cover())
+        self.assertEqual(client.features(), frozenset())
+        self.assertEqual(state.content, {hashlib.sha256(self.data).hexdigest(): 3000})
+        self.assertEqual(state.stats['files'], 1)
+
+    def test_server_without_login(self):
+        # Servers from before login announce nothing, so get base64 fields
+        state = start_server(self, features=[], unknown=set(['login']))
+        self.assertIn('cover: success', self.commit_cover())
+        self.assertEqual(state.content, {hashlib.sha256(self.data).hexdigest(): 3000})
+
+    def test_encoded_files(self):
+        self.assertEqual(read_file((self.path, 1000, 10)), self.data[1000:1010])
+        self.assertEqual(encoded_files({'cover': self.path})['cover'].decode('base64'), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import sqlite3
+import unittest
+from threading import Thread
+
+from support import Library
+
+from calibre_plugins.casanova_plugin import index
+from calibre_plugins.casanova_plugin.index import (CasanovaBookIndex, CasanovaIssueIndex,
+                                                   LibraryIndexes)
+
+
+class BookIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Library()
+        self.db.add_book(1, '10.1')
+        self.db.add_book(2, '20.3')
+        self.db.add_book(3, 'abc.1')
+        self.db.add_book(4)
+
+    def test_build(self):
+        book_map = CasanovaBookIndex(self.db)
+        self.assertEqual(len(book_map), 3)
+        self.assertEqual(book_map['10'], 1)
+        self.assertEqual(book_map.get('abc'), 3)
+        self.assertNotIn('30', book_map)
+        self.assertEqual(book_map.identifier(2), '20.3')
+        self.assertEqual(book_map.casanova_id(3), 'abc')
+        self.assertIsNone(book_map.identifier(4))
+        self.assertEqual(sorted(book_map.identifiers()), ['10.1', '20.3', 'abc.1'])
+
+    def test_shared_casanova_id(self):
+        self.db.add_book(5, '10.2')
+        book_map = CasanovaBookIndex(self.db)
+        # The highest book id wins, and the id stays mapped while any book has it
+        self.assertEqual(book_map['10'], 5)
+        book_map.set_identifier(5, None)
+        self.assertEqual(book_map['10'], 1)
+        book_map.set_identifier(5, '10.2')
+        book_map.remove_books([1])
+        self.assertEqual(book_map['10'], 5)
+        book_map.remove_books([5])
+        self.assertNotIn('10', book_map)
+
+    def test_shared_other_id(self):
+        self.db.add_book(5, 'abc.2')
+        book_map = CasanovaBookIndex(self.db)
+        self.assertEqual(book_map['abc'], 5)
+        book_map.remove_books([5])
+        self.assertEqual(book_map['abc'], 3)
+
+    def test_bulk_changes_match_rebuild(self):
+        book_map = CasanovaBookIndex(self.db)
+        count = index.BULK_CHANGE * 3
+        for book_id in xrange(10, 10 + count):
+            self.db.add_book(book_id, '%d.1' % (book_id % 7 + 100))
+        book_map.refresh_books(xrange(10, 10 + count))
+        removed = range(10, 10 + count, 2)
+        for book_id in removed:
+            self.db.remove_book(book_id)
+        book_map.remove_books(removed)
+        fresh = CasanovaBookIndex(self.db)
+        self.assertEqual(book_map.snapshot(), fresh.snapshot())
+        self.assertEqual(sorted(book_map.identifiers()), sorted(fresh.identifiers()))
+
+    def test_snapshot_round_trip(self):
+        book_map = CasanovaBookIndex(self.db)
+        restored = CasanovaBookIndex(self.db, build=False)
+        self.assertTrue(restored.restore(book_map.snapshot()))
+        self.assertEqual(restored.snapshot(), book_map.snapshot())
+        self.assertEqual(restored['abc'], 3)
+
+    def test_reconcile(self):
+        book_map = CasanovaBookIndex(self.db)
+        since = self.db.last_modified()
+        self.db.remove_book(1)
+        self.db.add_book(6, '60.1')
+        self.db.set_casanova(2, '21.1')
+        book_map.reconcile(since.isoformat())
+        self.assertEqual(sorted(book_map.identifiers()), ['21.1', '60.1', 'abc.1'])
+
+    def test_concurrent_changes(self):
+        book_map = CasanovaBookIndex(self.db)
+
+        def change(start):
+            for book_id in xrange(start, start + 200):
+                book_map.set_identifier(book_id, '%d.1' % book_id)
+            book_map.remove_books(xrange(start, start + 200, 2))
+        threads = [Thread(target=change, args=(n * 1000,)) for n in xrange(1, 5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(book_map), 3 + 4 * 100)
+        self.assertEqual(book_map['1001'], 1001)
+        self.assertNotIn('1000', book_map)
+
+
+class IssueIndexTest(unittest.TestCase):
+
+    def test_issues(self):
+        db = Library()
+        db.add_book(1, issues=[(7, 'Spring')])
+        db.add_book(2, issues=[(7, 'Spring'), (8, 'Summer')])
+        issue_map = CasanovaIssueIndex(db)
+        self.assertEqual(dict((k, v.strip()) for k, v in issue_map.issues().items()),
+                         {'7': 'Spring', '8': 'Summer'})
+        self.assertEqual(issue_map.book_ids('7'), set([1, 2]))
+        issue_map.remove_books([2])
+        self.assertEqual(issue_map.book_ids('7'), set([1]))
+        issue_map.refresh_books([2])
+        self.assertEqual(issue_map.book_ids('8'), set([2]))
+
+
+class LibraryIndexesTest(unittest.TestCase):
+
+    def test_failed_load_is_rebuilt(self):
+        db = Library()
+        db.add_book(1, '10.1')
+        get = db.conn.get
+
+        def locked(*args, **kwargs):
+            raise sqlite3.OperationalError('database is locked')
+        db.conn.get = locked
+        indexes = LibraryIndexes(db)
+        indexes.load()
+        self.assertTrue(indexes.ready.is_set())
+        self.assertIsNotNone(indexes.error)
+        db.conn.get = get
+        self.assertEqual(indexes.wait().book_map['10'], 1)
+        self.assertIsNone(indexes.error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+from support import override_prefs, start_server
+
+from calibre_plugins.casanova_plugin import resumable
+from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.resumable import (ResumableUpload, UnsupportedServer,
+                                                       send_all)
+
+
+class SlowPrefs(object):
+    ''' The plugin prefs, read back as slowly as from a busy disk '''
+
+    def __getitem__(self, key):
+        value = prefs[key]
+        time.sleep(0.01)
+        return value
+
+    def __setitem__(self, key, value):
+        prefs[key] = value
+
+    def __getattr__(self, name):
+        return getattr(prefs, name)
+
+
+class ResumableUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        override_prefs(self, cache_ttls={}, upload_sessions={}, upload_chunk_size=1000,
+                       upload_parallel_chunks=3,
+                       priority_limits={'interactive': 4, 'normal': 3, 'bulk': 2})
+        self.data = os.urandom(5500)
+        f = tempfile.NamedTemporaryFile(suffix='.epub', delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write(self.data)
+        self.path = f.name
+
+    def received(self, state, session):
+        upload = state.uploads[session]
+        return b''.join(upload['chunks'][i] for i in sorted(upload['chunks']))
+
+    def test_upload(self):
+        state = start_server(self)
+        session = ResumableUpload(self.path).run()
+        self.assertEqual(self.received(state, session), self.data)
+        self.assertEqual(state.received.count('upload_chunk'), 6)
+
+    def test_parallel_chunks(self):
+        # Every chunk upload_parallel_chunks allows is in flight, whatever the bulk limit
+        state = start_server(self, delay={'upload_chunk': 0.2})
+        session = ResumableUpload(self.path).run()
+        self.assertEqual(self.received(state, session), self.data)
+        self.assertEqual(state.peak['upload_chunk'], 3)
+
+    def test_resume(self):
+        state = start_server(self)
+        upload = ResumableUpload(self.path)
+        upload.start()
+        # Only some of the chunks get through the first time
+        upload.missing = upload.missing[:2]
+        self.assertEqual(send_all([upload]), {})
+        again = ResumableUpload(self.path)
+        again.start()
+        self.assertEqual(again.session, upload.session)
+        self.assertEqual(again.missing, [2, 3, 4, 5])
+        self.assertEqual(send_all([again]), {})
+        self.assertEqual(self.received(state, again.session), self.data)
+
+    def test_unsupported_server(self):
+        for status in (400, 404, 501, 200):
+            # An older server answers upload_start as an unknown command,
+            # which for some is a page with a 200 status
+            start_server(self, unknown=set(['upload_start']), unknown_status=status)
+            with self.assertRaises(UnsupportedServer):
+                ResumableUpload(self.path).start()
+
+    def test_failed_chunk(self):
+        start_server(self, unknown=set(['upload_chunk']), unknown_status=403)
+        upload = ResumableUpload(self.path)
+        upload.start()
+        errors = send_all([upload])
+        self.assertEqual(errors.keys(), [upload])
+
+    def test_sessions_saved_together(self):
+        # Uploads running at once each keep their session
+        self.addCleanup(setattr, resumable, 'prefs', resumable.prefs)
+        resumable.prefs = SlowPrefs()
+        uploads = [ResumableUpload(self.path, key='file %d' % i) for i in xrange(10)]
+        for session in ('session', None):
+            threads = [Thread(target=upload._remember, args=(session,)) for upload in uploads]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(prefs['upload_sessions']), 10 if session else 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
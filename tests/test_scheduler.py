@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+import unittest
+
+from support import override_prefs
+
+from calibre_plugins.casanova_plugin.client import Deadline, RequestTimeout
+from calibre_plugins.casanova_plugin.scheduler import (Scheduler, TokenBucket, transfer_connections,
+                                                       INTERACTIVE, NORMAL, BULK)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        override_prefs(self, connection_pool_size=4,
+                       priority_limits={'interactive': 4, 'normal': 3, 'bulk': 2},
+                       transfer_concurrency={'download': {'min': 1, 'max': 6},
+                                             'upload': {'min': 1, 'max': 3}},
+                       upload_parallel_chunks=3)
+        self.scheduler = Scheduler()
+
+    def blocked(self, priority):
+        try:
+            self.scheduler.acquire(priority, Deadline(0.1))
+        except RequestTimeout:
+            return True
+        self.scheduler.release(priority)
+        return False
+
+    def test_class_limit(self):
+        for i in xrange(2):
+            self.scheduler.acquire(BULK)
+        self.assertTrue(self.blocked(BULK))
+        self.assertFalse(self.blocked(INTERACTIVE))
+        self.scheduler.release(BULK)
+        self.assertFalse(self.blocked(BULK))
+
+    def test_transfers_outside_limits(self):
+        # Every download and chunk the transfer_concurrency bounds allow can run at once
+        for i in xrange(transfer_connections()):
+            self.scheduler.acquire(BULK, Deadline(0.1), transfer=True)
+        self.assertEqual(self.scheduler.transfers, 15)
+        # and bulk and interactive requests still have their slots
+        self.assertFalse(self.blocked(BULK))
+        self.assertFalse(self.blocked(INTERACTIVE))
+        for i in xrange(transfer_connections()):
+            self.scheduler.release(BULK, transfer=True)
+        self.assertEqual(self.scheduler.transfers, 0)
+
+    def test_transfer_connections(self):
+        self.assertEqual(transfer_connections(), 6 + 3 * 3)
+        override_prefs(self, upload_parallel_chunks=0)
+        self.assertEqual(transfer_connections(), 6 + 3)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        override_prefs(self, bandwidth_limit=32)
+        self.bucket = TokenBucket()
+
+    def test_chunk_larger_than_rate(self):
+        # Two seconds of refill at 32 KB/s are enough for a 64 KB chunk
+        self.bucket._stamp -= 2
+        self.bucket.consume(64 * 1024, NORMAL, Deadline(1))
+        self.assertLess(self.bucket._tokens, 1024)
+
+    def test_wait(self):
+        self.bucket._stamp -= 0.5
+        start = time.time()
+        self.bucket.consume(32 * 1024, BULK, Deadline(2))
+        self.assertGreater(time.time() - start, 0.3)
+
+    def test_interactive_runs_into_debt(self):
+        self.bucket.consume(64 * 1024, INTERACTIVE, Deadline(0.1))
+        with self.assertRaises(RequestTimeout):
+            self.bucket.consume(1024, NORMAL, Deadline(0.3))
+
+
+if __name__ == '__main__':
+    unittest.main()
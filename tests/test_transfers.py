@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import unittest
+
+from support import override_prefs
+
+from calibre_plugins.casanova_plugin.client import HTTPError
+from calibre_plugins.casanova_plugin.transfers import AdaptiveLimit, PROBE_INTERVAL
+
+
+class Clock(object):
+    ''' Time that only moves when the test says so '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        override_prefs(self, transfer_concurrency={'download': {'min': 1, 'max': 4},
+                                                   'upload': {'min': 1, 'max': 3}})
+        self.clock = Clock()
+        self.limit = AdaptiveLimit('download', self.clock)
+
+    def round(self, count, seconds, nbytes, error=None):
+        ''' Runs count transfers together for seconds, each moving nbytes '''
+        started = [self.limit.acquire() for i in xrange(count)]
+        self.clock.now += seconds
+        for start in started:
+            self.limit.release(start, nbytes, error)
+
+    def test_increase_while_throughput_grows(self):
+        self.assertEqual(self.limit.limit, 1)
+        self.round(1, 1, 100)
+        self.assertEqual(self.limit.limit, 2)
+        self.round(2, 1, 300)
+        self.assertEqual(self.limit.limit, 3)
+        # A third transfer adds nothing, so the limit goes back and holds
+        self.round(3, 1, 200)
+        self.assertEqual(self.limit.limit, 2)
+        for i in xrange(PROBE_INTERVAL - 1):
+            self.round(2, 1, 300)
+            self.assertEqual(self.limit.limit, 2)
+        self.round(2, 1, 300)
+        self.assertEqual(self.limit.limit, 3)
+
+    def test_no_probe_without_demand(self):
+        self.round(1, 1, 100)
+        self.assertEqual(self.limit.limit, 2)
+        # One transfer at a time never fills two slots
+        for i in xrange(4):
+            self.round(1, 1, 1000)
+        self.assertEqual(self.limit.limit, 2)
+
+    def test_cap(self):
+        self.limit.jobs = 2
+        for i in xrange(4):
+            self.round(self.limit.limit, 1, 1000 * 2 ** i)
+        self.assertEqual(self.limit.limit, 2)
+
+    def test_decrease_on_congestion(self):
+        self.limit.limit = 4
+        started = [self.limit.acquire() for i in xrange(4)]
+        self.clock.now += 1
+        self.limit.release(started.pop(), 0, HTTPError('url', 503, 'Busy'))
+        self.assertEqual(self.limit.limit, 2)
+        self.limit.release(started.pop(), 0, HTTPError('url', 429, 'Too many'))
+        self.assertEqual(self.limit.limit, 1)
+        # Errors that say nothing about load leave the limit alone
+        self.limit.limit = 4
+        self.limit.release(started.pop(), 0, HTTPError('url', 404, 'Not found'))
+        self.assertEqual(self.limit.limit, 4)
+
+    def test_decrease_from_what_ran(self):
+        self.limit.limit = 4
+        start = self.limit.acquire()
+        self.clock.now += 1
+        # Only one transfer was running, so there is nothing to halve
+        self.limit.release(start, 0, HTTPError('url', 503, 'Busy'))
+        self.assertEqual(self.limit.limit, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from support import override_prefs, start_server
+
+from calibre_plugins.casanova_plugin import content
+from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.upload import CasanovaAdder
+
+
+class Adder(CasanovaAdder):
+    ''' Answers new_text with a canned answer instead of asking the server '''
+
+    def __init__(self, answer):
+        self.answer = answer
+
+    def _post(self, values, path='/api/do', abort=None, progress=None, files=None, transfer=False):
+        return BytesIO(json.dumps(self.answer))
+
+
+class CopyCountingAdder(CasanovaAdder):
+    ''' Records the library files copied to be sent '''
+
+    def __init__(self):
+        self.copied = []
+
+    def _copy(self, path, tdir):
+        self.copied.append(path)
+        return CasanovaAdder._copy(self, path, tdir)
+
+
+class CasanovaAdderTest(unittest.TestCase):
+
+    def setUp(self):
+        override_prefs(self, cache_ttls={}, upload_sessions={}, cover_processing=False,
+                       chunked_upload_threshold=1024 * 1024)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.formats = {}
+        for fmt in ('pdf', 'epub'):
+            self.formats[fmt] = os.path.join(root, 'text.' + fmt)
+            with open(self.formats[fmt], 'wb') as f:
+                f.write(os.urandom(2000))
+
+    def add(self, adder=None):
+        return (adder or CasanovaAdder())(None, 'A text', 'Doe, Jane', '', '', '', '<package/>',
+                                          self.formats, None, 1)
+
+    def stored(self, *fmts):
+        ''' What the server should hold once these formats were added '''
+        ret = {}
+        for fmt in fmts:
+            with open(self.formats[fmt], 'rb') as f:
+                ret[hashlib.sha256(f.read()).hexdigest()] = 2000
+        return ret
+
+    def test_formats(self):
+        state = start_server(self)
+        result = self.add()
+        self.assertEqual(result, {'casanova_id': '2', 'formats': {'epub': 'success', 'pdf': 'success'}})
+        self.assertEqual(state.content, self.stored('epub', 'pdf'))
+
+    def test_held_format_not_copied(self):
+        state = start_server(self)
+        state.content.update(self.stored('epub'))
+        adder = CopyCountingAdder()
+        result = self.add(adder)
+        self.assertEqual(result['formats'], {'epub': 'success', 'pdf': 'success'})
+        self.assertEqual(adder.copied, [self.formats['pdf']])
+        # Hashed where they are, so the next add of the same files reads neither again
+        hashed = set(key[0] for key in content._hashes)
+        self.assertTrue(set(os.path.abspath(path) for path in self.formats.values()) <= hashed)
+
+    def test_chunked_formats(self):
+        override_prefs(self, chunked_upload_threshold=1000, upload_chunk_size=500)
+        state = start_server(self)
+        result = self.add()
+        self.assertEqual(result['formats'], {'epub': 'success', 'pdf': 'success'})
+        self.assertEqual(state.content, self.stored('epub', 'pdf'))
+        self.assertEqual(state.stats['chunks'], 8)
+        # Done with, so not kept to be resumed
+        self.assertEqual(prefs['upload_sessions'], {})
+
+    def test_unlisted_format(self):
+        start_server(self)
+        # A format the answer does not list was not added, whatever the overall status
+        result = self.add(Adder({'status': 'success', 'casanova_id': '7',
+                                 'formats': {'epub': 'success'}}))
+        self.assertEqual(result['casanova_id'], '7')
+        self.assertEqual(result['formats']['epub'], 'success')
+        self.assertNotEqual(result['formats']['pdf'], 'success')
+        result = self.add(Adder({'status': 'success', 'casanova_id': '7'}))
+        self.assertNotIn('success', result['formats'].values())
+
+    def test_server_without_formats(self):
+        for features in (['files'], []):
+            state = start_server(self, features=features)
+            result = self.add()
+            # Only the format calibre prefers goes, in the text field
+            self.assertEqual(result['casanova_id'], '2')
+            self.assertEqual(result['formats']['epub'], 'success')
+            self.assertNotEqual(result['formats']['pdf'], 'success')
+            self.assertEqual(state.content, self.stored('epub'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL 3'
+__copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
+__docformat__ = 'restructuredtext en'
+
+import socket
+import time
+from collections import deque
+from threading import Condition, Lock
+
+from calibre import human_readable
+
+from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.client import Cancelled, HTTPError, RequestTimeout
+
+# A round's throughput must beat the last one's by this much for the extra
+# transfer added before it to count as a gain
+GAIN = 1.1
+# Rounds to wait, after more transfers turned out not to help, before trying again
+PROBE_INTERVAL = 5
+
+
+def is_congestion(error):
+    ''' Whether a failed transfer suggests the link or the server is overloaded '''
+    if isinstance(error, HTTPError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, (RequestTimeout, socket.error))
+
+
+class Slot(object):
+    ''' One running transfer; set ``bytes`` to the amount it moved '''
+
+    def __init__(self, limit, abort):
+        self.limit = limit
+        self.abort = abort
+        self.bytes = 0
+
+    def __enter__(self):
+        self.started = self.limit.acquire(self.abort)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.limit.release(self.started, self.bytes, exc)
+
+
+class AdaptiveLimit(object):
+    '''
+    The number of transfers of one kind (downloads or uploads) that run at
+    once, tuned to what the link and the server can take. It grows by one
+    while each added transfer raises the total throughput, drops back by
+    one when it does not, and halves when transfers time out or the server
+    reports it is overloaded (additive increase, multiplicative decrease).
+    It stays within the bounds in the transfer_concurrency pref, and never
+    grows past cap(), the most transfers that can really run at once.
+
+    Throughput is measured per round, a round being as many completed
+    transfers as the limit, over the time transfers were actually running
+    (by clock, time.time unless given).
+    '''
+
+    def __init__(self, kind, clock=time.time):
+        self.kind = kind
+        self.clock = clock
+        self._cond = Condition(Lock())
+        # The max_concurrent_count of the jobs running these transfers
+        self.jobs = None
+        self.limit = self.bounds()[0]
+        self.running = 0
+        self.waiting = 0
+        # (time, limit, bytes/s, mean seconds per transfer, reason) per change
+        self.history = deque(maxlen=50)
+        self.rate = None
+        self._last_change = None
+        self._hold = 0
+        self._reset_round()
+
+    def bounds(self):
+        bounds = prefs['transfer_concurrency'][self.kind]
+        return max(1, bounds['min']), max(1, bounds['min'], bounds['max'])
+
+    def job_limit(self):
+        ''' The max_concurrent_count to start the jobs running these transfers with '''
+        self.jobs = self.bounds()[1]
+        return self.jobs
+
+    def cap(self):
+        '''
+        The most transfers that can run at once: the upper bound, or fewer
+        if the jobs already started were allowed fewer at a time
+        '''
+        high = self.bounds()[1]
+        return high if self.jobs is None else max(self.bounds()[0], min(high, self.jobs))
+
+    def _reset_round(self):
+        self._done = 0
+        self._bytes = 0
+        self._seconds = 0.0
+        self._busy = 0.0
+        self._saturated = False
+        self._stamp = self.clock()
+
+    def _tick(self):
+        now = self.clock()
+        if self.running:
+            self._busy += now - self._stamp
+        self._stamp = now
+
+    def slot(self, abort=None):
+        ''' A context manager holding one transfer slot '''
+        return Slot(self, abort)
+
+    def acquire(self, abort=None):
+        ''' Waits for a free slot, returning the time the transfer started '''
+        with self._cond:
+            self.waiting += 1
+            try:
+                while self.running >= self.limit:
+                    self._saturated = True
+                    if abort is not None and abort.is_set():
+                        raise Cancelled('Cancelled waiting for a free %s slot' % self.kind)
+                    self._cond.wait(0.25)
+            finally:
+                self.waiting -= 1
+            self._tick()
+            self.running += 1
+            if self.running >= self.limit:
+                self._saturated = True
+            return self.clock()
+
+    def release(self, started, nbytes=0, error=None):
+        ''' Frees a slot and feeds the transfer's outcome to the controller '''
+        with self._cond:
+            self._tick()
+            self.running -= 1
+            if error is None:
+                self._done += 1
+                self._bytes += nbytes
+                self._seconds += self.clock() - started
+                if self._done >= self.limit:
+                    self._end_round()
+            elif is_congestion(error):
+                # Halve what was really running, which can be less than the limit
+                running = min(self.limit, self.running + 1, self.cap())
+                self._change(max(self.bounds()[0], running // 2), None, 'failure: %s' % error)
+                self.rate = None
+                self._reset_round()
+            self._cond.notify_all()
+
+    def _end_round(self):
+        low, high = self.bounds()[0], self.cap()
+        rate = self._bytes / self._busy if self._busy > 0 else None
+        mean = self._seconds / self._done
+        previous, saturated = self.rate, self._saturated
+        self.rate = rate
+        self._reset_round()
+        if self._hold:
+            self._hold -= 1
+        if rate is None:
+            return
+        if self._last_change == 'increase' and previous is not None and rate < previous * GAIN:
+            self._change(self.limit - 1, rate, 'no gain from %d transfers' % self.limit, mean)
+            self._hold = PROBE_INTERVAL
+        elif not low <= self.limit <= high:
+            self._change(min(max(self.limit, low), high), rate, 'bounds changed', mean)
+        elif saturated and not self._hold and self.limit < high:
+            self._change(self.limit + 1, rate, 'probing', mean)
+            self._last_change = 'increase'
+        else:
+            self._last_change = None
+
+    def _change(self, limit, rate, reason, mean=None):
+        self._last_change = 'decrease' if limit < self.limit else None
+        self.limit = limit
+        self.history.append((self.clock(), limit, rate, mean, reason))
+
+    def stats_summary(self):
+        with self._cond:
+            lines = ['Casanova %ss: %d at once (bounds %d-%d), %d running, %d waiting' % (
+                self.kind, self.limit, self.bounds()[0], self.cap(), self.running, self.waiting)]
+            for stamp, limit, rate, mean, reason in self.history:
+                lines.append('  %s -> %d (%s%s): %s' % (
+                    time.strftime('%H:%M:%S', time.localtime(stamp)), limit,
+                    human_readable(rate) + '/s' if rate else 'no rate',
+                    ', %.1fs per transfer' % mean if mean else '', reason))
+            return '\n'.join(lines)
+
+
+# The limits shared by all of the plugin's download and upload jobs
+downloads = AdaptiveLimit('download')
+uploads = AdaptiveLimit('upload')
@@ -7,13 +7,16 @@ __license__ = 'GPL 3'
 __copyright__ = '2014, Alex Kosloff <pisatel1976@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
+import sys
+import time
+import traceback
 from functools import partial
+from importlib import import_module
 from PyQt4.Qt import QMenu, QToolButton, QUrl
-from calibre.gui2 import error_dialog, question_dialog, info_dialog, open_url
+from calibre.gui2 import error_dialog, question_dialog, info_dialog, open_url, Dispatcher
 from calibre.gui2.actions import InterfaceAction
 from calibre.utils.config import config_dir
 
-from calibre.gui2.tag_browser.view import TagsView
 # The class that all interface action plugins must inherit from
 from calibre.gui2.actions import InterfaceAction
 #from calibre_plugins.casanova_plugin.main import DemoDialog
@@ -21,14 +24,26 @@ from calibre_plugins.casanova_plugin.config import prefs
 from calibre_plugins.casanova_plugin.utils import (set_plugin_icon_resources, get_icon,
                                                          create_menu_action_unique)
 
-from calibre_plugins.casanova_plugin.download import CasanovaDownloadManager
-from calibre_plugins.casanova_plugin.upload import CasanovaAddManager
-from calibre_plugins.casanova_plugin.metadata import CasanovaMetadataManager
-from calibre_plugins.casanova_plugin.dialogs import ChooseIssuesToUpdateDialog, ChooseAuthorsToUpdateDialog, ChooseFormatToDownloadDialog, SearchDialog, AddBookDialog
-
 
 PLUGIN_ICONS = ['images/icon.png']
 
+# (module name, milliseconds) for each plugin module imported on demand
+import_times = []
+
+
+def load_plugin_module(name):
+    '''
+    Imports one of the plugin's modules the first time it is needed, so that
+    loading the plugin adds next to nothing to calibre's startup time.
+    '''
+    full_name = 'calibre_plugins.casanova_plugin.' + name
+    if full_name not in sys.modules:
+        start = time.time()
+        import_module(full_name)
+        import_times.append((name, (time.time() - start) * 1000))
+    return sys.modules[full_name]
+
+
 class CasanovaUI(InterfaceAction):
 
     name = "Casanova"
@@ -49,50 +64,198 @@ class CasanovaUI(InterfaceAction):
 
     def initialization_complete(self):
         ''' An InterfaceAction method '''
-        # @todo : create Casanova managers here
-        self.mm = CasanovaMetadataManager(self.gui)
-        self.dm = CasanovaDownloadManager(self.gui, self.mm)
-        self.am = CasanovaAddManager(self.gui)
+        self._mm = self._dm = self._am = None
+        self._selection = None
+        # Network calls whose results have not been applied yet
+        self._network_calls = set()
+        # Apply jobs started for the current library
+        self._apply_jobs = set()
+        self.start_indexes()
+        if not prefs['lazy_startup']:
+            self.create_managers()
         self.rebuild_menus()
+        self.gui.library_view.selectionModel().selectionChanged.connect(self.selection_changed)
+        self.gui.library_view.model().modelReset.connect(self.selection_changed)
+
+    def library_changed(self, db):
+        ''' An InterfaceAction method, called when the user switches libraries '''
+        if getattr(self, 'indexes', None) is None:
+            return
+        # Results fetched for the old library must not be applied to the new one
+        for future in list(self._network_calls):
+            future.cancel()
+        # and apply jobs still running are stopped, and what they changed
+        # undone, while the old library is open
+        if self._mm is not None:
+            self._mm.close()
+        self._apply_jobs.clear()
+        self.indexes.close()
+        self._mm = self._dm = self._am = None
+        self.start_indexes()
+        self.selection_changed()
+
+    def shutting_down(self):
+        ''' An InterfaceAction method '''
+        if getattr(self, 'indexes', None) is not None:
+            self.indexes.save_snapshot()
+        if prefs['log_statistics']:
+            self.log_statistics()
+        client = sys.modules.get('calibre_plugins.casanova_plugin.client')
+        if client is not None:
+            client.client.close()
+        covers = sys.modules.get('calibre_plugins.casanova_plugin.covers')
+        if covers is not None:
+            covers.covers.shutdown()
+        resumable = sys.modules.get('calibre_plugins.casanova_plugin.resumable')
+        if resumable is not None:
+            resumable.chunk_pool.shutdown()
+        engine = sys.modules.get('calibre_plugins.casanova_plugin.engine')
+        if engine is not None:
+            engine.engine.shutdown()
+        return True
+
+    def log_statistics(self):
+        ''' Prints what the session's network traffic, caching and transfers came to '''
+        client = sys.modules.get('calibre_plugins.casanova_plugin.client')
+        if client is not None:
+            print(client.client.cache.stats_summary())
+            flights = client.client.flights
+            print('Casanova requests: %d sent, %d coalesced with one already in flight' % (
+                flights.calls, flights.coalesced))
+            for cmd in sorted(client.client.transfer_stats):
+                print(client.client.stats_summary(cmd))
+            print(sys.modules['calibre_plugins.casanova_plugin.scheduler'].scheduler.stats_summary())
+        covers = sys.modules.get('calibre_plugins.casanova_plugin.covers')
+        if covers is not None:
+            print(covers.covers.stats_summary())
+        transfers = sys.modules.get('calibre_plugins.casanova_plugin.transfers')
+        if transfers is not None:
+            print(transfers.downloads.stats_summary())
+            print(transfers.uploads.stats_summary())
+
+    def start_indexes(self):
+        ''' Loads the current library's indexes, in the background unless lazy startup is off '''
+        index = load_plugin_module('index')
+        self.indexes = index.LibraryIndexes(self.gui.current_db)
+        if prefs['lazy_startup']:
+            self.indexes.start(Dispatcher(self.indexes_ready))
+        else:
+            self.indexes.load()
+
+    def indexes_ready(self):
+        ''' Called in the GUI thread once the background index load has finished '''
+        if self.indexes.error is not None:
+            try:
+                self.indexes.recover()
+            except Exception:
+                traceback.print_exc()
+        self.selection_changed()
+
+    def create_managers(self):
+        ''' Creates the Casanova managers for the current library '''
+        metadata = load_plugin_module('metadata')
+        download = load_plugin_module('download')
+        upload = load_plugin_module('upload')
+        self._mm = metadata.CasanovaMetadataManager(self.gui, self.indexes)
+        self._dm = download.CasanovaDownloadManager(self.gui, self._mm)
+        self._am = upload.CasanovaAddManager(self.gui, self._mm)
+        print('Casanova import times: ' + ', '.join(
+            '%s %.1f ms' % (name, ms) for name, ms in import_times))
+
+    @property
+    def mm(self):
+        if self._mm is None:
+            self.create_managers()
+        return self._mm
+
+    @property
+    def dm(self):
+        if self._dm is None:
+            self.create_managers()
+        return self._dm
+
+    @property
+    def am(self):
+        if self._am is None:
+            self.create_managers()
+        return self._am
 
 
     def about_to_show_menu(self):
         ''' Just before the menu is displayed '''
+        if not self.indexes.ready.is_set():
+            # Everything but the settings needs the indexes, which are still loading
+            for name in ('casanova_book_submenu', 'author_menu_item', 'add_new_menu_item',
+                         'casanova_issue_submenu'):
+                if hasattr(self, name):
+                    getattr(self, name).setEnabled(False)
+            return
+        if hasattr(self, 'casanova_issue_submenu'):
+            self.casanova_issue_submenu.setEnabled(True)
+        book_map = self.indexes.book_map
+        if book_map is not None and not book_map.listening:
+            # Without database listeners the index does not see identifier
+            # changes made outside the plugin, so look at the selection again
+            self._selection = None
         if hasattr(self, 'casanova_book_submenu'):
-            selected_linked = self.is_one_casanova_book_selected()
+            selected_linked = bool(self.get_selection_state()['linked'])
             self.casanova_book_submenu.setEnabled(selected_linked)
         if hasattr(self, 'author_menu_item'):
             author_selected_linked = self.is_one_casanova_book_selected(include_non_casanova=True)
             self.author_menu_item.setEnabled(author_selected_linked)
         if hasattr(self, 'add_new_menu_item'):
-            add_selected_linked = self.is_one_casanova_book_selected(only_non_casanova=True)
-            self.add_new_menu_item.setEnabled(add_selected_linked)
+            self.add_new_menu_item.setEnabled(bool(self.get_unlinked_selected_ids()))
         #if hasattr(self, 'casanova_issue_submenu'):
         #    selected_linked = self.is_no_books_selected()
         #    self.casanova_issue_submenu.setEnabled(selected_linked)
 
 
+    def selection_changed(self, *args):
+        ''' Forgets the cached selection state, it is worked out again when next needed '''
+        self._selection = None
+
+    def get_selection_state(self):
+        '''
+        The selected book ids and the casanova identifiers of the linked ones.
+        This is computed from the identifier index once per selection change
+        (or index change), so menus and actions do not touch the database.
+        Nothing counts as selected until the index has loaded.
+        '''
+        if not self.indexes.ready.is_set():
+            self.gui.status_bar.show_message(_('Casanova is still loading its index...'), 3000)
+            return {'generation': None, 'book_ids': [], 'linked': []}
+        book_map = self.indexes.wait().book_map
+        if self._selection is None or self._selection['generation'] != book_map.generation:
+            db = self.gui.current_db
+            rows = self.gui.library_view.selectionModel().selectedRows()
+            book_ids = [db.id(row.row()) for row in rows]
+            if not book_map.listening:
+                book_map.refresh_books(book_ids)
+            linked = []
+            for book_id in book_ids:
+                identifier = book_map.identifier(book_id)
+                if identifier:
+                    linked.append((book_id, identifier))
+            self._selection = {'generation': book_map.generation,
+                               'book_ids': book_ids, 'linked': linked}
+        return self._selection
+
+    def get_unlinked_selected_ids(self):
+        ''' The selected books that are not on Casanova yet '''
+        state = self.get_selection_state()
+        linked = set(book_id for book_id, identifier in state['linked'])
+        return [book_id for book_id in state['book_ids'] if book_id not in linked]
+
     def is_one_casanova_book_selected(self, include_non_casanova=False, only_non_casanova=False):
         ''' Checks that there is one and only one casanova book selected (for updating, etc) '''
-        db = self.gui.current_db
-        rows = self.gui.library_view.selectionModel().selectedRows()
-        if not rows or len(rows) != 1:
+        state = self.get_selection_state()
+        if len(state['book_ids']) != 1:
             return False
+        if include_non_casanova and not only_non_casanova:
+            return True
         if only_non_casanova:
-            for row in rows:
-                calibre_id = db.id(row.row())
-                mi = db.get_metadata(calibre_id, index_is_id=True)
-                if not mi.has_identifier('casanova'):
-                    return True
-        else:
-            if include_non_casanova:
-                return True
-            for row in rows:
-                calibre_id = db.id(row.row())
-                mi = db.get_metadata(calibre_id, index_is_id=True)
-                if mi.has_identifier('casanova'):
-                    return True
-        return False
+            return not state['linked']
+        return bool(state['linked'])
 
 
     def is_no_books_selected(self):
@@ -111,20 +274,13 @@ class CasanovaUI(InterfaceAction):
 
     def get_selected_casanova_id(self, base_only=False):
         ''' Gets the selected book's Casanova id (if multiple are selected, it gets the first one) '''
-        db = self.gui.current_db
-        rows = self.gui.library_view.selectionModel().selectedRows()
-        if not rows or len(rows) == 0:
-            return False
-        for row in rows:
-            calibre_id = db.id(row.row())
-            mi = db.get_metadata(calibre_id, index_is_id=True)
-            if mi.has_identifier('casanova'):
-                res = mi.identifiers['casanova'].split('.')
-                if (len(res)==2):
-                    if base_only:
-                        return res[0]
-                    else:
-                        return {'id':res[0], 'revision':res[1]}
+        for calibre_id, identifier in self.get_selection_state()['linked']:
+            res = identifier.split('.')
+            if (len(res)==2):
+                if base_only:
+                    return res[0]
+                else:
+                    return {'id':res[0], 'revision':res[1]}
         return False
 
 
@@ -214,59 +370,160 @@ class CasanovaUI(InterfaceAction):
             self.gui.quit(restart=True)
 
 
-    def add_book(self):
-        ''' Adds a book to Casanova '''
+    def get_book_formats(self, book_id):
+        ''' The paths of the book's files in the library, by lower case format; the upload job copies them '''
         db = self.gui.current_db
-        row = self.get_selected_row()
-        if self.gui.current_view() is self.gui.library_view:
-            book_id = self.gui.library_view.model().id(row)
-        else:
-            book_id = self.gui.current_view().model().id(row)
-        mi = db.get_metadata(book_id, index_is_id=True)
-
         formats = {}
         fmts = db.formats(book_id, index_is_id=True, verify_formats=False)
         if fmts:
             fmts = fmts.split(',')
             for fmt in fmts:
-                fpath = db.format(book_id, fmt, index_is_id=True, as_path=True)
+                fpath = db.format_abspath(book_id, fmt, index_is_id=True)
                 if fpath is not None:
                     formats[fmt.lower()] = fpath
+        return formats
+
+    def add_book(self):
+        ''' Adds a book to Casanova, or several if more than one is selected '''
+        db = self.gui.current_db
+        book_ids = self.get_unlinked_selected_ids()
+        if len(book_ids) > 1:
+            return self.add_books(book_ids)
+        if not book_ids:
+            return
+        # Not the current row, which may be a book already on Casanova
+        book_id = book_ids[0]
+        mi = db.get_metadata(book_id, index_is_id=True)
+
+        formats = self.get_book_formats(book_id)
         if len(formats)==0:
             return
 
-        add_dialog = AddBookDialog(self.gui, self.mm, mi)
+        add_dialog = load_plugin_module('dialogs').AddBookDialog(self.gui, self.mm, mi)
         add_dialog.exec_()
         if add_dialog.result() != add_dialog.Accepted:
             return
         self.am.add(book_id, mi, formats, add_dialog.one_line_description)
         db.commit()
 
-    def refresh_metadata(self):
-        ''' Download any changes on the Casanova metadata server to an item locally '''
-        row = self.get_selected_row()
-        if self.gui.current_view() is self.gui.library_view:
-            id = self.gui.library_view.model().id(row)
-        else:
-            id = self.gui.current_view().model().id(row)
-        result = self.mm.update(id)
+    def add_books(self, book_ids):
+        ''' Adds several books to Casanova, with one dialog for all of them '''
+        db = self.gui.current_db
+        books = []
+        no_files = []
+        for book_id in book_ids:
+            mi = db.get_metadata(book_id, index_is_id=True)
+            # Only the names for now; the upload jobs copy the files of the books added
+            formats = db.formats(book_id, index_is_id=True, verify_formats=False)
+            if not formats:
+                no_files.append(mi.title)
+                continue
+            books.append({'book_id': book_id, 'mi': mi, 'title': mi.title,
+                          'authors': mi.authors, 'formats': formats.lower().split(',')})
+        if no_files:
+            print('Not adding books without any files: ' + ', '.join(no_files))
+        if not books:
+            return
+        add_dialog = load_plugin_module('dialogs').BulkAddDialog(self.gui, self.mm, books)
+        add_dialog.exec_()
+        if add_dialog.result() != add_dialog.Accepted or not add_dialog.selected_books:
+            return
+        by_id = dict((book['book_id'], book) for book in books)
+        self.am.add_many([(book_id, by_id[book_id]['mi'], self.get_book_formats(book_id), one_liner)
+                          for book_id, one_liner in add_dialog.selected_books])
+
+    def run_network(self, message, func, args, done, priority=None):
+        '''
+        Runs func(*args) on the network engine, so the GUI stays responsive,
+        and calls done(future) in the GUI thread once it has finished.
+        '''
+        scheduler = load_plugin_module('scheduler')
+        if priority is None:
+            priority = scheduler.NORMAL
+        self.gui.status_bar.show_message(message)
+        future = load_plugin_module('engine').engine.submit_abortable(priority, func, *args)
+        self._network_calls.add(future)
+        future.add_done_callback(Dispatcher(partial(self.network_call_done, done)))
+        return future
+
+    def apply_in_job(self, description, func, args, done):
+        '''
+        Runs one of the metadata manager's apply methods as a calibre job,
+        so the jobs panel shows its progress and it can be cancelled, then
+        done(result) in the GUI thread.
+        '''
+        metadata = load_plugin_module('metadata')
+        job = metadata.start_casanova_apply(Dispatcher(partial(self.updates_applied, done)),
+                                            self.gui.job_manager, description, func, args)
+        self._apply_jobs.add(job)
+        self.gui.status_bar.show_message(description, 3000)
+
+    def updates_applied(self, done, job):
+        if job not in self._apply_jobs:
+            # Started for a library that has since been closed
+            return
+        self._apply_jobs.discard(job)
+        if job.failed:
+            if not getattr(job, 'killed', False):
+                self.gui.job_exception(job, dialog_title=_('Failed to apply updates from Casanova'))
+            return
+        done(job.result)
+
+    def network_call_done(self, done, future):
+        self._network_calls.discard(future)
+        if future.aborted.is_set():
+            # Cancelled, e.g. because the library was switched
+            return
+        done(future)
+
+    def show_metadata_counts(self, result, messages=()):
+        ''' Reports the added/updated counts of a metadata fetch, or the message sent instead '''
         if isinstance(result, dict):
             return info_dialog(self.gui, 'Metadata retrieved',
-                        unicode(result['added']) + ' added and ' + unicode(result['updated']) + ' updated', show=True)
-        elif isinstance(result, str):
-            return info_dialog(self.gui, 'Casanova message', unicode(result), show=True)
+                        unicode(result['added']) + ' added and ' + unicode(result['updated']) + ' updated',
+                        det_msg='\n'.join(unicode(m) for m in messages), show=True)
+        return info_dialog(self.gui, 'Casanova message', unicode(result), show=True)
+
+    def get_selected_linked_ids(self):
+        ''' The calibre ids of the selected books that are linked to Casanova '''
+        return [book_id for book_id, identifier in self.get_selection_state()['linked']]
+
+    def refresh_metadata(self):
+        ''' Download any changes on the Casanova metadata server to the selected items locally '''
+        identifiers = [identifier for book_id, identifier in self.get_selection_state()['linked']]
+        if not identifiers:
+            return
+        self.run_network(_('Fetching metadata updates from Casanova...'),
+                         self.mm.fetch_updates, (identifiers,), self.metadata_updates_fetched,
+                         load_plugin_module('scheduler').INTERACTIVE)
+
+    def metadata_updates_fetched(self, future):
+        if future.exception() is not None:
+            return error_dialog(self.gui, 'Unable to Sync', unicode(future.exception()), show=True)
+        self.apply_in_job(_('Applying metadata updates from Casanova'),
+                          self.mm.apply_updates, (future.result(),), self.metadata_updates_applied)
+
+    def metadata_updates_applied(self, result):
+        if result['added'] or result['updated'] or not result['messages']:
+            return self.show_metadata_counts(result, result['messages'])
+        return info_dialog(self.gui, 'Casanova message', '\n'.join(unicode(m) for m in result['messages']), show=True)
 
 
     def upload_metadata(self):
         ''' Upload any changes we have made locally to the Casanova metadata server '''
-        row = self.get_selected_row()
-        if self.gui.current_view() is self.gui.library_view:
-            id = self.gui.library_view.model().id(row)
-        else:
-            id = self.gui.current_view().model().id(row)
-        result = self.mm.commit(id)
-        if isinstance(result, str):
-            return info_dialog(self.gui, 'Casanova message', unicode(result), show=True)
+        book_ids = self.get_selected_linked_ids()
+        if not book_ids:
+            return
+        # The library is read here, in the GUI thread; only the network calls run in the background
+        self.run_network(_('Uploading metadata to Casanova...'),
+                         self.mm.commit_many, (self.mm.prepare_commit(book_ids),), self.metadata_uploaded)
+
+    def metadata_uploaded(self, future):
+        if future.exception() is not None:
+            return error_dialog(self.gui, 'Unable to upload metadata', unicode(future.exception()), show=True)
+        messages = future.result()
+        if messages:
+            return info_dialog(self.gui, 'Casanova message', '\n'.join(unicode(m) for m in messages), show=True)
             
 
     def show_configuration(self):
@@ -280,12 +537,11 @@ class CasanovaUI(InterfaceAction):
 
     def download_format(self):
         ''' Callback for downloading a format for a book '''
-        self.mm.refresh_book_map()
         casanova_id = self.get_selected_casanova_id(True)
         if not casanova_id:
             return error_dialog(self.gui, 'Unable to Sync',
                                 'This doesn\'t seem to be a Casanova text.', show=True)
-        choose_dialog = ChooseFormatToDownloadDialog(self.gui, self.dm, casanova_id)
+        choose_dialog = load_plugin_module('dialogs').ChooseFormatToDownloadDialog(self.gui, self.dm, casanova_id)
         choose_dialog.exec_()
         if choose_dialog.result() != choose_dialog.Accepted:
             return
@@ -301,8 +557,7 @@ class CasanovaUI(InterfaceAction):
 
     def update_issues(self):
         ''' Callback for syncing an issue '''
-        self.mm.refresh_issue_map()
-        choose_dialog = ChooseIssuesToUpdateDialog(self.gui, self.mm)
+        choose_dialog = load_plugin_module('dialogs').ChooseIssuesToUpdateDialog(self.gui, self.mm)
         choose_dialog.exec_()
         if choose_dialog.result() != choose_dialog.Accepted:
             return
@@ -310,15 +565,42 @@ class CasanovaUI(InterfaceAction):
         if choose_dialog.selected_issues is None:
             return error_dialog(self.gui, 'Unable to Sync',
                                 'Unable to retrieve updates to selected issues.', show=True)
-        # @todo: put this in a Dispatcher job
-        result = {'added':0, 'updated':0}
-        for issue in choose_dialog.selected_issues:
-            r = self.mm.sync(issue)
-            result['added'] = r['added']
-            result['updated'] = r['updated']
+        issues = [issue for issue in choose_dialog.selected_issues if issue]
+        if not issues:
+            return
+        self.gui.status_bar.show_message(_('Fetching issue updates from Casanova...'))
+        engine = load_plugin_module('engine').engine
+        bulk = load_plugin_module('scheduler').BULK
+        futures = [engine.submit_abortable(bulk, self.mm.fetch_sync, issue) for issue in issues]
+        self._network_calls.update(futures)
+        engine.when_all(futures, Dispatcher(partial(self.issues_fetched, issues)))
+
+    def issues_fetched(self, issues, futures):
+        ''' Applies the fetched issue updates, as a job '''
+        self._network_calls.difference_update(futures)
+        if any(future.aborted.is_set() for future in futures):
+            return
+        fetched = []
+        errors = []
+        for issue, future in zip(issues, futures):
+            if future.exception() is not None:
+                errors.append(unicode(future.exception()))
+            else:
+                fetched.append((issue, future.result()))
+        if not fetched:
+            return error_dialog(self.gui, 'Unable to Sync',
+                                'Unable to retrieve updates to selected issues.',
+                                det_msg='\n'.join(errors), show=True)
+        self.apply_in_job(_('Applying issue updates from Casanova'), self.mm.apply_zip_responses,
+                          ([response for issue, response in fetched],),
+                          partial(self.issues_applied, [issue for issue, response in fetched], errors))
 
-        return info_dialog(self.gui, 'Metadata retrieved',
-                                unicode(result['added']) + ' added and ' + unicode(result['updated']) + ' updated', show=True)               
+    def issues_applied(self, issues, errors, result):
+        # An issue whose answer was a message, not a zip, has not been synced
+        for issue, applied in zip(issues, result['results']):
+            if isinstance(applied, dict):
+                self.mm.mark_synced(issue)
+        return self.show_metadata_counts(result, errors + result['messages'])
 
 
     def update_author(self):
@@ -338,36 +620,45 @@ class CasanovaUI(InterfaceAction):
         for x in authors:
             corrected_authors[x] = author_to_author_sort(x)
         
-        result = {'added':0, 'updated':0}
         if len(corrected_authors)>1:
-            choose_dialog = ChooseAuthorsToUpdateDialog(self.gui, self.mm, corrected_authors)
+            choose_dialog = load_plugin_module('dialogs').ChooseAuthorsToUpdateDialog(self.gui, self.mm, corrected_authors)
             choose_dialog.exec_()
             if choose_dialog.result() != choose_dialog.Accepted:
                 return
             if choose_dialog.selected_authors is None:
                 return error_dialog(self.gui, 'Unable to Sync',
                                     'Unable to retrieve updates to selected issues.', show=True)
-            # @todo: put this in a Dispatcher job
             selected_authors_string = '|'.join(choose_dialog.selected_authors)
-            result = self.mm.author_sync(selected_authors_string)
-        if len(corrected_authors) == 1:
-            for k,v in corrected_authors.items():
-                result = self.mm.author_sync(v) 
-
-        return info_dialog(self.gui, 'Metadata retrieved',
-                                unicode(result['added']) + ' added and ' + unicode(result['updated']) + ' updated', show=True)               
+        elif len(corrected_authors) == 1:
+            selected_authors_string = corrected_authors.values()[0]
+        else:
+            return
+        self.run_network(_('Fetching texts by author from Casanova...'),
+                         self.mm.fetch_author, (selected_authors_string,), self.texts_fetched,
+                         load_plugin_module('scheduler').BULK)
+
+    def texts_fetched(self, future):
+        ''' Merges a fetched zip of texts into the library, as a job '''
+        if future.exception() is not None:
+            return error_dialog(self.gui, 'Unable to Sync', unicode(future.exception()), show=True)
+        self.apply_in_job(_('Applying texts from Casanova'), self.mm.apply_zip_responses,
+                          ([future.result()],), self.texts_applied)
+
+    def texts_applied(self, result):
+        if result['messages'] and not (result['added'] or result['updated']):
+            return self.show_metadata_counts(result['messages'][0])
+        return self.show_metadata_counts(result, result['messages'])
 
     def search(self):
-        search_dialog = SearchDialog(self.gui, self.mm)
+        search_dialog = load_plugin_module('dialogs').SearchDialog(self.gui, self.mm)
         search_dialog.exec_()
         if search_dialog.result() != search_dialog.Accepted:
             return
         if search_dialog.selected_texts is None:
             return error_dialog(self.gui, 'Unable to Sync',
                                 'No results!', show=True)
-        result = self.mm.get_texts(search_dialog.selected_texts)
-        return info_dialog(self.gui, 'Metadata retrieved',
-                                unicode(result['added']) + ' added and ' + unicode(result['updated']) + ' updated', show=True)
+        self.run_network(_('Fetching texts from Casanova...'),
+                         self.mm.fetch_texts, (search_dialog.selected_texts,), self.texts_fetched)
 
 
     def create_menu_item_ex(self, parent_menu, menu_text, image=None, tooltip=None,
@@ -8,32 +8,44 @@ __docformat__ = 'restructuredtext en'
 
 import os
 import shutil
-from contextlib import closing
-from mechanize import MozillaCookieJar
+from functools import partial
 import json
-import mimetypes
-import urllib
-import urllib2
-import StringIO
-from base64 import b64encode
-
-from calibre import browser, get_download_filename, url_slash_cleaner
-from calibre.ebooks import BOOK_EXTENSIONS
+
 from calibre.gui2 import Dispatcher, info_dialog, error_dialog
 from calibre.gui2.threaded_jobs import ThreadedJob
-from calibre.ptempfile import PersistentTemporaryFile
-from calibre.utils.filenames import ascii_filename
+from calibre.ptempfile import TemporaryDirectory
 
 from calibre.ebooks.metadata import author_to_author_sort
-from calibre.ebooks.metadata.opf2 import OPF, metadata_to_opf
+from calibre.ebooks.metadata.opf2 import metadata_to_opf
+from calibre.utils.config import prefs as calibre_prefs
 
 from calibre_plugins.casanova_plugin.config import prefs
+from calibre_plugins.casanova_plugin.client import client, Cancelled
+from calibre_plugins.casanova_plugin.content import content_hash, known_content, record_synced_covers
+from calibre_plugins.casanova_plugin.covers import covers
+from calibre_plugins.casanova_plugin.library import cover_path
+from calibre_plugins.casanova_plugin.progress import JobProgress
+from calibre_plugins.casanova_plugin.resumable import (ResumableUpload, UnsupportedServer, send_all,
+                                                      session_key)
+from calibre_plugins.casanova_plugin.transfers import uploads
 
 
 class CasanovaAdder(object):
-	''' Simple class to encapsulate posting a new text to Casanova server '''
+	'''
+	Posts a new text, with every format of it and its cover, to the Casanova server. Small
+	formats are streamed in the new_text request itself; formats above the
+	chunked_upload_threshold pref are first sent in resumable chunks, all
+	of them together. Files the server already holds (by content hash) are
+	not sent at all, only their hash. Returns {'casanova_id': the new id or None, 'formats':
+	{format: 'success' or what went wrong}}; a format counts as added only when the server
+	says so. Servers that do not announce the 'formats' feature get one format, the way the
+	original protocol sent it. The job does not touch the library database: the paths of
+	the book's files and cover are read beforehand, and the new id is recorded by
+	CasanovaAddManager. The files are hashed where they are, and the job copies out of the
+	library only those it sends.
+	'''
 
-	def __call__(self, gui, title, authors, description, one_liner, issues, opf, file_loc, mi, book_id, log=None, abort=None, notifications=None):
+	def __call__(self, gui, title, authors, description, one_liner, issues, opf, formats, original_cover, book_id, log=None, abort=None, notifications=None):
 		values = {'cmd' : 'new_text',
 		          'title' : title,
 		          'authors' : authors,
@@ -41,62 +53,180 @@ class CasanovaAdder(object):
 		          'description' : description,
 		          'issues' : issues,
 		          'opf' : opf }
-		if file_loc:
-			with open(file_loc, 'rb') as f:
-				td = f.read()
-				values['text'] = b64encode(td)
-				fn, ext = os.path.splitext(file_loc)
-				values['text_ext'] = ext
-		response = self._post(values)
+		if abort is not None and abort.is_set():
+			return None
+		with TemporaryDirectory('_casanova_upload') as tdir:
+			return self._add(values, formats, tdir, original_cover, abort, notifications)
+
+	def _copy(self, path, tdir):
+		''' A copy of a library file to send, so the library can change the file while it goes '''
+		copy = os.path.join(tdir, os.path.basename(path))
+		shutil.copy2(path, copy)
+		return copy
+
+	def _add(self, values, formats, tdir, original_cover, abort, notifications):
+		title = values['title']
+		# The cover goes along too, shrunk by the cover pipeline
+		cover = covers.prepare(original_cover)
+		if 'formats' not in client.features():
+			return self._add_one_format(values, formats, tdir, cover, original_cover, abort)
+		results = {}
+		files = {}
+		chunked = {}
+		copies = {}
+		# Unchanged library files are hashed once, not on every add
+		hashes = dict((fmt, content_hash(path)) for fmt, path in formats.iteritems())
+		if cover:
+			values['cover_hash'] = content_hash(cover)
+			values['cover_ext'] = os.path.splitext(cover)[1]
+		known = known_content(hashes.values() + ([values['cover_hash']] if cover else []), abort)
+		if cover and values['cover_hash'] not in known:
+			files['cover'] = cover
+		for fmt, path in formats.iteritems():
+			if hashes[fmt] in known:
+				print('Casanova already has the %s of %s' % (fmt.upper(), title))
+				values['text_hash_' + fmt] = hashes[fmt]
+				continue
+			copies[fmt] = self._copy(path, tdir)
+			if content_hash(path) != hashes[fmt]:
+				# The library changed the file after it was hashed
+				hashes[fmt] = content_hash(copies[fmt])
+			values['text_hash_' + fmt] = hashes[fmt]
+			if os.path.getsize(copies[fmt]) > prefs['chunked_upload_threshold']:
+				chunked[fmt] = copies[fmt]
+			else:
+				# Streamed from disk rather than read and base64 encoded here
+				files['text_' + fmt] = copies[fmt]
+		# One part of the job's progress per chunked format, and one for the request
+		progress = JobProgress(notifications, _('Uploading'))
+		parts = sorted(chunked) + [None]
+		inline = ', '.join(sorted(fmt.upper() for fmt in formats if 'text_' + fmt in files))
+		upload_progress = progress.part(len(parts) - 1, len(parts), _('Uploading %s') % inline if inline else None)
+		with uploads.slot(abort) as slot:
+			started = {}
+			for i, fmt in enumerate(parts[:-1]):
+				# Resumed by the library file, not the copy
+				upload = ResumableUpload(chunked[fmt], abort, progress.part(i, len(parts), _('Uploading %s') % fmt.upper()),
+				                         session_key(formats[fmt]))
+				try:
+					upload.start()
+					started[fmt] = upload
+				except UnsupportedServer:
+					files['text_' + fmt] = chunked[fmt]
+				except Cancelled:
+					raise
+				except Exception as e:
+					results[fmt] = unicode(e)
+			errors = send_all(started.values())
+			for fmt, upload in started.items():
+				if upload in errors:
+					results[fmt] = unicode(errors[upload])
+					del started[fmt]
+				else:
+					values['text_upload_' + fmt] = upload.session
+			sent = sorted(fmt for fmt in formats if fmt not in results)
+			if not sent:
+				raise Exception(_('None of the formats could be uploaded: ') + '; '.join(
+					'%s: %s' % (fmt.upper(), error) for fmt, error in sorted(results.iteritems())))
+			values['formats'] = '|'.join(sent)
+			response = self._post(values, abort=abort, progress=upload_progress, files=files, transfer=True)
+			slot.bytes = sum(os.path.getsize(copies[fmt]) for fmt in sent if fmt in copies)
+		doc = self._answer(response)
+		accepted = doc.get('formats')
+		if not isinstance(accepted, dict):
+			accepted = {}
+		for fmt in sent:
+			# Only what the server lists as added was added
+			results[fmt] = accepted.get(fmt, _('The server did not list it as added'))
+			if fmt in started and results[fmt] == 'success':
+				started[fmt].finished()
+		return {'casanova_id': self._added(doc, original_cover), 'formats': results}
+
+	def _add_one_format(self, values, formats, tdir, cover, original_cover, abort):
+		'''
+		Adds a text to a server that takes a single format, in the text and
+		text_ext fields of the original protocol. The format sent is the one
+		first in calibre's input format order; the others are not added.
+		'''
+		order = [fmt.lower() for fmt in calibre_prefs['input_format_order']]
+		fmt = min(formats, key=lambda fmt: (order.index(fmt) if fmt in order else len(order), fmt))
+		values['text_ext'] = os.path.splitext(formats[fmt])[1]
+		files = {'text': self._copy(formats[fmt], tdir)}
+		if cover:
+			values['cover_ext'] = os.path.splitext(cover)[1]
+			files['cover'] = cover
+		with uploads.slot(abort) as slot:
+			response = self._post(values, abort=abort, files=files, transfer=True)
+			slot.bytes = os.path.getsize(files['text'])
+		doc = self._answer(response)
+		casanova_id = self._added(doc, original_cover)
+		results = dict((other, _('The server takes one format per text')) for other in formats)
+		results[fmt] = 'success' if casanova_id else doc.get('status')
+		return {'casanova_id': casanova_id, 'formats': results}
+
+	def _answer(self, response):
+		''' The server's answer to new_text, as a dict '''
 		the_page = response.read()
 		try: 
 			doc = json.loads(the_page)
 		except:
-			return False
-		if 'status' in doc and doc['status']=='success':
-			mi.identifiers['casanova'] = doc['casanova_id']
-			gui.current_db.set_metadata(book_id, mi)
-			gui.current_db.commit()
-			print('book added with casanova id=' + doc['casanova_id'])
-			return True
-		return False
-
-	def _post(self, values, path='/api/do'):
+			doc = None
+		return doc if isinstance(doc, dict) else {'status': the_page}
+
+	def _added(self, doc, original_cover):
+		''' The casanova id of the text new_text added, or None '''
+		if doc.get('status') != 'success' or not doc.get('casanova_id'):
+			return None
+		casanova_id = doc['casanova_id']
+		print('book added with casanova id=' + casanova_id)
+		if original_cover:
+			record_synced_covers({casanova_id.partition('.')[0]: content_hash(original_cover)})
+		return casanova_id
+
+	def _post(self, values, path='/api/do', abort=None, progress=None, files=None, transfer=False):
 		''' Posts something to the casanova listener url '''
-		self.base_url = prefs['base_url']
-		url = url_slash_cleaner(self.base_url + path)
-		user_agent = 'Casanova/1.0 (compatible; MSIE 5.5; Windows NT)'
-		values['un'] = prefs['username']
-		values['pw'] = prefs['password']
-		headers = { 'User-Agent' : user_agent, 'Content-type': 'application/x-www-form-urlencoded; charset=UTF-8' }
-		data = urllib.urlencode(values)
-		req = urllib2.Request(url, data, headers)
-		response = urllib2.urlopen(req)
-		return response
+		return client.post(values, path, abort=abort, progress=progress, files=files, transfer=transfer)
 
 
 gui_casanova_adder = CasanovaAdder()
 
-def start_casanova_upload(callback, job_manager, gui, title, authors, description, one_liner, issues, opf, file_loc, mi, book_id):
+def start_casanova_upload(callback, job_manager, gui, title, authors, description, one_liner, issues, opf, formats, cover, book_id):
 	description = _('Adding %s') % title
-	job = ThreadedJob('casanova_add', description, gui_casanova_adder, (gui, title, authors, description, one_liner, issues, opf, file_loc, mi, book_id), {}, callback, max_concurrent_count=1, killable=False)
+	job = ThreadedJob('casanova_add', description, gui_casanova_adder, (gui, title, authors, description, one_liner, issues, opf, formats, cover, book_id), {}, callback, max_concurrent_count=uploads.job_limit(), killable=True)
 	job_manager.run_threaded_job(job)
 
 
 class CasanovaAddManager(object):
-	def __init__(self, gui):
+	def __init__(self, gui, mm):
 		print('New Casanova add manager created')
 		self.gui = gui
+		self.mm = mm
 		self.db = gui.current_db
 
 	def add(self, book_id,  mi, formats, one_liner=''):
-		self.one_liner = one_liner
-		self.title = mi.title
+		args = self._job_args(book_id, mi, formats, one_liner)
+		start_casanova_upload(Dispatcher(self.added), self.gui.job_manager, self.gui, *args)
+		self.gui.status_bar.show_message(_('Adding') + ' ' + unicode(mi.title), 3000)
+
+	def add_many(self, books):
+		'''
+		Adds several books, given as (book_id, mi, formats, one_liner). Each
+		book is a job of its own and the job manager runs several at once;
+		the outcome is reported for all of them together once they are done.
+		'''
+		bulk = {'pending': len(books), 'added': [], 'failed': []}
+		callback = Dispatcher(partial(self.added_in_bulk, bulk))
+		for book_id, mi, formats, one_liner in books:
+			args = self._job_args(book_id, mi, formats, one_liner)
+			start_casanova_upload(callback, self.gui.job_manager, self.gui, *args)
+		self.gui.status_bar.show_message(_('Adding %d texts to Casanova') % len(books), 3000)
+
+	def _job_args(self, book_id, mi, formats, one_liner):
+		''' The arguments of the job adding a book '''
 		# authors
 		authors = []
 		for x in mi.authors:
 			authors.append(author_to_author_sort(x))
-		self.authors = '|'.join(authors)
 		# issues
 		issues = []
 		um = mi.get_all_user_metadata(False)
@@ -105,28 +235,51 @@ class CasanovaAddManager(object):
 			for issue_str in issue_strs:
 				issue_id = issue_str.rpartition('(')[-1].partition(')')[0]
 				issues.append(issue_id)
-		self.issues = '|'.join(issues)
-		# etc
-		self.description = mi.comments
-		# opf
-		self.opf = metadata_to_opf(mi)
-		# file to upload
-		for format, file_loc in formats.items():
-			self.file = file_loc
-		# metadata
-		self.mi = mi
-		self.book_id = book_id
-		self._start()
-
-	def _start(self):
-		start_casanova_upload(Dispatcher(self.added), self.gui.job_manager, self.gui, self.title, self.authors, self.description, self.one_liner, self.issues, self.opf, self.file, self.mi, self.book_id)
-		self.gui.status_bar.show_message(_('Adding') + ' ' + unicode(self.title), 3000)
+		# files to upload, by format, and the cover, read here as the job does not touch the library
+		return (mi.title, '|'.join(authors), mi.comments, one_liner, '|'.join(issues),
+		        metadata_to_opf(mi), dict(formats), cover_path(self.db, book_id), book_id)
 
+	def link(self, book_id, casanova_id):
+		''' Records the casanova id the server gave a new text on its book. Runs in the GUI thread. '''
+		self.db.set_identifier(book_id, 'casanova', casanova_id)
+		self.db.commit()
+		self.mm.book_map.refresh_books([book_id])
 
 	def added(self, job):
 		if job.failed:
 			self.gui.job_exception(job, dialog_title=_('Failed to add text. Sorry.'))
 			return
+		book_id = job.args[-1]
+		if job.result and job.result.get('casanova_id'):
+			self.link(book_id, job.result['casanova_id'])
 		self.gui.status_bar.show_message(job.description + ' ' + _('finished'), 5000)
+		result = job.result or {}
+		failed = [(fmt, status) for fmt, status in sorted(result.get('formats', {}).iteritems()) if status != 'success']
+		if failed or not result.get('casanova_id'):
+			lines = ['%s: %s' % (fmt.upper(), status) for fmt, status in sorted(result.get('formats', {}).iteritems())]
+			error_dialog(self.gui, _('Casanova message'), _('Not every format of %s was added.') % job.args[1],
+			             det_msg='\n'.join(lines), show=True)
 
-
+	def added_in_bulk(self, bulk, job):
+		''' Collects the outcome of one of the jobs started by add_many() '''
+		bulk['pending'] -= 1
+		title = job.args[1]
+		result = {} if job.failed else (job.result or {})
+		if job.failed:
+			bulk['failed'].append('%s: %s' % (title, job.exception or _('failed')))
+		elif not result.get('casanova_id'):
+			bulk['failed'].append('%s: %s' % (title, '; '.join(
+				'%s %s' % (fmt.upper(), status) for fmt, status in sorted(result.get('formats', {}).iteritems()))))
+		else:
+			self.link(job.args[-1], result['casanova_id'])
+			bulk['added'].append(title)
+			failed = ['%s %s' % (fmt.upper(), status) for fmt, status in sorted(result['formats'].iteritems()) if status != 'success']
+			if failed:
+				bulk['failed'].append('%s: %s' % (title, '; '.join(failed)))
+		if bulk['pending'] > 0:
+			return
+		message = _('%d texts added to Casanova.') % len(bulk['added'])
+		if not bulk['failed']:
+			return info_dialog(self.gui, _('Casanova message'), message, show=True)
+		error_dialog(self.gui, _('Casanova message'), message + ' ' + _('%d had problems.') % len(bulk['failed']),
+		             det_msg='\n'.join(bulk['failed']), show=True)